@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''模拟的设备主机，提供与qt4i driver一致的host/和device/<udid>/接口
+
+控件树、截图和沙盒内容均为生成的数据，可配置大小并注入延迟，用于在没有Mac和
+iPhone的环境下调试和测试UISpy的性能。
+
+单独运行:
+    python -m benchmark.fakehost --port 12306 --devices 2 --tree-depth 6
+'''
+
+import base64
+import optparse
+import random
+import struct
+import threading
+import time
+import zlib
+
+from rpc.server import ThreadedJSONRPCServer
+from util import uitree
+
+
+CLASSNAMES = ('Window', 'Other', 'NavigationBar', 'Button', 'StaticText', 'Image',
+              'Cell', 'Table', 'ScrollView', 'TextField', 'Switch')
+
+
+def make_png(width, height, seed=0):
+    '''生成指定大小的PNG图片，内容为带噪点的渐变，压缩率接近真实截图
+    '''
+    rand = random.Random(seed)
+    rows = []
+    for y in range(height):
+        base = y * 255 // max(1, height - 1)
+        noise = ''.join(chr(rand.randint(0, 255)) for _ in range(max(1, width // 16)))
+        row = bytearray(width * 3)
+        for x in range(width):
+            value = (base + ord(noise[x % len(noise)])) & 0xff if x % 16 == 0 else base
+            row[x * 3] = value
+            row[x * 3 + 1] = (value + x) & 0xff
+            row[x * 3 + 2] = 255 - value
+        rows.append('\x00' + str(row))
+    raw = ''.join(rows)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    return ('\x89PNG\r\n\x1a\n'
+            + chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk('IDAT', zlib.compress(raw, 6))
+            + chunk('IEND', ''))
+
+
+def make_element_tree(depth=5, breadth=4, width=375, height=667, seed=0):
+    '''生成qt4i格式的控件树，根节点为Application，子控件在父控件范围内平铺
+
+    :param depth: 树的深度
+    :type depth: int
+    :param breadth: 每个控件的子控件数
+    :type breadth: int
+    '''
+    rand = random.Random(seed)
+    counter = [0]
+
+    def node(classname, x, y, w, h, level):
+        counter[0] += 1
+        index = counter[0]
+        named = rand.random() < 0.3
+        element = {'classname': classname,
+                   'name': 'element_%d' % index if named else None,
+                   'label': u'标签%d' % index if rand.random() < 0.3 else None,
+                   'value': u'%d' % index if rand.random() < 0.1 else None,
+                   'visible': rand.random() < 0.95,
+                   'enabled': True,
+                   'rect': {'origin': {'x': x, 'y': y}, 'size': {'width': w, 'height': h}},
+                   'children': []}
+        if level < depth:
+            # alternate between horizontal and vertical stripes
+            for i in range(breadth):
+                if level % 2:
+                    cw, ch = w / float(breadth), h
+                    cx, cy = x + i * cw, y
+                else:
+                    cw, ch = w, h / float(breadth)
+                    cx, cy = x, y + i * ch
+                element['children'].append(
+                    node(CLASSNAMES[rand.randint(1, len(CLASSNAMES) - 1)], cx, cy, cw, ch, level + 1))
+        return element
+
+    tree = node('Application', 0, 0, width, height, 0)
+    tree['name'] = 'FakeApp'
+    return tree
+
+
+def make_sandbox(depth=3, dirs=3, files=5, file_size=2048, seed=0):
+    '''生成沙盒目录
+
+    :returns: dict -- {path: None(目录) 或者 文件内容}
+    '''
+    rand = random.Random(seed)
+    sandbox = {'/': None}
+
+    def fill(path, level):
+        for i in range(files):
+            # 大文件重复同一段随机内容，避免生成过慢
+            content = ''.join(chr(rand.randint(32, 126)) for _ in range(min(file_size, 4096)))
+            content = (content * (file_size // len(content) + 1))[:file_size]
+            sandbox['%sfile_%d.txt' % (path, i)] = content
+        if level < depth:
+            for i in range(dirs):
+                child = '%sdir_%d/' % (path, i)
+                sandbox[child] = None
+                fill(child, level + 1)
+    for name in ('Documents/', 'Library/', 'tmp/'):
+        sandbox['/' + name] = None
+        fill('/' + name, 1)
+    return sandbox
+
+
+class FakeDevice(object):
+    '''模拟的iOS设备
+    '''
+
+    def __init__(self, udid, name, simulator=False, tree_depth=5, tree_breadth=4,
+                 screen_size=(750, 1334), sandbox_depth=3, sandbox_file_size=2048, animation=0,
+                 install_failures=0, seed=0):
+        self.udid = udid
+        self.name = name
+        self.simulator = simulator
+        self.tree_depth = tree_depth
+        self.tree_breadth = tree_breadth
+        self.screen_size = screen_size
+        self.seed = seed
+        self.orientation = 1
+        self.apps = [{'com.tencent.fake%d' % i: 'FakeApp%d' % i} for i in range(5)]
+        self.running_app = None
+        self.actions = []
+        self._sandbox_depth = sandbox_depth
+        self._sandbox_file_size = sandbox_file_size
+        self._sandbox_mtimes = {}
+        self.animation = animation  # 每次界面操作后画面持续变化的时间（秒）
+        self._animating_until = 0
+        self.install_failures = install_failures  # 之后的多少次安装失败
+        self._tree = None
+        self._tree_seed = seed
+        self._tree_hashes = None
+        self._screenshot = None
+        self._sandbox = None
+        self._lock = threading.Lock()
+
+    def info(self):
+        return {'udid': self.udid, 'name': self.name, 'simulator': self.simulator, 'ios': '11.0'}
+
+    def element_tree(self):
+        if self._tree is None:
+            width, height = self.screen_size
+            self._tree = make_element_tree(self.tree_depth, self.tree_breadth, width / 2, height / 2, self._tree_seed)
+        return self._tree
+
+    def tree_hashes(self):
+        with self._lock:
+            tree, hashes = self.element_tree(), self._tree_hashes
+        if hashes is None or hashes[0] is not tree:
+            hashes = (tree, uitree.hash_tree(tree, hashes[1] if hashes else None))
+            with self._lock:
+                self._tree_hashes = hashes
+        return hashes
+
+    def screenshot(self):
+        if self._screenshot is None:
+            self._screenshot = make_png(self.screen_size[0], self.screen_size[1], self.seed)
+        now = time.time()
+        if now < self._animating_until:
+            # 动画中每帧的截图都不同，PNG结尾之后的数据不影响显示
+            return self._screenshot + str(int(now * 60))
+        return self._screenshot
+
+    def sandbox(self):
+        if self._sandbox is None:
+            self._sandbox = make_sandbox(self._sandbox_depth, file_size=self._sandbox_file_size, seed=self.seed)
+        return self._sandbox
+
+    def mutate(self, local=True):
+        '''模拟界面变化，截图重新生成
+
+        :param local: 为True时只改变一个控件的文本，与大多数点击的效果相同，否则重新生成控件树
+        :type local: bool
+        '''
+        with self._lock:
+            self.seed += 1
+            self._screenshot = None
+            if not local or self._tree is None:
+                self._tree_seed = self.seed
+                self._tree = None
+                return
+            # copy the path to the changed element, the tree may be being serialised
+            rand = random.Random(self.seed)
+            tree = element = dict(self._tree)
+            while element['children']:
+                children = element['children'] = list(element['children'])
+                index = rand.randrange(len(children))
+                element = children[index] = dict(children[index])
+            element['label'] = u'标签%d' % self.seed
+            self._tree = tree
+
+    # remote methods, named after the qt4i device driver API
+
+    def capture_screen(self):
+        return base64.b64encode(self.screenshot())
+
+    def get_screen_orientation(self):
+        return self.orientation
+
+    def get_element_tree(self):
+        return self.element_tree()
+
+    def get_element_tree_delta(self, known):
+        '''只返回变化的子树，known中的子树以{"$ref": 哈希}代替，见util.uitree
+        '''
+        tree, hashes = self.tree_hashes()
+        return uitree.reference_subtrees(tree, set(known), hashes)
+
+    def _gesture(self, name, *args):
+        self.actions.append((name,) + args)
+        self.mutate()
+        self._animating_until = time.time() + self.animation
+
+    def click(self, x, y):
+        self._gesture('click', x, y)
+
+    def double_click(self, x, y):
+        self._gesture('double_click', x, y)
+
+    def long_click(self, x, y, duration=3):
+        self._gesture('long_click', x, y, duration)
+
+    def drag(self, x0, y0, x1, y1, duration=0, repeat=1, interval=0.5, velocity=1000):
+        self._gesture('drag', x0, y0, x1, y1)
+
+    def send_keys(self, text):
+        self._gesture('send_keys', text)
+
+    def start_app(self, bundle_id, app_params=None, env=None):
+        self.running_app = bundle_id
+        self.mutate(local=False)
+        return True
+
+    def stop_app(self, bundle_id):
+        if self.running_app == bundle_id:
+            self.running_app = None
+        return True
+
+    def install(self, ipa_path):
+        if self.install_failures > 0:
+            self.install_failures -= 1
+            raise IOError('failed to install %s' % ipa_path)
+        bundle_id = 'com.fake.installed.%d' % len(self.apps)
+        self.apps.append({bundle_id: ipa_path.rsplit('/', 1)[-1]})
+        return True
+
+    def uninstall(self, bundle_id):
+        self.apps = [app for app in self.apps if bundle_id not in app]
+        return True
+
+    def get_app_list(self, app_type='user'):
+        return self.apps
+
+    def get_sandbox_path_files(self, bundle_id, file_path):
+        if not file_path.endswith('/'):
+            file_path += '/'
+        result = []
+        for path in self.sandbox():
+            if path != file_path and path.startswith(file_path):
+                rest = path[len(file_path):].rstrip('/')
+                if '/' not in rest:
+                    content = self.sandbox()[path]
+                    result.append({'path': path.rstrip('/'), 'is_dir': path.endswith('/'),
+                                   'size': len(content) if content is not None else 0,
+                                   'mtime': self._sandbox_mtimes.get(path, 1500000000.0)})
+        result.sort(key=lambda item: item['path'])
+        return result
+
+    def is_sandbox_path_dir(self, bundle_id, file_path):
+        return self.sandbox().get(file_path.rstrip('/') + '/', '') is None
+
+    def get_sandbox_file_content(self, bundle_id, file_path):
+        content = self.sandbox().get(file_path)
+        if content is None:
+            raise IOError('%s is not a file' % file_path)
+        return base64.b64encode(content)
+
+    def get_sandbox_file_info(self, bundle_id, file_path):
+        sandbox = self.sandbox()
+        if file_path in sandbox and sandbox[file_path] is not None:
+            return {'size': len(sandbox[file_path]), 'mtime': self._sandbox_mtimes.get(file_path, 1500000000.0)}
+        dir_path = file_path.rstrip('/') + '/'
+        if dir_path not in sandbox:
+            raise IOError('%s does not exist' % file_path)
+        return {'size': 0, 'mtime': self._sandbox_mtimes.get(dir_path, 1500000000.0)}
+
+    def read_sandbox_file(self, bundle_id, file_path, offset, length):
+        content = self.sandbox().get(file_path)
+        if content is None:
+            raise IOError('%s is not a file' % file_path)
+        return base64.b64encode(content[offset:offset + length])
+
+    def write_sandbox_file(self, file_path, content):
+        '''模拟App修改或者新建沙盒中的文件，新建文件时所在目录的mtime随之变化
+        '''
+        now = time.time()
+        if file_path not in self.sandbox():
+            self._sandbox_mtimes[file_path.rsplit('/', 1)[0] + '/'] = now
+        self.sandbox()[file_path] = content
+        self._sandbox_mtimes[file_path] = now
+
+    def remove_sandbox_file(self, file_path):
+        '''模拟App删除沙盒中的文件
+        '''
+        del self.sandbox()[file_path]
+        self._sandbox_mtimes[file_path.rsplit('/', 1)[0] + '/'] = time.time()
+
+    def close_sandbox_client(self):
+        pass
+
+    def get_xcode_version(self):
+        return '9.2'
+
+    def get_ios_version(self):
+        return '11.0'
+
+
+class FakeHost(ThreadedJSONRPCServer):
+    '''模拟的设备主机
+
+    用法:
+        host = FakeHost(('127.0.0.1', 0), devices=2)
+        host.start()
+        ... HostDriver('127.0.0.1', host.port) ...
+        host.stop()
+    '''
+
+    def __init__(self, addr=('127.0.0.1', 0), devices=1, latency=0, method_latency=None,
+                 jitter=0, binary_screenshot=True, tree_delta=True, device_push=True, sandbox_chunks=True,
+                 **device_options):
+        '''
+        :param devices: 设备数量
+        :type devices: int
+        :param latency: 每次调用注入的延迟（秒）
+        :type latency: float
+        :param method_latency: 按方法名指定的延迟，例如{'device.get_element_tree': 0.2}
+        :type method_latency: dict
+        :param jitter: 延迟的随机波动比例
+        :type jitter: float
+        :param binary_screenshot: 是否提供GET device/<udid>/screenshot，为False时模拟只支持base64截图的主机
+        :type binary_screenshot: bool
+        :param tree_delta: 是否支持device.get_element_tree_delta，为False时模拟只支持全量控件树的主机
+        :type tree_delta: bool
+        :param device_push: 是否支持host.wait_for_devices，为False时模拟只能轮询设备列表的主机
+        :type device_push: bool
+        :param sandbox_chunks: 是否支持分块读取沙盒文件，为False时模拟只能一次读取整个文件的主机
+        :type sandbox_chunks: bool
+        :param device_options: 传给FakeDevice的参数，如tree_depth、screen_size
+        '''
+        ThreadedJSONRPCServer.__init__(self, addr)
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.jitter = jitter
+        self.binary_screenshot = binary_screenshot
+        self.tree_delta = tree_delta
+        self.device_push = device_push
+        self.sandbox_chunks = sandbox_chunks
+        self.devices = {}
+        self.devices_version = 0
+        self._device_options = device_options
+        self._devices_changed = threading.Condition()
+        self._next_index = 0
+        for _ in range(devices):
+            self.add_device()
+        self.calls = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='FakeHost')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _dispatch_request(self, data, dispatch_method=None, path=None):
+        return ThreadedJSONRPCServer._dispatch_request(
+            self, data, lambda method, params: self._call(path, method, params), path)
+
+    def add_device(self):
+        '''模拟插入一台设备
+
+        :returns: FakeDevice
+        '''
+        with self._devices_changed:
+            index = self._next_index
+            self._next_index += 1
+            udid = '%040x' % (index + 1)
+            device = FakeDevice(udid, 'FakePhone%d' % index, simulator=index % 2 == 1,
+                                seed=index, **self._device_options)
+            devices = dict(self.devices)
+            devices[udid] = device
+            self.devices = devices
+            self._bump_devices_version()
+        return device
+
+    def remove_device(self, udid):
+        '''模拟拔出一台设备
+        '''
+        with self._devices_changed:
+            devices = dict(self.devices)
+            del devices[udid]
+            self.devices = devices
+            self._bump_devices_version()
+
+    def _bump_devices_version(self):
+        self.devices_version += 1
+        self._devices_changed.notify_all()
+
+    def _get_resource(self, path):
+        parts = [part for part in path.split('?', 1)[0].split('/') if part]
+        if not self.binary_screenshot or len(parts) != 3 or parts[0] != 'device' or parts[2] != 'screenshot':
+            return None
+        device = self.devices.get(parts[1])
+        if device is None:
+            return None
+        self._delay('screenshot')
+        return device.screenshot(), 'image/png'
+
+    def _delay(self, method):
+        self.calls += 1
+        delay = self.method_latency.get(method, self.latency)
+        if delay:
+            time.sleep(delay * (1 + self.jitter * (random.random() * 2 - 1)))
+
+    def _call(self, path, method, params):
+        self._delay(method)
+        parts = [part for part in (path or '').split('/') if part]
+        if parts[:1] == ['host']:
+            func = getattr(self, 'host_' + method, None)
+        elif parts[:1] == ['device'] and len(parts) > 1 and method.startswith('device.'):
+            device = self.devices.get(parts[1])
+            if device is None:
+                raise ValueError('device %s not found' % parts[1])
+            func = getattr(device, method[len('device.'):], None)
+        else:
+            func = None
+        if method == 'device.get_element_tree_delta' and not self.tree_delta:
+            func = None
+        if method == 'wait_for_devices' and not self.device_push:
+            func = None
+        if method in ('device.get_sandbox_file_info', 'device.read_sandbox_file') and not self.sandbox_chunks:
+            func = None
+        if func is None or method.rsplit('.', 1)[-1].startswith('_'):
+            raise ValueError('method "%s" is not supported on %s' % (method, path))
+        return func(*params)
+
+    # host methods
+
+    def host_echo(self):
+        return True
+
+    def host_list_devices(self):
+        return [device.info() for _, device in sorted(self.devices.items())]
+
+    def host_wait_for_devices(self, version, timeout):
+        deadline = time.time() + timeout
+        with self._devices_changed:
+            while version == self.devices_version and time.time() < deadline:
+                self._devices_changed.wait(deadline - time.time())
+            return {'version': self.devices_version, 'devices': self.host_list_devices()}
+
+    def host_start_simulator(self, udid):
+        return True
+
+
+def _hotplug(host, interval):
+    plugged = None
+    while True:
+        time.sleep(interval)
+        if plugged is None:
+            plugged = host.add_device().udid
+        else:
+            host.remove_device(plugged)
+            plugged = None
+
+
+def main():
+    parser = optparse.OptionParser(usage='python -m benchmark.fakehost [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=12306)
+    parser.add_option('--devices', type='int', default=1)
+    parser.add_option('--tree-depth', type='int', default=5)
+    parser.add_option('--tree-breadth', type='int', default=4)
+    parser.add_option('--screen', default='750x1334', help=u'截图大小，如750x1334')
+    parser.add_option('--latency', type='float', default=0, help=u'每次调用的延迟（秒）')
+    parser.add_option('--jitter', type='float', default=0)
+    parser.add_option('--no-binary-screenshot', action='store_false', dest='binary_screenshot', default=True,
+                      help=u'只支持base64截图，模拟旧版本的主机')
+    parser.add_option('--no-device-push', action='store_false', dest='device_push', default=True,
+                      help=u'不支持长轮询设备变化，模拟旧版本的主机')
+    parser.add_option('--hotplug', type='float', default=0, help=u'每隔指定秒数交替插入和拔出一台设备')
+    options, _ = parser.parse_args()
+    width, height = [int(value) for value in options.screen.split('x')]
+    host = FakeHost((options.host, options.port), devices=options.devices, latency=options.latency,
+                    jitter=options.jitter, binary_screenshot=options.binary_screenshot,
+                    device_push=options.device_push, tree_depth=options.tree_depth,
+                    tree_breadth=options.tree_breadth, screen_size=(width, height))
+    print 'fake host listening on %s' % host.url
+    if options.hotplug:
+        thread = threading.Thread(target=_hotplug, args=(host, options.hotplug))
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        host.serve_forever()
+    except KeyboardInterrupt:
+        host.server_close()
+
+
+if __name__ == '__main__':
+    main()
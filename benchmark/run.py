@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''端到端性能测试，基于模拟设备主机测量连接、刷新、控件查找和沙盒浏览的耗时与吞吐
+
+在仓库根目录运行:
+    python -m benchmark.run                      # 运行全部用例
+    python -m benchmark.run -k refresh -n 50     # 只运行名称包含refresh的用例
+    python -m benchmark.run --save base.json     # 保存结果
+    python -m benchmark.run --baseline base.json # 与保存的结果比较，退化超过阈值时返回1
+    python -m benchmark.run --cassette a.cassette # 加上回放录制文件的用例(UISpy菜单"高级-录制RPC")
+'''
+
+import json
+import optparse
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark.fakehost import FakeHost
+from rpc.client import loads_response
+from rpc.connpool import clear_pools
+from rpc.devicepool import DevicePool
+from rpc.driver import DeviceDriver
+from rpc.driver import HostDriver
+from rpc.gesture import GestureQueue
+from rpc.installer import BatchInstaller
+from rpc.metrics import Histogram
+from rpc.replay import Cassette
+from rpc.replay import ReplayTransport
+from rpc.sandbox import SandboxCrawler
+from rpc.sandbox import SandboxIndex
+from rpc.sandbox import SandboxMirror
+from util import uitree
+
+
+class Result(object):
+    '''单个用例的结果
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = Histogram()
+        self.elapsed = 0.0
+        self.operations = 0
+
+    @property
+    def throughput(self):
+        return self.operations / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {'name': self.name,
+                'operations': self.operations,
+                'throughput': self.throughput,
+                'mean': self.latency.mean,
+                'p50': self.latency.percentile(50),
+                'p95': self.latency.percentile(95),
+                'p99': self.latency.percentile(99)}
+
+
+def measure(name, func, iterations, threads=1):
+    '''调用func共iterations次，记录每次耗时以及总吞吐
+
+    :param threads: 并发线程数，每个线程调用iterations/threads次
+    :type threads: int
+    '''
+    result = Result(name)
+    lock = threading.Lock()
+    per_thread = max(1, iterations // threads)
+
+    def worker():
+        for _ in range(per_thread):
+            start = time.time()
+            func()
+            cost = time.time() - start
+            with lock:
+                result.latency.add(cost)
+                result.operations += 1
+
+    func()  # warm up connections and caches
+    start = time.time()
+    if threads == 1:
+        worker()
+    else:
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    result.elapsed = time.time() - start
+    return result
+
+
+class Suite(object):
+    '''性能测试用例集合，每个以bench_开头的方法为一个用例
+    '''
+
+    def __init__(self, iterations=20, latency=0, cassette=None):
+        self.iterations = iterations
+        self.latency = latency
+        self.cassette = cassette
+
+    def _host(self, **options):
+        return FakeHost(latency=self.latency, **options).start()
+
+    def _device(self, host, cache_max_age=0):
+        # every call goes to the host, only concurrent identical requests are merged;
+        # the 1s screenshot and tree cache would otherwise time dictionary lookups
+        udid = sorted(host.devices)[0]
+        return DeviceDriver(host.url, udid, cache_max_age=cache_max_age)
+
+    def bench_connect(self):
+        host = self._host()
+        try:
+            def connect():
+                clear_pools()
+                driver = HostDriver('127.0.0.1', host.port)
+                driver.connect_to_host('xctest')
+                driver.list_devices()
+            yield measure('connect', connect, self.iterations)
+        finally:
+            host.stop()
+
+    def bench_refresh(self):
+        for label, depth, screen in (('small', 4, (375, 667)),
+                                     ('large', 6, (750, 1334))):
+            host = self._host(tree_depth=depth, screen_size=screen)
+            try:
+                driver = self._device(host)
+                yield measure('refresh.%s' % label, driver.snapshot, self.iterations)
+                yield measure('refresh.%s.x4' % label, driver.snapshot, self.iterations, threads=4)
+                yield measure('screenshot.%s' % label, driver.take_screenshot, self.iterations)
+                yield measure('element_tree.%s' % label, driver.get_element_tree, self.iterations)
+            finally:
+                host.stop()
+        host = self._host(tree_depth=6, screen_size=(750, 1334))
+        try:
+            # refreshing again within the cache time of the driver
+            driver = self._device(host, cache_max_age=None)
+            driver.snapshot()
+            yield measure('refresh.large.cached', driver.snapshot, self.iterations)
+        finally:
+            host.stop()
+
+    def bench_tree_update(self):
+        # a click changing one label, then a tree refresh
+        for label, tree_delta in (('delta', True), ('full', False)):
+            host = self._host(tree_depth=6, tree_delta=tree_delta)
+            try:
+                driver = self._device(host)
+
+                def click_and_refresh():
+                    driver.click(0.5, 0.5)
+                    driver.get_element_tree()
+                yield measure('tree_update.large.%s' % label, click_and_refresh, self.iterations)
+            finally:
+                host.stop()
+
+    def bench_gestures(self):
+        # taps on a screen animating for 0.3s: the fixed 1.5s sleep before refreshing, waiting
+        # for the screen to settle, and five quick taps through the gesture queue
+        host = self._host(tree_depth=6, animation=0.3)
+        try:
+            driver = self._device(host)
+
+            def fixed_sleep():
+                driver.click(0.5, 0.5)
+                time.sleep(1.5)
+                driver.snapshot()
+
+            def wait_for_idle():
+                driver.click(0.5, 0.5)
+                driver.wait_for_idle()
+                driver.snapshot()
+
+            def queued():
+                settled = threading.Event()
+                queue = GestureQueue(driver, lambda count, idle: (driver.snapshot(), settled.set()))
+                for index in range(5):
+                    queue.click(0.1 * index, 0.5)
+                settled.wait()
+            iterations = max(1, self.iterations // 10)
+            yield measure('gesture.fixed_sleep', fixed_sleep, iterations)
+            yield measure('gesture.wait_for_idle', wait_for_idle, iterations)
+            yield measure('gestures.x5.queued', queued, iterations)
+        finally:
+            host.stop()
+
+    def bench_screenshot_base64(self):
+        # hosts without the binary screenshot endpoint
+        host = self._host(screen_size=(750, 1334), binary_screenshot=False)
+        try:
+            driver = self._device(host)
+            yield measure('screenshot.large.base64', driver.take_screenshot, self.iterations)
+            yield measure('refresh.large.base64', driver.snapshot, self.iterations)
+        finally:
+            host.stop()
+
+    def bench_fan_out(self):
+        # app lists of every device on a busy host, one by one vs through a DevicePool
+        host = self._host(devices=12)
+        try:
+            pool = DevicePool()
+            devices = pool.add_host(HostDriver('127.0.0.1', host.port))
+
+            def serial():
+                for device in devices:
+                    pool.get(device['udid']).get_app_list()
+
+            def parallel():
+                futures = pool.get_app_lists()
+                for future in futures.values():
+                    future.result()
+            yield measure('app_list.x12.serial', serial, max(1, self.iterations // 4))
+            yield measure('app_list.x12.pool', parallel, max(1, self.iterations // 4))
+        finally:
+            host.stop()
+
+    def bench_batch_install(self):
+        # one package on eight devices of a host, one by one vs two at a time
+        host = self._host(devices=8, method_latency={'device.install': 0.2})
+        try:
+            pool = DevicePool()
+            udids = [device['udid'] for device in pool.add_host(HostDriver('127.0.0.1', host.port))]
+
+            def serial():
+                for udid in udids:
+                    pool.get(udid).install_app('/tmp/fake.ipa')
+            iterations = max(1, self.iterations // 10)
+            yield measure('install.x8.serial', serial, iterations)
+            yield measure('install.x8.batch',
+                          lambda: BatchInstaller(pool, '/tmp/fake.ipa', udids).start().result(), iterations)
+        finally:
+            host.stop()
+
+    def bench_hit_test(self):
+        host = self._host(tree_depth=6)
+        try:
+            tree = self._device(host).get_element_tree()
+        finally:
+            host.stop()
+        yield self._measure_hit_test('hit_test.x100', tree)
+
+    def _measure_hit_test(self, name, tree):
+        width = tree['rect']['size']['width']
+        height = tree['rect']['size']['height']
+        rand = random.Random(0)
+        points = [(rand.random() * width, rand.random() * height) for _ in range(100)]
+
+        def hit_test():
+            for pos in points:
+                uitree.get_focused_element(pos, tree)
+        return measure(name, hit_test, self.iterations)
+
+    def bench_replay(self):
+        # recorded sessions, replayed as fast as possible
+        if not self.cassette:
+            return
+        cassette = Cassette(self.cassette)
+        transport = ReplayTransport(cassette)
+        records = [record for record in cassette.records
+                   if record.method == 'POST' and record.status == 200 and not record.error]
+
+        def replay():
+            cassette.rewind()
+            for record in records:
+                transport.request(record.meta['host'], record.handler, record.request)
+        yield measure('replay.session', replay, max(1, self.iterations // 4))
+        trees = []
+        for record in records:
+            _find_trees(loads_response(record.response), trees)
+        if trees:
+            tree = max(trees, key=lambda tree: len(uitree.dfs_traverse(tree)))
+            yield self._measure_hit_test('replay.hit_test.x100', tree)
+
+    def bench_sandbox_browse(self):
+        host = self._host(sandbox_depth=3)
+        try:
+            driver = self._device(host)
+            bundle_id = driver.get_app_list()[0].keys()[0]
+
+            def browse():
+                pending = ['/']
+                while pending:
+                    path = pending.pop()
+                    for item in driver.get_sandbox_path_files(bundle_id, path):
+                        if item['is_dir']:
+                            pending.append(item['path'])
+                        elif item['path'].endswith('_0.txt'):
+                            driver.get_sandbox_file_content(bundle_id, item['path'])
+            yield measure('sandbox_browse', browse, max(1, self.iterations // 4))
+        finally:
+            host.stop()
+
+    def bench_sandbox_crawl(self):
+        # indexing the whole sandbox with one and four workers, then an incremental refresh;
+        # the directory stats of a refresh share one multicall, so they get no latency of their own
+        host = self._host(sandbox_depth=3, method_latency={'device.get_sandbox_file_info': 0})
+        try:
+            driver = self._device(host)
+
+            def crawl(workers):
+                index = SandboxIndex(driver.udid, 'com.tencent.fake0')
+                SandboxCrawler(driver, index, max_workers=workers).crawl().wait()
+                return index
+            index = crawl(4)
+            iterations = max(1, self.iterations // 4)
+            yield measure('sandbox_crawl.x1', lambda: crawl(1), iterations)
+            yield measure('sandbox_crawl.x4', lambda: crawl(4), iterations)
+            yield measure('sandbox_crawl.refresh',
+                          lambda: SandboxCrawler(driver, index).refresh().wait(), iterations)
+        finally:
+            host.stop()
+
+    def bench_sandbox_file(self):
+        # viewing an 8MB sandbox file: one base64 response, chunked download, unchanged file
+        host = self._host(sandbox_depth=1, sandbox_file_size=8 * 1024 * 1024)
+        root = tempfile.mkdtemp()
+        try:
+            driver = self._device(host)
+            path = '/Documents/file_0.txt'
+
+            def download():
+                mirror = SandboxMirror(tempfile.mkdtemp(dir=root))
+                driver.download_sandbox_file('com.tencent.fake0', path, mirror)
+            mirror = SandboxMirror(root)
+            iterations = max(1, self.iterations // 4)
+            yield measure('sandbox_file.8m.base64',
+                          lambda: driver.get_sandbox_file_content('com.tencent.fake0', path), iterations)
+            yield measure('sandbox_file.8m.chunked', download, iterations)
+            yield measure('sandbox_file.8m.mirror',
+                          lambda: driver.download_sandbox_file('com.tencent.fake0', path, mirror), iterations)
+        finally:
+            host.stop()
+            shutil.rmtree(root, True)
+
+    def run(self, keyword=None):
+        results = []
+        for name in sorted(dir(self)):
+            if not name.startswith('bench_') or (keyword and keyword not in name):
+                continue
+            for result in getattr(self, name)():
+                print_result(result)
+                results.append(result)
+        return results
+
+
+def _find_trees(value, trees):
+    # collect the element trees found in a recorded response
+    if isinstance(value, dict):
+        if 'rect' in value and 'children' in value:
+            trees.append(value)
+            return
+        value = value.values()
+    if isinstance(value, list):
+        for item in value:
+            _find_trees(item, trees)
+
+
+def print_result(result):
+    item = result.to_dict()
+    print '%-24s %6d ops %9.1f ops/s  mean %8.2fms  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms' % (
+        item['name'], item['operations'], item['throughput'], item['mean'] * 1000,
+        item['p50'] * 1000, item['p95'] * 1000, item['p99'] * 1000)
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    '''与基线比较p50耗时，返回退化的用例列表
+    '''
+    regressions = []
+    previous = dict((item['name'], item) for item in baseline)
+    for result in results:
+        base = previous.get(result.name)
+        if not base or not base['p50']:
+            continue
+        ratio = result.latency.percentile(50) / base['p50']
+        if ratio > 1 + tolerance:
+            regressions.append((result.name, base['p50'], result.latency.percentile(50), ratio))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='python -m benchmark.run [options]')
+    parser.add_option('-n', '--iterations', type='int', default=20, help=u'每个用例的调用次数')
+    parser.add_option('-k', '--keyword', help=u'只运行名称包含该关键字的用例')
+    parser.add_option('--latency', type='float', default=0, help=u'模拟主机每次调用的延迟（秒）')
+    parser.add_option('--save', help=u'保存结果到json文件')
+    parser.add_option('--baseline', help=u'与json文件中的结果比较')
+    parser.add_option('--tolerance', type='float', default=0.25, help=u'允许的p50退化比例')
+    parser.add_option('--cassette', help=u'回放RPC录制文件，测量真实控件树的解码和查找耗时')
+    options, _ = parser.parse_args()
+
+    results = Suite(options.iterations, options.latency, options.cassette).run(options.keyword)
+    if options.save:
+        with open(options.save, 'w') as fd:
+            json.dump([result.to_dict() for result in results], fd, indent=2)
+    if options.baseline:
+        with open(options.baseline) as fd:
+            regressions = compare(results, json.load(fd), options.tolerance)
+        for name, before, after, ratio in regressions:
+            print 'REGRESSION %s: p50 %.2fms -> %.2fms (x%.2f)' % (name, before * 1000, after * 1000, ratio)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,619 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''非阻塞的JSON-RPC客户端
+
+所有连接由一个后台Reactor线程通过select多路复用，同一主机的请求在HTTP/1.1 keep-alive
+连接上流水线发送，每个调用立即返回Future，不再为每个进行中的调用占用一个线程。
+只有幂等的调用(rpc.resilience.IDEMPOTENT_METHODS)才会流水线发送或者在连接断开后重发，
+点击、安装等调用只在空闲连接上发送，连接断开时直接失败，避免在设备上执行两次。
+'''
+
+import collections
+import errno
+import json
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+import zlib
+
+from rpc.client import build_request
+from rpc.client import decompress
+from rpc.client import DEFAULT_TIMEOUT
+from rpc.client import loads_response
+from rpc.client import METHOD_TIMEOUTS
+from rpc.client import remaining_time
+from rpc.client import RPCTimeoutError
+from rpc.client import unmarshal_response
+from rpc.future import Future
+from rpc.resilience import IDEMPOTENT_METHODS
+from util.logger import Log
+
+
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_PIPELINE_DEPTH = 8
+IDLE_TIMEOUT = 30
+RECV_SIZE = 64 * 1024
+
+
+def _make_wakeup_pair():
+    '''创建用于唤醒select的socket对
+    '''
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.create_connection(listener.getsockname())
+    reader, _ = listener.accept()
+    listener.close()
+    return reader, writer
+
+
+class _Call(object):
+    '''一次待发送或者进行中的HTTP请求
+    '''
+
+    def __init__(self, key, handler, body, future, decoder, timeout, idempotent):
+        self.key = key
+        self.handler = handler
+        self.body = body
+        self.future = future
+        self.decoder = decoder
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.deadline = None if timeout is None else time.time() + timeout
+
+
+class _ResponseParser(object):
+    '''增量解析HTTP/1.x响应，支持Content-Length、chunked以及读到连接关闭三种消息体
+    '''
+
+    def __init__(self):
+        self._buffer = ''
+        self._reset()
+
+    def _reset(self):
+        self.started = bool(self._buffer)  # 当前响应是否已收到数据
+        self._state = 'status'
+        self._status = None
+        self._headers = {}
+        self._version = None
+        self._remaining = 0
+        self._body = []
+
+    def feed(self, data):
+        '''输入收到的数据
+
+        :returns: list -- 已完整接收的响应[(status, headers, body, keep_alive)]
+        '''
+        if data or self._buffer:
+            self.started = True
+        self._buffer += data
+        responses = []
+        while True:
+            response = self._step()
+            if response is None:
+                break
+            responses.append(response)
+        return responses
+
+    def eof(self):
+        '''连接关闭，返回以连接关闭为结束的响应
+        '''
+        if self._state == 'until_close':
+            self._body.append(self._buffer)
+            self._buffer = ''
+            return self._finish(False)
+
+    def _readline(self):
+        pos = self._buffer.find('\r\n')
+        if pos < 0:
+            return None
+        line = self._buffer[:pos]
+        self._buffer = self._buffer[pos + 2:]
+        return line
+
+    def _step(self):
+        # 逐个状态推进，直到得到一个完整的响应或者数据不足；用循环而非递归，chunk很多的
+        # 响应体不会超过递归深度
+        while True:
+            if self._state == 'status':
+                line = self._readline()
+                if line is None:
+                    return None
+                if not line:
+                    continue
+                version, status = line.split(' ', 2)[:2]
+                self._version = version
+                self._status = int(status)
+                self._state = 'headers'
+            elif self._state == 'headers':
+                line = self._readline()
+                if line is None:
+                    return None
+                if line:
+                    name, value = line.split(':', 1)
+                    self._headers[name.strip().lower()] = value.strip()
+                    continue
+                if 'chunked' in self._headers.get('transfer-encoding', '').lower():
+                    self._state = 'chunk_size'
+                elif 'content-length' in self._headers:
+                    self._remaining = int(self._headers['content-length'])
+                    self._state = 'body'
+                elif self._status in (204, 304) or 100 <= self._status < 200:
+                    return self._finish(self._keep_alive())
+                else:
+                    self._state = 'until_close'
+            elif self._state == 'body':
+                if len(self._buffer) < self._remaining:
+                    self._remaining -= len(self._buffer)
+                    self._body.append(self._buffer)
+                    self._buffer = ''
+                    return None
+                self._body.append(self._buffer[:self._remaining])
+                self._buffer = self._buffer[self._remaining:]
+                return self._finish(self._keep_alive())
+            elif self._state == 'chunk_size':
+                line = self._readline()
+                if line is None:
+                    return None
+                self._remaining = int(line.split(';', 1)[0], 16)
+                self._state = 'chunk' if self._remaining else 'trailer'
+            elif self._state == 'chunk':
+                if len(self._buffer) < self._remaining + 2:
+                    return None
+                self._body.append(self._buffer[:self._remaining])
+                self._buffer = self._buffer[self._remaining + 2:]
+                self._state = 'chunk_size'
+            elif self._state == 'trailer':
+                line = self._readline()
+                if line is None:
+                    return None
+                if not line:
+                    return self._finish(self._keep_alive())
+            else:
+                self._body.append(self._buffer)
+                self._buffer = ''
+                return None
+
+    def _keep_alive(self):
+        connection = self._headers.get('connection', '').lower()
+        if self._version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def _finish(self, keep_alive):
+        body = ''.join(self._body)
+        encoding = self._headers.get('content-encoding', '').lower()
+        if encoding in ('gzip', 'deflate'):
+            body = decompress(body, encoding)
+        response = (self._status, self._headers, body, keep_alive)
+        self._reset()
+        return response
+
+
+class _Connection(object):
+    '''Reactor管理的一条非阻塞HTTP连接
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self.sock = None
+        self.connected = False
+        self.keep_alive = False  # 收到过keep-alive响应后才允许流水线发送
+        self.completed = 0
+        self.inflight = collections.deque()
+        self.outbuf = ''
+        self.parser = _ResponseParser()
+        self.last_active = time.time()
+
+    def connect(self, address):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.sock.connect_ex(address)
+        if err in (0, errno.EISCONN):
+            self.connected = True
+        elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+            raise socket.error(err, errno.errorcode.get(err, 'connect failed'))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def can_accept(self, depth, idempotent=True):
+        if not self.inflight:
+            return True
+        # 非幂等的调用不排在其他请求之后，连接断开时能够确定它是否已被发送
+        return idempotent and self.keep_alive and len(self.inflight) < depth
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class Reactor(object):
+    '''后台IO线程，多路复用所有异步RPC连接
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._connections = {}  # key -> [_Connection]
+        self._limits = {}  # key -> (max_connections, pipeline_depth)
+        self._addresses = {}
+        self._wakeup_reader, self._wakeup_writer = _make_wakeup_pair()
+        self._wakeup_reader.setblocking(0)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='rpc-reactor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def configure(self, key, max_connections, pipeline_depth):
+        '''设置主机的最大连接数和每条连接的流水线深度
+        '''
+        with self._lock:
+            self._limits[key] = (max_connections, pipeline_depth)
+
+    def submit(self, key, handler, body, decoder, timeout=None, idempotent=True):
+        '''提交请求
+
+        :param key: (host, port)
+        :param handler: 请求路径
+        :param body: 请求体
+        :param decoder: 将HTTP响应体转换为调用结果的函数
+        :param timeout: 超时时间（秒）
+        :param idempotent: 请求是否可以重复执行，否则不流水线发送，连接断开时也不重发
+        :returns: Future
+        '''
+        future = Future()
+        call = _Call(key, handler, body, future, decoder, timeout, idempotent)
+        future.set_cancel_handler(lambda _: self._wakeup())
+        with self._lock:
+            self._pending.append(call)
+        self._wakeup()
+        return future
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send('x')
+        except socket.error:
+            pass
+
+    def _run(self):
+        while self._running:
+            try:
+                self._dispatch_pending()
+                self._poll(self._next_timeout())
+                self._check_timeouts()
+            except:
+                Log.e('Reactor', traceback.format_exc())
+        error = socket.error(errno.ECONNABORTED, 'reactor stopped')
+        for connections in self._connections.values():
+            for conn in list(connections):
+                self._fail_connection(conn, error)
+        with self._lock:
+            pending, self._pending = self._pending, collections.deque()
+        for call in pending:
+            call.future.set_exception(error)
+
+    def _next_timeout(self):
+        timeout = 1.0
+        now = time.time()
+        for connections in self._connections.values():
+            for conn in connections:
+                for call in conn.inflight:
+                    if call.deadline is not None:
+                        timeout = min(timeout, call.deadline - now)
+        with self._lock:
+            for call in self._pending:
+                if call.deadline is not None:
+                    timeout = min(timeout, call.deadline - now)
+        return max(0, timeout)
+
+    def _dispatch_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, collections.deque()
+        waiting = collections.deque()
+        failed = {}
+        for call in pending:
+            if call.future.done():
+                continue
+            if call.key in failed:
+                call.future.set_exception(failed[call.key])
+                continue
+            try:
+                conn = self._pick_connection(call.key, call.idempotent)
+            except (socket.error, socket.gaierror), e:
+                failed[call.key] = e
+                call.future.set_exception(e)
+                continue
+            if conn is None:
+                waiting.append(call)
+                continue
+            conn.inflight.append(call)
+            conn.outbuf += ('POST %s HTTP/1.1\r\n'
+                            'Host: %s:%s\r\n'
+                            'Accept-Encoding: gzip, deflate\r\n'
+                            'User-Agent: jsonrpclib/0.1\r\n'
+                            'Content-Type: application/json-rpc\r\n'
+                            'Content-Length: %d\r\n\r\n%s') % (call.handler, call.key[0], call.key[1],
+                                                               len(call.body), call.body)
+        if waiting:
+            with self._lock:
+                waiting.extend(self._pending)
+                self._pending = waiting
+
+    def _pick_connection(self, key, idempotent=True):
+        max_connections, depth = self._limits.get(key, (DEFAULT_MAX_CONNECTIONS, DEFAULT_PIPELINE_DEPTH))
+        connections = self._connections.setdefault(key, [])
+        candidates = [conn for conn in connections if conn.can_accept(depth, idempotent)]
+        idle = [conn for conn in candidates if not conn.inflight]
+        if idle:
+            return idle[0]
+        if len(connections) < max_connections:
+            conn = _Connection(key)
+            try:
+                conn.connect(self._resolve(key))
+            except:
+                conn.close()
+                raise
+            connections.append(conn)
+            return conn
+        if candidates:
+            return min(candidates, key=lambda conn: len(conn.inflight))
+        return None
+
+    def _resolve(self, key):
+        address = self._addresses.get(key)
+        if address is None:
+            address = socket.getaddrinfo(key[0], key[1], socket.AF_INET, socket.SOCK_STREAM)[0][4]
+            self._addresses[key] = address
+        return address
+
+    def _poll(self, timeout):
+        readers = [self._wakeup_reader]
+        writers = []
+        for connections in self._connections.values():
+            for conn in connections:
+                readers.append(conn)
+                if not conn.connected or conn.outbuf:
+                    writers.append(conn)
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        for conn in writable:
+            self._handle_write(conn)
+        for conn in readable:
+            if conn is self._wakeup_reader:
+                try:
+                    while self._wakeup_reader.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+            elif conn.sock is not None:
+                self._handle_read(conn)
+        self._evict_idle()
+
+    def _handle_write(self, conn):
+        if conn.sock is None:
+            return
+        if not conn.connected:
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._fail_connection(conn, socket.error(err, errno.errorcode.get(err, 'connect failed')))
+                return
+            conn.connected = True
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._connection_lost(conn, e)
+            return
+        conn.outbuf = conn.outbuf[sent:]
+        conn.last_active = time.time()
+
+    def _handle_read(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._connection_lost(conn, e)
+            return
+        conn.last_active = time.time()
+        if not data:
+            response = conn.parser.eof()
+            if response:
+                self._complete(conn, response)
+            self._connection_lost(conn, socket.error(errno.ECONNRESET, 'connection closed by server'))
+            return
+        try:
+            responses = conn.parser.feed(data)
+        except (ValueError, zlib.error), e:
+            self._fail_connection(conn, e)
+            return
+        for response in responses:
+            self._complete(conn, response)
+            if conn.sock is None:
+                break
+
+    def _complete(self, conn, response):
+        status, headers, body, keep_alive = response
+        call = conn.inflight.popleft()
+        conn.completed += 1
+        conn.keep_alive = keep_alive
+        if not call.future.cancelled():
+            if status != 200:
+                call.future.set_exception(IOError('HTTP error %s for %s' % (status, call.handler)))
+            else:
+                try:
+                    call.future.set_result(call.decoder(body))
+                except:
+                    exc_info = sys.exc_info()
+                    call.future.set_exception(exc_info[1], exc_info[2])
+        if not keep_alive:
+            self._connection_lost(conn, socket.error(errno.ECONNRESET, 'connection closed by server'))
+
+    def _connection_lost(self, conn, error):
+        '''连接被关闭：复用的连接上尚未收到任何响应数据的幂等请求可以安全重发，其余请求失败
+
+        主机可能已经执行了请求才关闭连接，非幂等的请求重发会在设备上执行两次
+        '''
+        retry = conn.completed > 0 and not conn.parser.started
+        calls = list(conn.inflight)
+        conn.inflight.clear()
+        self._remove(conn)
+        if retry:
+            with self._lock:
+                for call in reversed(calls):
+                    if call.idempotent:
+                        self._pending.appendleft(call)
+        for call in calls:
+            if not (retry and call.idempotent):
+                call.future.set_exception(error)
+
+    def _fail_connection(self, conn, error):
+        calls = list(conn.inflight)
+        conn.inflight.clear()
+        self._remove(conn)
+        for call in calls:
+            call.future.set_exception(error)
+
+    def _remove(self, conn):
+        conn.close()
+        connections = self._connections.get(conn.key, [])
+        if conn in connections:
+            connections.remove(conn)
+
+    def _check_timeouts(self):
+        now = time.time()
+        with self._lock:
+            pending = list(self._pending)
+        for call in pending:
+            if call.deadline is not None and call.deadline <= now:
+                call.future.set_exception(self._timeout_error(call))
+        for connections in self._connections.values():
+            for conn in list(connections):
+                expired = [call for call in conn.inflight if call.deadline is not None and call.deadline <= now]
+                if expired:
+                    # 流水线上的响应顺序已无法对齐，关闭连接并使其上的所有请求失败
+                    for call in expired:
+                        call.future.set_exception(self._timeout_error(call))
+                    self._fail_connection(conn, socket.error(errno.ECONNABORTED, 'pipeline aborted after timeout'))
+
+    def _timeout_error(self, call):
+        return RPCTimeoutError('%s:%s%s timed out after %ss' % (call.key[0], call.key[1], call.handler, call.timeout),
+                               'read', call.timeout)
+
+    def _evict_idle(self):
+        now = time.time()
+        for connections in self._connections.values():
+            for conn in list(connections):
+                if not conn.inflight and now - conn.last_active > IDLE_TIMEOUT:
+                    self._remove(conn)
+
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+
+def get_reactor():
+    '''获取进程共享的Reactor
+    '''
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+        return _reactor
+
+
+class _Method(object):
+    # bind a remote method name to the async request function
+
+    def __init__(self, send, name):
+        self.__send = send
+        self.__name = name
+
+    def __getattr__(self, name):
+        return _Method(self.__send, "%s.%s" % (self.__name, name))
+
+    def __call__(self, *args):
+        return self.__send(self.__name, args)
+
+
+class AsyncRPCClientProxy(object):
+    '''异步RPC Client，用法与RPCClientProxy一致，每次调用返回Future
+
+    仅支持http协议，Future的回调在Reactor线程中执行
+    '''
+
+    def __init__(self, uri, reactor=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 pipeline_depth=DEFAULT_PIPELINE_DEPTH, timeout=DEFAULT_TIMEOUT, raw=False,
+                 method_timeouts=None):
+        if isinstance(uri, unicode):
+            uri = uri.encode('ISO-8859-1')
+        protocol, uri = urllib.splittype(uri)
+        if protocol != "http":
+            raise IOError, "unsupported async JSON-RPC protocol"
+        host, self.__handler = urllib.splithost(uri)
+        if not self.__handler:
+            self.__handler = "/RPC2"
+        hostname, port = urllib.splitport(host)
+        self.__key = (hostname, int(port or 80))
+        self.__timeout = timeout
+        self.__method_timeouts = dict(METHOD_TIMEOUTS)
+        self.__method_timeouts.update(method_timeouts or {})
+        self.__raw = raw
+        self.__reactor = reactor or get_reactor()
+        self.__reactor.configure(self.__key, max_connections, pipeline_depth)
+
+    def __request(self, methodname, params):
+        request = json.dumps(build_request(methodname, params))
+        timeout = self.__method_timeouts.get(methodname, self.__timeout)
+        remaining = remaining_time()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return self.__reactor.submit(self.__key, self.__handler, request,
+                                     self.__decode, timeout, methodname in IDEMPOTENT_METHODS)
+
+    def __decode(self, body):
+        response = loads_response(body, self.__raw)
+        if not isinstance(response, dict):
+            raise TypeError('Response is not dict')
+        return unmarshal_response(response)
+
+    def __repr__(self):
+        return "<AsyncServerProxy for %s:%s%s>" % (self.__key[0], self.__key[1], self.__handler)
+
+    __str__ = __repr__
+
+    def __getattr__(self, name):
+        return _Method(self.__request, name)
+
+    def __call__(self, attr):
+        if attr == "reactor":
+            return self.__reactor
+        raise AttributeError("Attribute %r not found" % (attr,))
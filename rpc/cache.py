@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''设备状态的缓存
+'''
+
+import contextlib
+import copy
+import json
+import os
+import sys
+import threading
+import time
+
+from rpc.client import loads_response
+from util.logger import Log
+
+
+class _Flight(object):
+    # a call in progress, shared by every caller asking for the same key
+
+    def __init__(self, generation):
+        self.generation = generation
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def finish(self, value=None, exc_info=None):
+        self._value = value
+        self._exc_info = exc_info
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class SingleFlightCache(object):
+    '''按key缓存调用结果(线程安全)，同一时刻相同key的调用只执行一次，结果交给所有等待者
+
+    invalidate()之后，之前开始的调用结果不再缓存，之后的调用也不会合并到之前的调用上。
+    缓存的结果在调用者之间共享，调用者不应修改
+    '''
+
+    def __init__(self, max_age=None):
+        '''
+        :param max_age: 缓存的最长有效时间（秒），None表示直到invalidate，0表示只合并并发调用
+        :type max_age: float
+        '''
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # {key: (value, fetched_at)}
+        self._flights = {}  # {key: _Flight}
+        self._generation = 0
+
+    def get(self, key, func, max_age=None, related=None):
+        '''返回key的缓存结果，没有或者已过期时调用func()获取
+
+        :param max_age: 本次调用接受的缓存时间，默认使用构造时的max_age
+        :type max_age: float
+        :param related: related(value)返回同时获得的其他结果{key: value}，一并缓存
+        :type related: callable
+        '''
+        if max_age is None:
+            max_age = self.max_age
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (max_age is None or time.time() - entry[1] <= max_age):
+                self.hits += 1
+                return entry[0]
+            flight = self._flights.get(key)
+            if flight is not None and flight.generation == self._generation:
+                self.merged += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight(self._generation)
+                leader = True
+        if not leader:
+            return flight.wait()
+        try:
+            value = func()
+        except:
+            exc_info = sys.exc_info()
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(exc_info=exc_info)
+            raise
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.generation == self._generation:
+                now = time.time()
+                self._entries[key] = (value, now)
+                if related is not None:
+                    for related_key, related_value in related(value).items():
+                        self._entries[related_key] = (related_value, now)
+        flight.finish(value)
+        return value
+
+    def invalidate(self):
+        '''清空缓存，进行中的调用结果不再缓存
+        '''
+        with self._lock:
+            self._generation += 1
+            self._entries = {}
+
+    @contextlib.contextmanager
+    def invalidating(self):
+        '''在改变设备状态的操作前后各清空一次缓存
+        '''
+        self.invalidate()
+        try:
+            yield
+        finally:
+            self.invalidate()
+
+
+# 设备信息的默认有效时间（秒），按名称中":"之前的部分查找
+DEFAULT_METADATA_TTLS = {
+    'xcode_version': 24 * 3600,
+    'ios_version': 24 * 3600,
+    'versions': 24 * 3600,
+    'app_list': 600,
+}
+DEFAULT_METADATA_TTL = 600
+
+
+class MetadataCache(object):
+    '''按设备缓存很少变化的信息(系统版本、App列表等)(线程安全)
+
+    每项信息有各自的有效时间，可以保存到文件在下次启动时继续使用；get返回缓存值的副本
+    '''
+
+    def __init__(self, ttls=None):
+        '''
+        :param ttls: 按名称指定的有效时间（秒），覆盖DEFAULT_METADATA_TTLS
+        :type ttls: dict
+        '''
+        self.ttls = dict(DEFAULT_METADATA_TTLS)
+        self.ttls.update(ttls or {})
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # {udid: {name: (value, stored_at)}}
+
+    def ttl(self, name):
+        return self.ttls.get(name.split(':', 1)[0], DEFAULT_METADATA_TTL)
+
+    def get(self, udid, name, func, related=None):
+        '''返回设备的name信息，没有或者已过期时调用func()获取
+
+        :param udid: 设备udid
+        :type udid: str
+        :param name: 信息名称，如"ios_version"、"app_list:user"
+        :type name: str
+        :param related: related(value)返回同时获得的其他信息{name: value}，一并缓存
+        :type related: callable
+        '''
+        with self._lock:
+            entry = self._entries.get(udid, {}).get(name)
+            if entry is not None and time.time() - entry[1] <= self.ttl(name):
+                self.hits += 1
+                return copy.deepcopy(entry[0])
+            self.misses += 1
+        value = func()
+        with self._lock:
+            now = time.time()
+            entries = self._entries.setdefault(udid, {})
+            entries[name] = (copy.deepcopy(value), now)
+            if related is not None:
+                for related_name, related_value in related(value).items():
+                    entries[related_name] = (copy.deepcopy(related_value), now)
+        return value
+
+    def invalidate(self, udid=None, *names):
+        '''清除缓存的信息
+
+        :param udid: 设备udid，None表示所有设备
+        :type udid: str
+        :param names: 要清除的信息名称，"app_list"同时清除"app_list:user"等，不指定时清除该设备的全部信息
+        '''
+        with self._lock:
+            if udid is None:
+                self._entries = {}
+                return
+            if not names:
+                self._entries.pop(udid, None)
+                return
+            entries = self._entries.get(udid, {})
+            for key in entries.keys():
+                if key in names or key.split(':', 1)[0] in names:
+                    del entries[key]
+
+    def load(self, path):
+        '''从文件加载之前保存的信息，之后save()默认保存到该文件
+
+        文件不存在或者无法解析时忽略
+        '''
+        self.path = path
+        try:
+            with open(path, 'rb') as fd:
+                entries = loads_response(fd.read())
+        except (IOError, ValueError), e:
+            if os.path.exists(path):
+                Log.w('MetadataCache', 'ignore %s: %s' % (path, e))
+            return
+        with self._lock:
+            for udid, items in entries.items():
+                target = self._entries.setdefault(udid, {})
+                for name, (value, stored_at) in items.items():
+                    if name not in target or target[name][1] < stored_at:
+                        target[name] = (value, stored_at)
+
+    def save(self, path=None):
+        '''把未过期的信息保存到文件，先写临时文件再替换，写入中断不会损坏原文件
+        '''
+        path = path or self.path
+        if not path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = {}
+            for udid, items in self._entries.items():
+                alive = dict((name, entry) for name, entry in items.items()
+                             if now - entry[1] <= self.ttl(name))
+                if alive:
+                    entries[udid] = alive
+            data = json.dumps(entries)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as fd:
+                fd.write(data)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except (IOError, OSError), e:
+            Log.w('MetadataCache', 'failed to save %s: %s' % (path, e))
+
+
+_metadata_cache = MetadataCache()
+
+
+def get_metadata_cache():
+    '''所有DeviceDriver共用的设备信息缓存
+    '''
+    return _metadata_cache
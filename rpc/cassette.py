@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RPC流量的录制文件(cassette)
+
+文件以MAGIC开头，之后每条记录为:
+    struct('>III')  -- 元数据、请求、响应的长度
+    元数据          -- JSON，包括开始时间、耗时、主机、路径、HTTP方法、状态码和错误
+    请求            -- zlib压缩的请求体
+    响应            -- zlib压缩的响应体(已解压的原始内容)
+
+文件只追加写入，每条记录写完即flush，进程异常退出时最多丢失最后一条不完整的记录
+'''
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+from util.logger import Log
+
+
+MAGIC = 'QT4ICAS1\n'
+_HEADER = struct.Struct('>III')
+# 录制时优先保证速度，控件树等文本在level 1下已经有很高的压缩率
+COMPRESS_LEVEL = 1
+
+
+class Record(object):
+    '''一次RPC调用的记录
+    '''
+
+    def __init__(self, meta, request, response):
+        self.meta = meta
+        self.request = request
+        self.response = response
+
+    @property
+    def start(self):
+        return self.meta['ts']
+
+    @property
+    def duration(self):
+        return self.meta['d']
+
+    @property
+    def handler(self):
+        return self.meta['handler']
+
+    @property
+    def method(self):
+        return self.meta.get('method', 'POST')
+
+    @property
+    def status(self):
+        return self.meta.get('status', 200)
+
+    @property
+    def reason(self):
+        return self.meta.get('reason', '')
+
+    @property
+    def error(self):
+        return self.meta.get('error')
+
+    def __repr__(self):
+        return '<Record %s %s%s %s %.3fs>' % (self.method, self.meta.get('host', ''), self.handler,
+                                             self.status, self.duration)
+
+
+class CassetteWriter(object):
+    '''追加写入录制文件(线程安全)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._lock = threading.Lock()
+        self._fd = open(path, 'ab')
+        if self._fd.tell() == 0:
+            self._fd.write(MAGIC)
+            self._fd.flush()
+
+    def record(self, host, handler, request_body, start, duration, response_body='',
+               method='POST', status=200, reason='', error=None):
+        '''写入一次调用
+
+        :param start: 调用开始的时间戳
+        :type start: float
+        :param duration: 调用耗时（秒）
+        :type duration: float
+        :param error: 未收到响应时的错误类型，例如"timeout"
+        :type error: str
+        '''
+        meta = {'ts': start, 'd': duration, 'host': host, 'handler': handler, 'method': method}
+        if status != 200:
+            meta['status'] = status
+            meta['reason'] = reason
+        if error:
+            meta['error'] = error
+        meta = json.dumps(meta)
+        request = zlib.compress(request_body or '', COMPRESS_LEVEL)
+        response = zlib.compress(response_body or '', COMPRESS_LEVEL)
+        data = ''.join([_HEADER.pack(len(meta), len(request), len(response)), meta, request, response])
+        with self._lock:
+            if self._fd is None:
+                return
+            self._fd.write(data)
+            self._fd.flush()
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+
+    @property
+    def closed(self):
+        return self._fd is None
+
+
+def iter_records(path):
+    '''按写入顺序读取录制文件中的记录，忽略末尾不完整的记录
+
+    :returns: iterator -- Record
+    '''
+    with open(path, 'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a cassette file' % path)
+        while True:
+            header = fd.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            sizes = _HEADER.unpack(header)
+            data = fd.read(sum(sizes))
+            if len(data) < sum(sizes):
+                Log.w('Cassette', 'truncated record at the end of %s' % path)
+                return
+            meta = json.loads(data[:sizes[0]])
+            request = zlib.decompress(data[sizes[0]:sizes[0] + sizes[1]])
+            response = zlib.decompress(data[sizes[0] + sizes[1]:])
+            yield Record(meta, request, response)
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def start_recording(path):
+    '''开始把本进程的所有RPC调用录制到path，已在录制时先结束之前的录制
+
+    :returns: CassetteWriter
+    '''
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close()
+        _recorder = CassetteWriter(os.path.abspath(path))
+        Log.i('Cassette', 'start recording rpc calls to %s' % _recorder.path)
+        return _recorder
+
+
+def stop_recording():
+    '''结束录制，返回录制的记录数
+    '''
+    global _recorder
+    with _recorder_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is None:
+        return 0
+    recorder.close()
+    Log.i('Cassette', 'stop recording, %d rpc calls written to %s' % (recorder.records, recorder.path))
+    return recorder.records
+
+
+def get_recorder():
+    '''当前进程的录制文件，未在录制时返回None
+    '''
+    return _recorder
@@ -15,18 +15,70 @@
 '''RPC Framework
 '''
 
+import contextlib
+import errno
+import httplib
 import json
+from json.decoder import scanstring
 import random
+import re
+import socket
 import string
 import SimpleXMLRPCServer
+import threading
+import time
 import xmlrpclib
+import zlib
 try:
     import fcntl
 except ImportError:
     fcntl = None
 
+from rpc import connpool
+from rpc.cassette import CassetteWriter
+from rpc.cassette import get_recorder
+from rpc.metrics import get_registry
+
 IDCHARS = string.ascii_lowercase+string.digits
 
+DEFAULT_CONNECT_TIMEOUT = 3
+# JSON-RPC 2.0中方法不存在的错误码
+METHOD_NOT_FOUND = -32601
+# 服务端不支持请求路径或者请求方式的HTTP状态码
+UNSUPPORTED_STATUS = (404, 501)
+# 没有错误码的服务端(如SimpleXMLRPCDispatcher)在方法不存在时返回的错误信息
+_NOT_SUPPORTED_PATTERN = re.compile(r'method "[^"]*" is not supported')
+DEFAULT_TIMEOUT = 60
+# 各方法的默认超时（秒），未列出的方法使用RPCClientProxy的timeout
+METHOD_TIMEOUTS = {
+    'echo': 3,
+    'list_devices': 30,
+    'start_simulator': 120,
+    'device.capture_screen': 15,
+    'screenshot': 15,
+    'device.get_screen_orientation': 10,
+    'device.get_element_tree': 30,
+    'device.get_element_tree_delta': 30,
+    'device.click': 15,
+    'device.double_click': 15,
+    'device.long_click': 15,
+    'device.drag': 15,
+    'device.send_keys': 30,
+    'device.start_app': 120,
+    'device.stop_app': 30,
+    'device.install': 600,
+    'device.uninstall': 120,
+    'device.get_app_list': 30,
+    'device.get_sandbox_path_files': 30,
+    'device.is_sandbox_path_dir': 10,
+    'device.get_sandbox_file_content': 120,
+    'device.get_sandbox_file_info': 10,
+    'device.read_sandbox_file': 60,
+    'device.close_sandbox_client': 10,
+    'device.get_xcode_version': 10,
+    'device.get_ios_version': 10,
+}
+
 def random_id(length=8):
     return_id = ''
     for _ in range(length):
@@ -38,8 +90,21 @@ class RPCClientProxy(object):
     '''
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=0, use_datetime=0, context=None):
+                 allow_none=0, use_datetime=0, context=None, raw=False,
+                 streaming=True, timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, method_timeouts=None,
+                 metrics=None, record=None):
         # establish a "logical" server connection
+        # raw: keep strings in results as unicode instead of UTF-8 encoded str
+        # streaming: parse responses incrementally as chunks arrive, objects
+        #            already complete are decoded by the C scanner in one go;
+        #            False buffers the whole response and decodes it at the end
+        # timeout: seconds a call may take once connected, for methods not
+        #          listed in method_timeouts or METHOD_TIMEOUTS; None = no limit
+        # connect_timeout: seconds to wait for a new connection
+        # metrics: MetricsRegistry recording every call, defaults to the shared one
+        # record: cassette file path or CassetteWriter to append every request
+        #         and response to, see rpc.cassette and rpc.replay
 
         if isinstance(uri, unicode):
             uri = uri.encode('ISO-8859-1')
@@ -58,43 +123,160 @@ class RPCClientProxy(object):
                 transport = SafeTransport(use_datetime=use_datetime, context=context)
             else:
                 transport = Transport(use_datetime=use_datetime)
+        transport.raw = raw
+        transport.streaming = streaming
+        if record is not None:
+            transport.recorder = CassetteWriter(record) if isinstance(record, basestring) else record
         self.__transport = transport
 
         self.__encoding = encoding
         self.__verbose = verbose
         self.__allow_none = allow_none
+        self.__raw = raw
+        self.__batch_supported = None
+        self.__timeout = timeout
+        self.__connect_timeout = connect_timeout
+        self.__method_timeouts = dict(METHOD_TIMEOUTS)
+        self.__method_timeouts.update(method_timeouts or {})
+        self.__metrics = metrics or get_registry()
 
     def __close(self):
         self.__transport.close()
 
-    def __request(self, methodname, params):
+    def __get_timeout(self, methodnames, timeout=None, connect_timeout=None):
+        # resolve the timeouts of a call, bounded by the thread's deadline
+        if timeout is None:
+            timeouts = [self.__method_timeouts.get(name, self.__timeout) for name in methodnames]
+            timeout = None if None in timeouts else max(timeouts)
+        if connect_timeout is None:
+            connect_timeout = self.__connect_timeout
+        return Timeout(connect_timeout, timeout).clamp(remaining_time())
+
+    def __record(self, name, start, error):
+        # record latency and transfer sizes of the call made by this thread
+        self.__metrics.record_call(name, time.time() - start, error,
+                                   self.__transport.last_stats())
+
+    def __request(self, methodname, params, timeout=None, connect_timeout=None):
         # call a method on the remote server
-        request = {"jsonrpc": "2.0"}
-        if len(params) > 0:
-            request["params"] = params
-        request["id"] = random_id()
-        request["method"] = methodname
-        request = json.dumps(request)
-        response = self.__transport.request(
+        request = json.dumps(build_request(methodname, params))
+        start = time.time()
+        error = True
+        try:
+            response = self.__transport.request(
+                self.__host,
+                self.__handler,
+                request,
+                verbose=self.__verbose,
+                timeout=self.__get_timeout([methodname], timeout, connect_timeout)
+                )
+            if not isinstance(response, dict):
+                raise TypeError('Response is not dict')
+            result = unmarshal_response(response)
+            error = False
+            return result
+        finally:
+            self.__record(methodname, start, error)
+
+    def __batch_request(self, calls):
+        # call several methods on the remote server with one JSON-RPC 2.0 batch
+        if self.__batch_supported is not False:
+            try:
+                return self.__send_batch(calls)
+            except (BatchNotSupportedError, xmlrpclib.ProtocolError), e:
+                # a timeout or an overloaded host says nothing about batch support
+                if self.__batch_supported or not is_unsupported(e):
+                    raise
+                self.__batch_supported = False
+        results = []
+        for methodname, params in calls:
+            try:
+                results.append(self.__request(methodname, params))
+            except DriverApiError, e:
+                results.append(e)
+        return results
+
+    def __send_batch(self, calls):
+        requests = [build_request(methodname, params) for methodname, params in calls]
+        methodnames = [methodname for methodname, _ in calls]
+        start = time.time()
+        error = True
+        try:
+            response = self.__transport.request(
+                self.__host,
+                self.__handler,
+                json.dumps(requests),
+                verbose=self.__verbose,
+                timeout=self.__get_timeout(methodnames)
+                )
+            if not isinstance(response, list):
+                raise BatchNotSupportedError('Response of batch request is not list')
+            error = False
+        finally:
+            # one row per kind of batch however many calls it carries, batches of a
+            # varying number of calls would otherwise each get a metric of their own
+            self.__record('batch[%s]' % ','.join(sorted(set(methodnames))), start, error)
+        self.__batch_supported = True
+        responses = {}
+        for item in response:
+            if isinstance(item, dict):
+                responses[item.get('id')] = item
+        results = []
+        for request in requests:
+            item = responses.get(request['id'])
+            if item is None:
+                results.append(DriverApiError('No response for %s' % request['method']))
+                continue
+            try:
+                results.append(unmarshal_response(item))
+            except DriverApiError, e:
+                results.append(e)
+        return results
+
+    def __stream_request(self, methodname, *params):
+        # call a method and return an iterator of (prefix, event, value) tuples,
+        # the result itself is found under the prefix "result.item"
+        request = json.dumps(build_request(methodname, params))
+        chunks = self.__transport.stream_request(
             self.__host,
             self.__handler,
             request,
-            verbose=self.__verbose
+            verbose=self.__verbose,
+            timeout=self.__get_timeout([methodname])
             )
-        response = json.loads(response)
-        if not isinstance(response, dict):
-            raise TypeError('Response is not dict')
-        if 'error' in response.keys() and response['error'] is not None:
-            raise DriverApiError(response['error']['message'])
-        else:
-            response = response['result'][0]
-            if isinstance(response, dict):
-                return self.encode_dict(response, "UTF-8")
-            elif isinstance(response, list):
-                return self.encode_list(response, "UTF-8")
-            elif isinstance(response, unicode):
-                return response.encode("UTF-8")
-            return response
+        start = time.time()
+        error = True
+        try:
+            for prefix, event, value in iterevents(chunks, self.__raw):
+                if prefix == 'error.message' and event == 'value':
+                    raise DriverApiError(value)
+                yield prefix, event, value
+            error = False
+        finally:
+            chunks.close()
+            self.__record('stream[%s]' % methodname, start, error)
+
+    def __fetch(self, name, timeout=None, connect_timeout=None):
+        # GET a binary resource below the proxy's path, e.g. "screenshot",
+        # returning the body as is instead of a JSON-RPC result
+        start = time.time()
+        error = True
+        try:
+            content = self.__transport.fetch(
+                self.__host,
+                self.__handler.rstrip('/') + '/' + name,
+                verbose=self.__verbose,
+                timeout=self.__get_timeout([name], timeout, connect_timeout)
+                )
+            error = False
+            return content
+        finally:
+            self.__record('fetch[%s]' % name, start, error)
+
+    def __with_timeout(self, timeout, connect_timeout=None):
+        # bind explicit timeouts to the calls made through the returned object
+        return _TimeoutMethods(
+            lambda methodname, params: self.__request(methodname, params, timeout, connect_timeout))
 
     def __repr__(self):
         return (
@@ -119,50 +301,314 @@ class RPCClientProxy(object):
             return self.__close
         elif attr == "transport":
             return self.__transport
+        elif attr == "batch":
+            return self.__batch_request
+        elif attr == "stream":
+            return self.__stream_request
+        elif attr == "fetch":
+            return self.__fetch
+        elif attr == "timeout":
+            return self.__with_timeout
+        elif attr == "metrics":
+            return self.__metrics
         raise AttributeError("Attribute %r not found" % (attr,))
     
             
     def encode_dict(self, content, encoding="UTF-8"):
-        '''将字典编码为指定形式
-        
-        :param content: 要编码内容
-        :type content: dict
-        :param encoding:编码类型
-        :type encoding: str
-        :returns: dict -- 编码后的字典
-        '''
-        for key in content:
-            if isinstance(content[key], dict):
-                content[key] = self.encode_dict(content[key], encoding)
-            elif isinstance(content[key], unicode):
-                content[key] = content[key].encode(encoding)
-            elif isinstance(content[key], list):
-                content[key] = self.encode_list(content[key], encoding)
-        return content   
-    
+        return encode_dict(content, encoding)
+
     def encode_list(self, content, encoding="UTF-8"):
-        '''将列表编码为指定形式
-        
-        :param content: 要编码内容
-        :type content: list
-        :param encoding:编码类型
-        :type encoding: str
-        :returns: list -- 编码后的列表
+        return encode_list(content, encoding)
+
+
+class _TimeoutMethods(object):
+    # method dispatcher returned by proxy("timeout")(seconds)
+
+    def __init__(self, send):
+        self.__send = send
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__send, name)
+
+
+class Timeout(object):
+    '''一次调用的超时时间（秒），None表示不限制
+    '''
+
+    def __init__(self, connect=None, read=None):
         '''
-        for ind, item in enumerate(content):
-            if isinstance(item, dict):
-                content[ind] = self.encode_dict(item, encoding)
-            elif isinstance(item, unicode):
-                content[ind] = content[ind].encode(encoding)
-            elif isinstance(item, list):
-                content[ind] = self.encode_list(item, encoding)
-        return content
+        :param connect: 建立连接的超时时间
+        :type connect: float
+        :param read: 连接建立后等待完整响应的超时时间
+        :type read: float
+        '''
+        self.connect = connect
+        self.read = read
+
+    def clamp(self, remaining):
+        '''按剩余时间收紧超时，剩余时间已用完时抛出RPCTimeoutError
+        '''
+        if remaining is None:
+            return self
+        if remaining <= 0:
+            raise RPCTimeoutError('deadline exceeded', 'deadline', 0)
+        return Timeout(remaining if self.connect is None else min(self.connect, remaining),
+                       remaining if self.read is None else min(self.read, remaining))
+
+    def __repr__(self):
+        return '<Timeout connect=%s read=%s>' % (self.connect, self.read)
+
+
+_deadlines = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''限制with块内当前线程所有RPC调用的总耗时，嵌套时以较早的截止时间为准
+
+    :param seconds: 总耗时上限（秒）
+    :type seconds: float
+    '''
+    previous = getattr(_deadlines, 'value', None)
+    value = time.time() + seconds
+    if previous is not None:
+        value = min(previous, value)
+    _deadlines.value = value
+    try:
+        yield
+    finally:
+        _deadlines.value = previous
+
+
+def remaining_time():
+    '''当前线程距离截止时间的剩余秒数，未设置截止时间时返回None
+    '''
+    value = getattr(_deadlines, 'value', None)
+    if value is None:
+        return None
+    return value - time.time()
+
+
+def build_request(methodname, params):
+    '''构造JSON-RPC 2.0请求对象
+
+    :param methodname: 方法名
+    :type methodname: str
+    :param params: 参数
+    :type params: tuple
+    :returns: dict
+    '''
+    request = {"jsonrpc": "2.0"}
+    if len(params) > 0:
+        request["params"] = params
+    request["id"] = random_id()
+    request["method"] = methodname
+    return request
+
+
+def loads_response(data, raw=False):
+    '''解析JSON-RPC响应
+
+    非raw模式下在解析过程中直接把字符串转换为UTF-8编码的str，不再对结果做第二次遍历
+
+    :param data: 响应内容
+    :type data: str
+    :param raw: 为True时字符串保持unicode
+    :type raw: bool
+    '''
+    if raw:
+        return json.loads(data)
+    response = json.loads(data, object_pairs_hook=_utf8_object)
+    if isinstance(response, list):
+        return _utf8_list(response)
+    elif isinstance(response, unicode):
+        return response.encode("UTF-8")
+    return response
+
+
+_KEY_CACHE = {}
+_KEY_CACHE_SIZE = 10000
+
+
+def _utf8_object(pairs, type=type, unicode=unicode, list=list):
+    # called by the decoder for every JSON object once its members are parsed,
+    # nested objects have already been converted at this point.
+    # keys repeat across nodes of an element tree, so their encoded form is cached
+    content = {}
+    for key, value in pairs:
+        value_type = type(value)
+        if value_type is unicode:
+            value = value.encode("UTF-8")
+        elif value_type is list and value:
+            _utf8_list(value)
+        try:
+            content[_KEY_CACHE[key]] = value
+        except KeyError:
+            if len(_KEY_CACHE) > _KEY_CACHE_SIZE:
+                _KEY_CACHE.clear()
+            encoded_key = _KEY_CACHE[key] = key.encode("UTF-8")
+            content[encoded_key] = value
+    return content
+
+
+def _utf8_list(content, type=type, unicode=unicode, list=list):
+    # objects inside the list are converted by _utf8_object already
+    for ind, item in enumerate(content):
+        item_type = type(item)
+        if item_type is unicode:
+            content[ind] = item.encode("UTF-8")
+        elif item_type is list:
+            _utf8_list(item)
+    return content
+
+
+def unmarshal_response(response):
+    '''从JSON-RPC响应对象中取出调用结果
+
+    :param response: loads_response解析后的响应
+    :type response: dict
+    :returns: 调用结果
+    '''
+    if 'error' in response.keys() and response['error'] is not None:
+        raise DriverApiError(response['error']['message'], response['error'].get('code'))
+    else:
+        return response['result'][0]
+
+
+def encode_dict(content, encoding="UTF-8"):
+    '''将字典编码为指定形式
+    
+    :param content: 要编码内容
+    :type content: dict
+    :param encoding:编码类型
+    :type encoding: str
+    :returns: dict -- 编码后的字典
+    '''
+    for key in content:
+        if isinstance(content[key], dict):
+            content[key] = encode_dict(content[key], encoding)
+        elif isinstance(content[key], unicode):
+            content[key] = content[key].encode(encoding)
+        elif isinstance(content[key], list):
+            content[key] = encode_list(content[key], encoding)
+    return content   
+
+
+def encode_list(content, encoding="UTF-8"):
+    '''将列表编码为指定形式
+    
+    :param content: 要编码内容
+    :type content: list
+    :param encoding:编码类型
+    :type encoding: str
+    :returns: list -- 编码后的列表
+    '''
+    for ind, item in enumerate(content):
+        if isinstance(item, dict):
+            content[ind] = encode_dict(item, encoding)
+        elif isinstance(item, unicode):
+            content[ind] = content[ind].encode(encoding)
+        elif isinstance(item, list):
+            content[ind] = encode_list(item, encoding)
+    return content
+
+
+class MultiCall(object):
+    '''JSON-RPC 2.0批量调用，将多个方法调用合并到一次HTTP请求中
+
+    用法::
+
+        multicall = MultiCall(proxy)
+        multicall.device.capture_screen()
+        multicall.device.get_screen_orientation()
+        screen, orientation = multicall()
+
+    服务端不支持批量请求时自动退化为逐个调用
+    '''
+
+    def __init__(self, proxy):
+        self.__proxy = proxy
+        self.__calls = []
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__record, name)
+
+    def __record(self, methodname, params):
+        self.__calls.append((methodname, params))
+
+    def __call__(self):
+        return MultiCallResult(self.__proxy("batch")(self.__calls))
+
+
+class MultiCallResult(object):
+    '''批量调用的结果，按调用顺序访问，出错的调用在访问时抛出对应的DriverApiError
+    '''
+
+    def __init__(self, results):
+        self.results = results
+
+    def __getitem__(self, index):
+        item = self.results[index]
+        if isinstance(item, DriverApiError):
+            raise item
+        return item
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        for index in range(len(self.results)):
+            yield self[index]
 
 
 class DriverApiError(Exception):
     '''Driver API Error
     '''
 
+    def __init__(self, message, code=None):
+        '''
+        :param code: JSON-RPC错误码，不是服务端返回的错误时为None
+        :type code: int
+        '''
+        super(DriverApiError, self).__init__(message)
+        self.code = code
+
+
+class BatchNotSupportedError(DriverApiError):
+    '''服务端不支持JSON-RPC批量请求
+    '''
+
+
+class RPCTimeoutError(DriverApiError):
+    '''RPC调用超时
+    '''
+
+    def __init__(self, message, phase, timeout):
+        '''
+        :param phase: 超时发生的阶段，connect/read/deadline
+        :type phase: str
+        :param timeout: 对应的超时时间（秒）
+        :type timeout: float
+        '''
+        super(RPCTimeoutError, self).__init__(message)
+        self.phase = phase
+        self.timeout = timeout
+
+
+def is_unsupported(error):
+    '''错误是否表示服务端不支持所调用的方法或者批量请求，超时、熔断以及方法执行失败都不属于此类
+
+    用于检测服务端是否支持某个可选的方法，只有此类错误才能回退到旧的方式
+    '''
+    if isinstance(error, BatchNotSupportedError):
+        return True
+    if isinstance(error, xmlrpclib.ProtocolError):
+        return error.errcode in UNSUPPORTED_STATUS
+    if type(error) is not DriverApiError:
+        return False
+    return error.code == METHOD_NOT_FOUND or _NOT_SUPPORTED_PATTERN.search(str(error)) is not None
+
+
 class Fault(object):
     '''JSON-RPC Error
     '''
@@ -185,47 +631,695 @@ class Fault(object):
         return '<Fault %s: %s>' % (self.faultCode, self.faultString)
 
  
+class TransferStats(object):
+    '''一次调用或者累计的传输字节数
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.request_bytes = 0  # 压缩前的请求大小
+        self.request_wire_bytes = 0  # 实际发送的请求大小
+        self.response_wire_bytes = 0  # 实际接收的响应大小
+        self.response_bytes = 0  # 解压后的响应大小
+        self.decode_time = 0.0  # JSON解码耗时（秒）
+
+    @property
+    def saved_bytes(self):
+        '''压缩节省的传输字节数
+        '''
+        return (self.request_bytes - self.request_wire_bytes) + (self.response_bytes - self.response_wire_bytes)
+
+    def add(self, other):
+        self.calls += other.calls
+        self.request_bytes += other.request_bytes
+        self.request_wire_bytes += other.request_wire_bytes
+        self.response_wire_bytes += other.response_wire_bytes
+        self.response_bytes += other.response_bytes
+        self.decode_time += other.decode_time
+
+    def __repr__(self):
+        return '<TransferStats calls=%d request=%d/%d response=%d/%d>' % (
+            self.calls, self.request_wire_bytes, self.request_bytes,
+            self.response_wire_bytes, self.response_bytes)
+
+
+def compress(data, encoding, level=6):
+    '''按HTTP Content-Encoding压缩数据
+
+    :param encoding: gzip或者deflate
+    :type encoding: str
+    :param level: 压缩级别(1-9)
+    :type level: int
+    '''
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError('unsupported content encoding: %s' % encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding):
+    '''按HTTP Content-Encoding解压数据
+    '''
+    decompressor = Decompressor(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class Decompressor(object):
+    '''增量解压gzip或者deflate编码的数据，deflate同时兼容带zlib头和不带头两种格式
+    '''
+
+    def __init__(self, encoding):
+        if encoding == 'gzip':
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._obj = None
+        else:
+            raise ValueError('unsupported content encoding: %s' % encoding)
+        self._head = ''
+
+    def decompress(self, data):
+        if self._obj is None:
+            self._head += data
+            if len(self._head) < 2:
+                return ''
+            data, self._head = self._head, ''
+            first, second = ord(data[0]), ord(data[1])
+            if first & 0x0f == 8 and (first << 8 | second) % 31 == 0:
+                self._obj = zlib.decompressobj()
+            else:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(data)
+
+    def flush(self):
+        if self._obj is None:
+            if not self._head:
+                return ''
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._obj.decompress(self._head) + self._obj.flush()
+        return self._obj.flush()
+
+
 class TransportMixIn(object):
     '''XMLRPC Transport extended API
     '''
     user_agent = "jsonrpclib/0.1"
+    scheme = "http"
+    pool_max_size = connpool.DEFAULT_MAX_SIZE
+    pool_idle_timeout = connpool.DEFAULT_IDLE_TIMEOUT
+    read_size = 64 * 1024
+    raw = False
+    streaming = True
+    # response encodings announced in Accept-Encoding, empty to disable
+    accept_encodings = ('gzip', 'deflate')
+    # compress request bodies larger than this many bytes, None to disable
+    encode_threshold = None
+    encode_method = 'gzip'
+    encode_level = 6
+    # CassetteWriter recording the calls of this transport, when None the
+    # process wide one from rpc.cassette.start_recording is used
+    recorder = None
     _connection = (None, None)
     _extra_headers = []
-        
+
+    def __init__(self):
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.total_stats = TransferStats()
+
+    def last_stats(self):
+        '''当前线程最近一次调用的传输字节数
+
+        :returns: TransferStats
+        '''
+        return getattr(self._local, 'stats', None)
+
+    def get_connection_pool(self, host):
+        '''获取主机对应的共享连接池，同一主机的所有RPCClientProxy共用
+        '''
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        return connpool.get_pool((self.scheme, chost),
+                                 lambda: self.new_connection(chost, x509),
+                                 self.pool_max_size,
+                                 self.pool_idle_timeout)
+
+    def new_connection(self, chost, x509):
+        return httplib.HTTPConnection(chost)
+
+    def request(self, host, handler, request_body, verbose=0, timeout=None):
+        self._local.stats = None
+        return self._retry_cold(self.single_request, host, handler, request_body, verbose, timeout)
+
+    def fetch(self, host, handler, verbose=0, timeout=None):
+        """GET请求handler，返回原样的响应体，用于截图等二进制数据，避免base64编码和JSON解析
+        """
+        self._local.stats = None
+        return self._retry_cold(self._perform, host, handler, None, verbose, timeout, self.read_content)
+
+    def _retry_cold(self, func, *args):
+        #retry request once if cached connection has gone cold
+        for i in (0, 1):
+            try:
+                return func(*args)
+            except socket.error, e:
+                if i or e.errno not in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
+                    raise
+            except httplib.BadStatusLine: #close after we sent request
+                if i:
+                    raise
+
+    def single_request(self, host, handler, request_body, verbose=0, timeout=None):
+        return self._perform(host, handler, request_body, verbose, timeout, self.parse_response)
+
+    def _perform(self, host, handler, request_body, verbose, timeout, read):
+        # send the request on a pooled connection and read the response with read()
+        timeout = timeout or Timeout()
+        recorder = self.recorder or get_recorder()
+        tape = [] if recorder is not None else None
+        start = time.time()
+        pool = self.get_connection_pool(host)
+        connection = self._acquire(pool, host, handler, timeout)
+        reusable = False
+        try:
+            deadline = None if timeout.read is None else time.time() + timeout.read
+            self._connect(connection, timeout)
+            self._local.sock = connection.sock
+            self._local.deadline = deadline
+            self._local.tape = tape
+            response = self._send(connection, host, handler, request_body, verbose)
+            self._check_response(host, handler, response)
+            result = read(response)
+            reusable = not response.will_close
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, tape)
+            return result
+        except xmlrpclib.ProtocolError, e:
+            reusable = not response.will_close
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, status=e.errcode, reason=e.errmsg)
+            raise
+        except socket.timeout:
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, error='timeout')
+            raise RPCTimeoutError('%s%s timed out after %ss' % (host, handler, timeout.read),
+                                  'read', timeout.read)
+        finally:
+            pool.release(connection, reusable)
+
+    def _record(self, recorder, host, handler, request_body, start, tape=None, **kwargs):
+        recorder.record(host, handler, request_body, start, time.time() - start, ''.join(tape or ()),
+                        method='GET' if request_body is None else 'POST', **kwargs)
+
+    def stream_request(self, host, handler, request_body, verbose=0, timeout=None):
+        """发送请求并返回逐块产生响应内容的生成器，连接在生成器结束后归还连接池
+
+        timeout.read限制的是每次读取的等待时间，而不是整个响应的耗时
+        """
+        timeout = timeout or Timeout()
+        recorder = self.recorder or get_recorder()
+        tape = [] if recorder is not None else None
+        start = time.time()
+        pool = self.get_connection_pool(host)
+        connection = self._acquire(pool, host, handler, timeout)
+        reusable = False
+        try:
+            self._connect(connection, timeout)
+            response = self._send(connection, host, handler, request_body, verbose)
+            self._check_response(host, handler, response)
+            stats = self._local.stats
+            for data in self._iter_body(response, stats, tape=tape):
+                yield data
+            self._add_total(stats)
+            reusable = not response.will_close
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, tape)
+        except xmlrpclib.ProtocolError, e:
+            reusable = not response.will_close
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, status=e.errcode, reason=e.errmsg)
+            raise
+        except socket.timeout:
+            if recorder is not None:
+                self._record(recorder, host, handler, request_body, start, error='timeout')
+            raise RPCTimeoutError('%s%s timed out after %ss' % (host, handler, timeout.read),
+                                  'read', timeout.read)
+        finally:
+            pool.release(connection, reusable)
+
+    def _acquire(self, pool, host, handler, timeout):
+        # wait for a pooled connection no longer than the connect timeout, the
+        # request has not been sent yet so the call can be retried safely
+        try:
+            return pool.acquire(timeout.connect)
+        except connpool.PoolTimeoutError:
+            raise RPCTimeoutError('%s%s found no free connection after %ss' % (host, handler, timeout.connect),
+                                  'connect', timeout.connect)
+
+    def _connect(self, connection, timeout):
+        # connect a new pooled connection and apply the read timeout to its socket
+        if connection.sock is None:
+            connection.timeout = timeout.connect
+            try:
+                connection.connect()
+            except socket.error, e:
+                # socket.timeout, ETIMEDOUT of the kernel, or a timed out TLS handshake
+                if not (isinstance(e, socket.timeout) or e.errno == errno.ETIMEDOUT or 'timed out' in str(e)):
+                    raise
+                connection.close()
+                raise RPCTimeoutError('connect to %s timed out after %ss' % (connection.host, timeout.connect),
+                                      'connect', timeout.connect)
+        connection.sock.settimeout(timeout.read)
+
+    def _send(self, connection, host, handler, request_body, verbose):
+        self._local.stats = TransferStats()
+        self._local.stats.calls = 1
+        if verbose:
+            connection.set_debuglevel(1)
+        if request_body is None:
+            # binary resources are already compressed, ask for them as is
+            connection.putrequest("GET", handler, skip_accept_encoding=True)
+            self.send_host(connection, host)
+            self.send_user_agent(connection)
+            connection.endheaders()
+        else:
+            self.send_request(connection, handler, request_body)
+            self.send_host(connection, host)
+            self.send_user_agent(connection)
+            self.send_content(connection, request_body)
+
+        self.verbose = verbose
+        return connection.getresponse(buffering=True)
+
+    def _check_response(self, host, handler, response):
+        if response.status == 200:
+            return
+
+        #discard any response data and raise exception
+        if response.getheader("content-length", 0):
+            response.read()
+        else:
+            response.will_close = True
+        raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                      response.reason, response.msg)
+
+    def send_request(self, connection, handler, request_body):
+        if self.accept_encodings:
+            connection.putrequest("POST", handler, skip_accept_encoding=True)
+            connection.putheader("Accept-Encoding", ", ".join(self.accept_encodings))
+        else:
+            connection.putrequest("POST", handler)
+
     def send_content(self, connection, request_body):
+        stats = self._local.stats
+        stats.request_bytes = len(request_body)
         connection.putheader("Content-Type", "application/json-rpc")
+        if self.encode_threshold is not None and len(request_body) > self.encode_threshold:
+            request_body = compress(request_body, self.encode_method, self.encode_level)
+            connection.putheader("Content-Encoding", self.encode_method)
+        stats.request_wire_bytes = len(request_body)
         connection.putheader("Content-Length", str(len(request_body)))
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
-            
+        # send headers and body in one segment, a separate small write waits
+        # for the delayed ACK of the headers (Nagle)
+        connection.endheaders(request_body or None)
+
+    def parse_response(self, response):
+        p, u = self.getparser()
+        call = self._local
+        decode_time = 0.0
+        for data in self._iter_body(response, call.stats, call.sock, call.deadline, call.tape):
+            if self.verbose:
+                print "body:", repr(data)
+            start = time.time()
+            p.feed(data)
+            decode_time += time.time() - start
+        start = time.time()
+        p.close()
+        result = u.close()
+        call.stats.decode_time = decode_time + time.time() - start
+        self._add_total(call.stats)
+        return result
+
+    def read_content(self, response):
+        call = self._local
+        content = ''.join(self._iter_body(response, call.stats, call.sock, call.deadline, call.tape))
+        self._add_total(call.stats)
+        return content
+
+    def _iter_body(self, response, stats, sock=None, deadline=None, tape=None):
+        # read the response body block by block, decoding it on the fly;
+        # with a deadline each read only waits for the time left of the call;
+        # the decoded blocks are also appended to tape when recording
+        encoding = response.getheader("Content-Encoding", "").lower()
+        decompressor = Decompressor(encoding) if encoding in ("gzip", "deflate") else None
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                sock.settimeout(remaining)
+            data = response.read(self.read_size)
+            if not data:
+                break
+            stats.response_wire_bytes += len(data)
+            if decompressor:
+                data = decompressor.decompress(data)
+            if data:
+                stats.response_bytes += len(data)
+                if tape is not None:
+                    tape.append(data)
+                yield data
+        if decompressor:
+            data = decompressor.flush()
+            if data:
+                stats.response_bytes += len(data)
+                if tape is not None:
+                    tape.append(data)
+                yield data
+
+    def _add_total(self, stats):
+        with self._stats_lock:
+            self.total_stats.add(stats)
+
     def getparser(self):
-        target = JSONTarget()
-        return JSONParser(target), target    
-    
+        target = JSONTarget(self.raw)
+        if self.streaming:
+            return JSONParser(target, whole_values=True), target
+        return BufferedJSONParser(target), target
+
 
 class JSONParser(object):
-    
-    def __init__(self, target):
+    """增量JSON解析器
+
+    数据块到达时即解析，并以事件的形式交给target，不需要先拼接出完整的响应内容。
+    target需要实现start_map、map_key、end_map、start_array、end_array和value方法。
+    whole_values为True时，已完整到达的对象和数组由json的C扫描器一次解析后交给
+    target.value，只有跨越数据块的外层容器逐个事件解析。
+    """
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+    _NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+    _NUMBER_CHARS = re.compile(r'[-+0-9.eE]*')
+    _CONSTANTS = {'t': ('true', True), 'f': ('false', False), 'n': ('null', None)}
+
+    def __init__(self, target, whole_values=False):
         self.target = target
+        self._buffer = ''
+        self._pending = []  # 未结束字符串的后续数据块
+        self._stack = []  # 每层容器: [is_map, expect_key]
+        self._done = False
+        self._scan = None
+        if whole_values:
+            raw = getattr(target, 'raw', False)
+            self._raw = raw
+            self._scan = json.JSONDecoder(object_pairs_hook=None if raw else _utf8_object).scan_once
 
     def feed(self, data):
-        self.target.feed(data)
+        if self._pending:
+            # 处于一个未结束的字符串中，直到出现引号才需要重新扫描
+            self._pending.append(data)
+            if '"' not in data:
+                return
+            data, self._pending = ''.join(self._pending), []
+            self._buffer += data
+        else:
+            self._buffer += data
+        self._parse(False)
 
     def close(self):
-        pass
+        if self._pending:
+            self._buffer += ''.join(self._pending)
+            self._pending = []
+        self._parse(True)
+        if not self._done or self._stack:
+            raise ValueError('Incomplete JSON document')
 
+    def _parse(self, final):
+        buf = self._buffer
+        pos = 0
+        end = len(buf)
+        target = self.target
+        stack = self._stack
+        whitespace = self._WHITESPACE.match
+        while True:
+            pos = whitespace(buf, pos).end()
+            if pos >= end:
+                break
+            char = buf[pos]
+            if self._done:
+                raise ValueError('Extra data at position %d' % pos)
+            if char == '"':
+                try:
+                    value, new_pos = scanstring(buf, pos + 1)
+                except ValueError:
+                    if final or buf.find('"', pos + 1) >= 0 and self._is_terminated(buf, pos + 1):
+                        raise
+                    self._pending = [buf[pos:]]
+                    buf, pos = '', 0
+                    break
+                if stack and stack[-1][0] and stack[-1][1]:
+                    target.map_key(value)
+                    stack[-1][1] = False
+                else:
+                    target.value(value)
+                    self._value_done()
+                pos = new_pos
+            elif char in '{[' and self._scan_value(buf, pos):
+                pos = self._scan_end
+            elif char == '{':
+                target.start_map()
+                stack.append([True, True])
+                pos += 1
+            elif char == '[':
+                target.start_array()
+                stack.append([False, False])
+                pos += 1
+            elif char == '}':
+                stack.pop()
+                target.end_map()
+                self._value_done()
+                pos += 1
+            elif char == ']':
+                stack.pop()
+                target.end_array()
+                self._value_done()
+                pos += 1
+            elif char == ',':
+                if stack and stack[-1][0]:
+                    stack[-1][1] = True
+                pos += 1
+            elif char == ':':
+                pos += 1
+            elif char in self._CONSTANTS:
+                literal, value = self._CONSTANTS[char]
+                if end - pos < len(literal) and not final:
+                    break
+                if buf[pos:pos + len(literal)] != literal:
+                    raise ValueError('Invalid literal at position %d' % pos)
+                target.value(value)
+                self._value_done()
+                pos += len(literal)
+            else:
+                if self._NUMBER_CHARS.match(buf, pos).end() >= end and not final:
+                    # the number may continue in the next chunk
+                    break
+                match = self._NUMBER.match(buf, pos)
+                if not match or match.end() == pos:
+                    raise ValueError('Unexpected character %r at position %d' % (char, pos))
+                frac, exp = match.groups()
+                number = match.group()
+                target.value(float(number) if frac or exp else int(number))
+                self._value_done()
+                pos = match.end()
+        self._buffer = buf[pos:] if pos else buf
 
-class JSONTarget(object):
-    
-    def __init__(self):
+    def _scan_value(self, buf, pos):
+        # decode a container whose end has already arrived in one go; an
+        # incomplete (or invalid) one is left to the event parser
+        if self._scan is None:
+            return False
+        try:
+            value, self._scan_end = self._scan(buf, pos)
+        except (ValueError, StopIteration):
+            return False
+        if not self._raw and type(value) is list:
+            _utf8_list(value)
+        self.target.value(value)
+        self._value_done()
+        return True
+
+    def _is_terminated(self, buf, pos):
+        # scanstring failed although a quote exists: the quote may be escaped,
+        # treat the string as unterminated unless an unescaped quote is present
+        while True:
+            pos = buf.find('"', pos)
+            if pos < 0:
+                return False
+            backslashes = 0
+            while buf[pos - 1 - backslashes] == '\\':
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return True
+            pos += 1
+
+    def _value_done(self):
+        if not self._stack:
+            self._done = True
+
+
+class BufferedJSONParser(object):
+    """先缓存全部数据块，结束时一次性解析，适用于中小型的响应
+    """
+
+    def __init__(self, target):
+        self.target = target
         self.data = []
 
     def feed(self, data):
         self.data.append(data)
 
     def close(self):
-        return ''.join(self.data)
+        data, self.data = ''.join(self.data), []
+        self.target.value(loads_response(data, self.target.raw))
+
+
+class JSONTarget(object):
+    """根据解析事件构造结果对象，非raw模式下字符串转换为UTF-8编码的str
+    """
+
+    def __init__(self, raw=False):
+        self.raw = raw
+        self._stack = []  # [container, pending_key]
+        self._result = None
+
+    def start_map(self):
+        self._stack.append([{}, None])
+
+    def map_key(self, key):
+        if not self.raw:
+            key = key.encode("UTF-8")
+        self._stack[-1][1] = key
+
+    def end_map(self):
+        self._add(self._stack.pop()[0])
+
+    def start_array(self):
+        self._stack.append([[], None])
+
+    def end_array(self):
+        self._add(self._stack.pop()[0])
+
+    def value(self, value):
+        if not self.raw and type(value) is unicode:
+            value = value.encode("UTF-8")
+        self._add(value)
+
+    def _add(self, value):
+        if not self._stack:
+            self._result = value
+            return
+        container, key = self._stack[-1]
+        if key is None:
+            container.append(value)
+        else:
+            container[key] = value
+
+    def close(self):
+        return self._result
+
+
+class _EventTarget(object):
+    # collect parser events as (prefix, event, value) tuples, prefix being the
+    # dotted path of the value with "item" standing for array elements
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.events = []
+        self._path = []
+
+    def start_map(self):
+        self.events.append(('.'.join(self._path), 'start_map', None))
+        self._path.append('')
+
+    def map_key(self, key):
+        if not self.raw:
+            key = key.encode("UTF-8")
+        self.events.append(('.'.join(self._path[:-1]), 'map_key', key))
+        self._path[-1] = key
+
+    def end_map(self):
+        self._path.pop()
+        self.events.append(('.'.join(self._path), 'end_map', None))
+
+    def start_array(self):
+        self.events.append(('.'.join(self._path), 'start_array', None))
+        self._path.append('item')
+
+    def end_array(self):
+        self._path.pop()
+        self.events.append(('.'.join(self._path), 'end_array', None))
+
+    def value(self, value):
+        if not self.raw and type(value) is unicode:
+            value = value.encode("UTF-8")
+        self.events.append(('.'.join(self._path), 'value', value))
+
+
+def iterevents(chunks, raw=False):
+    """逐块解析JSON并产生(prefix, event, value)事件
+
+    :param chunks: 产生数据块的可迭代对象
+    :param raw: 为True时字符串保持unicode
+    """
+    target = _EventTarget(raw)
+    parser = JSONParser(target)
+    for data in chunks:
+        parser.feed(data)
+        events, target.events = target.events, []
+        for event in events:
+            yield event
+    parser.close()
+    for event in target.events:
+        yield event
+
+
+def iteritems(events, prefix):
+    """从事件流中构造位于prefix处的对象，每个对象完整后立即产生
+
+    例如prefix为"result.item.children.item"时，逐个产生根节点下的每棵子树
+    """
+    builder = None
+    depth = 0
+    for current, event, value in events:
+        if builder is None:
+            if current != prefix:
+                continue
+            if event == 'value':
+                yield value
+                continue
+            if event not in ('start_map', 'start_array'):
+                continue
+            builder = JSONTarget(raw=True)
+            depth = 0
+        if event == 'start_map':
+            builder.start_map()
+            depth += 1
+        elif event == 'start_array':
+            builder.start_array()
+            depth += 1
+        elif event == 'map_key':
+            builder.map_key(value)
+        elif event == 'value':
+            builder.value(value)
+        else:
+            if event == 'end_map':
+                builder.end_map()
+            else:
+                builder.end_array()
+            depth -= 1
+            if depth == 0:
+                yield builder.close()
+                builder = None
 
 
 class Transport(TransportMixIn, xmlrpclib.Transport):
@@ -236,15 +1330,21 @@ class Transport(TransportMixIn, xmlrpclib.Transport):
 
 
 class SafeTransport(TransportMixIn, xmlrpclib.SafeTransport):
+    scheme = "https"
     
     def __init__(self, use_datetime, context):
         TransportMixIn.__init__(self)    
         xmlrpclib.SafeTransport.__init__(self, use_datetime, context)
 
+    def new_connection(self, chost, x509):
+        return httplib.HTTPSConnection(chost, None, context=self.context, **(x509 or {}))
+
 
 class SimpleJSONRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     '''JSON-RPC请求处理器
     '''
+    encode_level = 6
+
     def is_rpc_path_valid(self):
         return True
     
@@ -262,7 +1362,9 @@ class SimpleJSONRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler)
                 chunk_size = min(size_remaining, max_chunk_size)
                 L.append(self.rfile.read(chunk_size))
                 size_remaining -= len(L[-1])
-            data = ''.join(L)
+            data = self.decode_request_content(''.join(L))
+            if data is None:
+                return
             response = self.server._marshaled_dispatch(
                     data, getattr(self, '_dispatch', None), self.path
                 )
@@ -273,15 +1375,37 @@ class SimpleJSONRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler)
         if response is None:
             response = ''
         self.send_header("Content-type", "application/json-rpc")
-        if self.encode_threshold is not None:
-            if len(response) > self.encode_threshold:
-                    q = self.accept_encodings().get("gzip", 0)
-                    if q:
-                        try:
-                            response = xmlrpclib.gzip_encode(response)
-                            self.send_header("Content-Encoding", "gzip")
-                        except NotImplementedError:
-                            pass
+        if self.encode_threshold is not None and len(response) > self.encode_threshold:
+            encoding = self.choose_encoding()
+            if encoding:
+                response = compress(response, encoding, self.encode_level)
+                self.send_header("Content-Encoding", encoding)
         self.send_header("Content-length", str(len(response)))
         self.end_headers()
         self.wfile.write(response)
+
+    def choose_encoding(self):
+        '''根据请求的Accept-Encoding选择响应的压缩方式，gzip优先
+        '''
+        accepted = self.accept_encodings()
+        best = None
+        for encoding in ("gzip", "deflate"):
+            if accepted.get(encoding, 0) > accepted.get(best, 0):
+                best = encoding
+        return best
+
+    def decode_request_content(self, data):
+        '''解压请求内容，不支持的编码返回None并回复错误
+        '''
+        encoding = self.headers.get("content-encoding", "identity").lower()
+        if encoding == "identity":
+            return data
+        if encoding in ("gzip", "deflate"):
+            try:
+                return decompress(data, encoding)
+            except zlib.error:
+                self.send_response(400, "error decoding %s body" % encoding)
+        else:
+            self.send_response(501, "encoding %r not supported" % encoding)
+        self.send_header("Content-length", "0")
+        self.end_headers()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''HTTP/1.1 keep-alive连接池
+'''
+
+import select
+import socket
+import threading
+import time
+
+
+DEFAULT_MAX_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 30
+
+
+class PoolTimeoutError(Exception):
+    '''等待空闲连接超时
+    '''
+
+
+class ConnectionPool(object):
+    '''同一主机的HTTP连接池(线程安全)
+
+    连接在请求完成后归还到池中复用，超过空闲时间或者已被服务端关闭的连接在取出前被淘汰。
+    '''
+
+    def __init__(self, factory, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        '''
+        :param factory: 创建新连接的函数，返回httplib.HTTPConnection
+        :type factory: callable
+        :param max_size: 同时使用中的最大连接数
+        :type max_size: int
+        :param idle_timeout: 空闲连接的最长保留时间（秒）
+        :type idle_timeout: float
+        '''
+        self._factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = []  # [(connection, last_used)]，末尾为最近使用
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def acquire(self, timeout=None):
+        '''从池中取出一个可用连接
+
+        :param timeout: 等待空闲连接的最长时间（秒），None表示一直等待
+        :type timeout: float
+        :returns: httplib.HTTPConnection
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                self._evict_expired()
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self._is_healthy(conn):
+                        self._in_use += 1
+                        return conn
+                    conn.close()
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError('no free connection in pool after %ss' % timeout)
+                    self._cond.wait(remaining)
+        try:
+            return self._factory()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, reusable=True):
+        '''归还连接
+
+        :param conn: acquire取出的连接
+        :type conn: httplib.HTTPConnection
+        :param reusable: 连接是否可以继续复用，否则直接关闭
+        :type reusable: bool
+        '''
+        if not reusable or conn.sock is None:
+            conn.close()
+        with self._cond:
+            self._in_use -= 1
+            if reusable and conn.sock is not None:
+                self._idle.append((conn, time.time()))
+            self._evict_expired()
+            self._cond.notify()
+
+    def resize(self, max_size):
+        '''调整同时使用中的最大连接数
+        '''
+        with self._cond:
+            self.max_size = max_size
+            self._cond.notify_all()
+
+    def clear(self):
+        '''关闭所有空闲连接
+        '''
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def _evict_expired(self):
+        if not self._idle:
+            return
+        now = time.time()
+        alive = []
+        for conn, last_used in self._idle:
+            if now - last_used > self.idle_timeout:
+                conn.close()
+            else:
+                alive.append((conn, last_used))
+        self._idle = alive
+
+    def _is_healthy(self, conn):
+        '''空闲的keep-alive连接上不应有可读数据，可读说明对端已关闭或者状态异常
+        '''
+        sock = conn.sock
+        if sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, factory, max_size=DEFAULT_MAX_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    '''获取key对应的共享连接池，不存在时创建，已存在时最大连接数取各调用者要求的最大值
+
+    :param key: 连接池的标识，一般为(scheme, host)
+    :type key: tuple
+    :param factory: 创建新连接的函数
+    :type factory: callable
+    '''
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(factory, max_size, idle_timeout)
+        elif max_size > pool.max_size:
+            pool.resize(max_size)
+        return pool
+
+
+def clear_pools():
+    '''关闭所有连接池中的空闲连接
+    '''
+    with _pools_lock:
+        pools = _pools.values()
+    for pool in pools:
+        pool.clear()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''多台设备主机上的设备Driver池
+
+每台设备只保留一个DeviceDriver，切换设备时复用其连接、缓存和调度器；同一主机的
+Driver共用一个连接池。
+
+用法:
+    pool = DevicePool()
+    pool.add_host(HostDriver('127.0.0.1', 12306))
+    driver = pool.get(udid)
+    futures = pool.take_screenshots()
+    wait_all(futures.values())
+'''
+
+import Queue
+import sys
+import threading
+import time
+import weakref
+
+from rpc.client import Transport
+from rpc.driver import DeviceDriver
+from rpc.future import Future
+from util.logger import Log
+
+
+# 同时执行的批量操作数，同一主机的连接池也至少保留这么多连接
+DEFAULT_MAX_WORKERS = 8
+# 超过该时间（秒）未使用的Driver从池中移除
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+class DeviceNotFoundError(KeyError):
+    '''已添加的设备主机上没有该设备
+    '''
+
+
+class DevicePool(object):
+    '''按udid复用DeviceDriver(线程安全)
+
+    Driver在第一次get时创建，空闲超时后从池中移除；仍被其他地方引用的Driver在
+    再次get时原样返回，同一设备不会同时存在两个Driver。
+    '''
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 cache_max_age=None):
+        '''
+        :param max_workers: 批量操作的最大并发数
+        :type max_workers: int
+        :param idle_timeout: Driver的最长空闲时间（秒），None表示不移除
+        :type idle_timeout: float
+        :param cache_max_age: 传给DeviceDriver的缓存时间，None表示使用DeviceDriver的默认值
+        :type cache_max_age: float
+        '''
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._cache_max_age = cache_max_age
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_workers)
+        self._hosts = {}  # {host_url: HostDriver}
+        self._devices = {}  # {udid: (host_url, device)}
+        self._drivers = {}  # {udid: (driver, last_used)}
+        self._alive = weakref.WeakValueDictionary()  # 已移出池但仍在使用的Driver
+
+    def add_host(self, host_driver, refresh=True):
+        '''添加设备主机
+
+        :param host_driver: 设备主机
+        :type host_driver: HostDriver
+        :param refresh: 是否立即获取主机上的设备列表
+        :type refresh: bool
+        :returns: list -- 该主机上的设备
+        '''
+        with self._lock:
+            self._hosts[host_driver.host_url] = host_driver
+        if refresh:
+            return self._refresh_host(host_driver)
+        return []
+
+    def remove_host(self, host_url):
+        '''移除设备主机及其上的设备
+        '''
+        with self._lock:
+            self._hosts.pop(host_url, None)
+            for udid, (url, _) in self._devices.items():
+                if url == host_url:
+                    self._forget(udid)
+
+    def refresh(self):
+        '''重新获取所有主机的设备列表，已不存在的设备的Driver被移除
+
+        :returns: list -- 所有设备
+        '''
+        with self._lock:
+            hosts = self._hosts.values()
+        for host_driver in hosts:
+            self._refresh_host(host_driver)
+        return self.devices()
+
+    def _refresh_host(self, host_driver):
+        devices = host_driver.list_devices() or []
+        self.update_devices(host_driver.host_url, devices)
+        return devices
+
+    def update_devices(self, host_url, devices):
+        '''更新主机上的设备列表，例如DeviceWatcher通知设备变化时
+
+        :param host_url: 已添加的设备主机
+        :type host_url: str
+        :param devices: 主机上的全部设备
+        :type devices: list
+        '''
+        udids = set(device['udid'] for device in devices)
+        with self._lock:
+            if host_url not in self._hosts:
+                return
+            for udid, (url, _) in self._devices.items():
+                if url == host_url and udid not in udids:
+                    self._forget(udid)
+            for device in devices:
+                url, _ = self._devices.get(device['udid'], (host_url, None))
+                if url != host_url:
+                    # 设备换到了另一台主机上
+                    self._forget(device['udid'])
+                self._devices[device['udid']] = (host_url, device)
+
+    def _forget(self, udid):
+        self._devices.pop(udid, None)
+        self._drivers.pop(udid, None)
+        self._alive.pop(udid, None)
+
+    def devices(self):
+        '''所有主机上的设备
+
+        :returns: list -- [device]，device中的host_url为所在主机
+        '''
+        with self._lock:
+            items = sorted(self._devices.items())
+        result = []
+        for _, (host_url, device) in items:
+            device = dict(device)
+            device['host_url'] = host_url
+            result.append(device)
+        return result
+
+    def host_of(self, udid):
+        '''设备所在的主机
+
+        :returns: HostDriver
+        '''
+        with self._lock:
+            if udid not in self._devices:
+                raise DeviceNotFoundError(udid)
+            return self._hosts[self._devices[udid][0]]
+
+    def get(self, udid):
+        '''返回设备的Driver，第一次使用时创建
+
+        :param udid: 设备udid
+        :type udid: str
+        :returns: DeviceDriver
+        :raises: DeviceNotFoundError
+        '''
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._drivers.get(udid)
+            driver = entry[0] if entry else self._alive.get(udid)
+            if driver is None:
+                if udid not in self._devices:
+                    raise DeviceNotFoundError(udid)
+                driver = self._new_driver(self._devices[udid][0], udid)
+                self._alive[udid] = driver
+            self._drivers[udid] = (driver, now)
+            return driver
+
+    def _new_driver(self, host_url, udid):
+        # 每个Driver使用自己的Transport，连接池按主机共享，大小至少为批量操作的并发数
+        transport = Transport(use_datetime=0)
+        transport.pool_max_size = max(transport.pool_max_size, self.max_workers)
+        kwargs = {}
+        if self._cache_max_age is not None:
+            kwargs['cache_max_age'] = self._cache_max_age
+        Log.i('DevicePool', 'create driver for %s on %s' % (udid, host_url))
+        return DeviceDriver(host_url, udid, transport=transport, **kwargs)
+
+    def evict_idle(self):
+        '''移除空闲超时的Driver
+
+        :returns: int -- 移除的数量
+        '''
+        with self._lock:
+            return self._evict_idle(time.time())
+
+    def _evict_idle(self, now):
+        if self.idle_timeout is None:
+            return 0
+        expired = [udid for udid, (_, last_used) in self._drivers.items()
+                   if now - last_used > self.idle_timeout]
+        for udid in expired:
+            del self._drivers[udid]
+        return len(expired)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._drivers)
+
+    def fan_out(self, func, udids=None):
+        '''在多台设备上并发执行func(driver)，同时执行的数量不超过max_workers
+
+        :param func: 参数为DeviceDriver的函数
+        :type func: callable
+        :param udids: 设备列表，默认为所有设备
+        :type udids: list
+        :returns: dict -- {udid: Future}
+        '''
+        if udids is None:
+            with self._lock:
+                udids = sorted(self._devices)
+        futures = {}
+        tasks = Queue.Queue()
+        for udid in udids:
+            futures[udid] = Future()
+            tasks.put((udid, futures[udid]))
+
+        def worker():
+            while True:
+                try:
+                    udid, future = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                with self._slots:
+                    if not future.set_running():
+                        continue
+                    try:
+                        future.set_result(func(self.get(udid)))
+                    except Exception, e:
+                        future.set_exception(e, sys.exc_info()[2])
+
+        for _ in range(min(self.max_workers, len(udids))):
+            thread = threading.Thread(target=worker, name='DevicePool')
+            thread.setDaemon(True)
+            thread.start()
+        return futures
+
+    def take_screenshots(self, udids=None):
+        '''所有设备截屏
+
+        :returns: dict -- {udid: Future}，结果为图片数据
+        '''
+        return self.fan_out(lambda driver: driver.take_screenshot(), udids)
+
+    def get_app_lists(self, app_type='user', udids=None):
+        '''所有设备的App列表
+
+        :returns: dict -- {udid: Future}，结果为App列表
+        '''
+        return self.fan_out(lambda driver: driver.get_app_list(app_type), udids)
+
+    def close(self):
+        '''移除所有主机和Driver
+        '''
+        with self._lock:
+            self._hosts = {}
+            self._devices = {}
+            self._drivers = {}
+            self._alive = weakref.WeakValueDictionary()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''设备主机上的设备发现
+
+主机提供host.wait_for_devices时以长轮询等待设备变化，否则定时调用list_devices：
+刚发生变化时轮询间隔最短，之后没有变化则逐渐拉长到最大间隔。
+'''
+
+import threading
+import traceback
+
+from rpc.client import DriverApiError
+from rpc.client import is_unsupported
+from util.logger import Log
+
+
+# 轮询list_devices的最短和最长间隔（秒）
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 5.0
+# 每次没有变化时轮询间隔增长的倍数
+POLL_BACKOFF = 1.5
+# 长轮询在主机上的最长等待时间（秒）
+WAIT_TIMEOUT = 20
+
+
+class DeviceChanges(object):
+    '''设备列表的一次变化
+    '''
+
+    def __init__(self, devices, added, removed, changed):
+        '''
+        :param devices: 变化后的全部设备
+        :param added: 新增的设备
+        :param removed: 移除的设备
+        :param changed: udid不变但信息变化的设备(变化后的信息)
+        :type changed: list
+        '''
+        self.devices = devices
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return '<DeviceChanges +%d -%d ~%d>' % (len(self.added), len(self.removed), len(self.changed))
+
+
+def diff_devices(old, new):
+    '''按udid比较两次获取的设备列表
+
+    :param old: 之前的设备列表，None表示尚未获取
+    :type old: list
+    :param new: 当前的设备列表
+    :type new: list
+    :returns: DeviceChanges
+    '''
+    old_devices = dict((device['udid'], device) for device in old or [])
+    new_udids = set(device['udid'] for device in new)
+    added = [device for device in new if device['udid'] not in old_devices]
+    changed = [device for device in new
+               if device['udid'] in old_devices and old_devices[device['udid']] != device]
+    removed = [device for device in old or [] if device['udid'] not in new_udids]
+    return DeviceChanges(new, added, removed, changed)
+
+
+class DeviceWatcher(object):
+    '''在后台线程中监视设备主机上的设备变化，有变化时调用callback(DeviceChanges)
+
+    callback在监视线程中执行，界面应转到主线程中更新；第一次获取到设备列表时
+    所有设备都作为新增设备通知。
+    '''
+
+    def __init__(self, host_driver, callback, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL, wait_timeout=WAIT_TIMEOUT):
+        '''
+        :param host_driver: 设备主机
+        :type host_driver: HostDriver
+        :param callback: 设备变化时的回调函数，参数为DeviceChanges
+        :type callback: callable
+        :param min_interval: 轮询的最短间隔（秒）
+        :type min_interval: float
+        :param max_interval: 轮询的最长间隔（秒），获取失败后也按该间隔重试
+        :type max_interval: float
+        :param wait_timeout: 长轮询在主机上的最长等待时间（秒）
+        :type wait_timeout: float
+        '''
+        self.host_driver = host_driver
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.wait_timeout = wait_timeout
+        self.polls = 0
+        self._devices = None
+        self._version = None
+        self._push = None  # 主机是否支持长轮询，None表示尚未确定
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def devices(self):
+        '''最近获取的设备列表，尚未获取时为None
+        '''
+        return self._devices
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='DeviceWatcher')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''停止监视，进行中的长轮询返回后线程退出
+        '''
+        self._stopped.set()
+        self._wakeup.set()
+
+    def poll_now(self):
+        '''立即重新获取设备列表，例如用户点击刷新时；长轮询时主机会即时返回变化，无需调用
+        '''
+        self._wakeup.set()
+
+    def _run(self):
+        interval = self.min_interval
+        failed = False
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                devices, waited = self._fetch()
+            except:
+                if not failed:
+                    Log.w('DeviceWatcher', 'failed to list devices of %s: %s'
+                          % (self.host_driver.host_url, traceback.format_exc()))
+                failed = True
+                self._wakeup.wait(self.max_interval)
+                continue
+            failed = False
+            self.polls += 1
+            changes = diff_devices(self._devices, devices)
+            if self._devices is None or changes:
+                self._devices = devices
+                self._notify(changes)
+                interval = self.min_interval
+            else:
+                interval = min(interval * POLL_BACKOFF, self.max_interval)
+            if not waited:
+                self._wakeup.wait(interval)
+
+    def _fetch(self):
+        '''获取设备列表
+
+        :returns: tuple -- (设备列表, 是否已经在主机上等待过)
+        '''
+        if self._push is not False:
+            try:
+                result = self.host_driver.wait_for_devices(self._version, self.wait_timeout)
+            except DriverApiError, e:
+                # a timed out long poll or a busy host does not mean an older host
+                if self._push or not is_unsupported(e):
+                    raise
+                Log.i('DeviceWatcher', 'host does not push device changes, poll list_devices')
+                self._push = False
+            else:
+                self._push = True
+                self._version = result['version']
+                return result['devices'], True
+        return self.host_driver.list_devices() or [], False
+
+    def _notify(self, changes):
+        try:
+            self.callback(changes)
+        except:
+            Log.e('DeviceWatcher', traceback.format_exc())
@@ -17,34 +17,69 @@
 
 import base64
 import ConfigParser
-from functools import wraps
+import hashlib
+import itertools
 import os
-import socket
 import sys
 import subprocess
 import threading
+import struct
+import time
+import xmlrpclib
+import zlib
 
+from rpc.asyncclient import AsyncRPCClientProxy
+from rpc.cache import get_metadata_cache
+from rpc.cache import SingleFlightCache
+from rpc.client import DriverApiError
+from rpc.client import is_unsupported
+from rpc.client import MultiCall
 from rpc.client import RPCClientProxy
+from rpc.discovery import DeviceWatcher
+from rpc.future import Future
+from rpc.future import gather
+from rpc.future import transfer
+from rpc.metrics import get_registry
+from rpc.resilience import get_breaker
+from rpc.resilience import get_breakers
+from rpc.resilience import ResilientProxy
+from rpc.sandbox import get_sandbox_mirror
+from rpc.supervisor import HostSupervisor
+from rpc.scheduler import DeviceScheduler
+from rpc.scheduler import INSTALL
+from rpc.scheduler import READ
+from rpc.scheduler import scheduled
+from rpc.scheduler import WRITE
 from settings import RESOURCE_PATH
+from util import uitree
+from util.logger import Log
 
 ENCODING = "utf-8"
-
-
-def sync(lockname):
-    '''方法同步锁，保证driverserver的接口一次只访问一个
-    '''
-    
-    def _synched(func):
-        @wraps(func)
-        def _synchronizer(self,*args, **kwargs):
-            tlock = self.__getattribute__(lockname)
-            tlock.acquire()
-            try:
-                return func(self, *args, **kwargs)
-            finally:
-                tlock.release()
-        return _synchronizer
-    return _synched
+# 截屏和控件树的缓存时间（秒），期间没有界面操作时重复的刷新直接使用缓存
+DEFAULT_CACHE_MAX_AGE = 1.0
+# 主机不提供二进制截图时GET请求的状态码
+_UNSUPPORTED_STATUS = (404, 405, 501)
+_IMAGE_SIGNATURES = ('\x89PNG\r\n\x1a\n', '\xff\xd8\xff')
+# 分块读取沙盒文件时每块的大小（字节）
+SANDBOX_CHUNK_SIZE = 512 * 1024
+# 长轮询的RPC超时在主机等待时间之外留出的余量（秒）
+WAIT_MARGIN = 10
+# 心跳请求的超时（秒）
+PING_TIMEOUT = 3
+# 流式获取控件树时每次持有设备读许可期间取出的事件数
+STREAM_BATCH = 1000
+# 等待界面稳定时的最长等待时间、采样间隔的范围（秒），以及判定稳定需要的连续相同截屏数；
+# 最长等待时间与原先界面操作后固定的等待时间相同，界面一直变化(视频等)时不会等得更久
+IDLE_TIMEOUT = 1.5
+IDLE_MIN_INTERVAL = 0.1
+IDLE_MAX_INTERVAL = 0.5
+IDLE_STABLE_SAMPLES = 2
+# 界面仍在变化时采样间隔增长的倍数
+IDLE_BACKOFF = 1.5
+# 两次截屏间变化的像素行不超过此比例时视为相同，忽略光标闪烁、状态栏时钟、加载指示等小范围变化
+IDLE_CHANGED_ROWS = 0.05
+# PNG每种颜色类型每个像素的通道数
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
 
 
 class HostDriver(object):
@@ -52,10 +87,16 @@ class HostDriver(object):
     '''
 
 
-    def __init__(self, host_ip, host_port):
+    def __init__(self, host_ip, host_port, transport=None):
+        '''
+        :param transport: 替代网络请求的Transport，例如回放录制文件的rpc.replay.ReplayTransport
+        '''
         self._host_ip = host_ip
         self._host_url = 'http://%s:%s' % (host_ip, host_port)
-        self._driver = RPCClientProxy('/'.join([self._host_url, 'host/']), allow_none=True, encoding=ENCODING)
+        self._breaker = get_breaker(self._host_url)
+        self._driver = ResilientProxy(RPCClientProxy('/'.join([self._host_url, 'host/']), transport=transport,
+                                                     allow_none=True, encoding=ENCODING),
+                                      self._breaker)
         self._devices = None
         self._qt4i_manage = None
 
@@ -63,6 +104,12 @@ class HostDriver(object):
     def host_url(self):
         return self._host_url
     
+    @property
+    def breaker(self):
+        '''主机的熔断器，可用于展示主机的连接状态
+        '''
+        return self._breaker
+
     @property
     def devices(self):
         return self._devices
@@ -85,91 +132,465 @@ class HostDriver(object):
             raise Exception("Unsupported platform!")
         
     def connect_to_host(self, driver_type):
-        socket.setdefaulttimeout(3)
         is_connected = False
         try:
             is_connected = self._driver.echo()
         except:
             is_connected = self.restart_host_driver(driver_type)
-        finally:
-            socket.setdefaulttimeout(None)  
         return is_connected
     
-    def restart_host_driver(self, driver_type):
-        socket.setdefaulttimeout(3)
+    def restart_host_driver(self, driver_type, progress=None):
+        '''重启本机设备主机上的driver，耗时较长，不应在界面线程中调用
+
+        :param progress: 每一步开始前调用progress(步骤序号, 总步数, 说明)
+        :type progress: callable
+        :returns: bool -- 重启后主机是否可用
+        '''
         is_connected = False
         if sys.platform == 'darwin' and self._host_ip == '127.0.0.1':
             try:
+                steps = []
                 if driver_type == 'instruments':
-                    subprocess.check_call('killall -9 instruments')
+                    steps.append((u'结束instruments进程', lambda: subprocess.check_call('killall -9 instruments')))
                 xctestagent_path = os.path.join(os.path.expanduser('~'), 'XCTestAgent')
                 if driver_type == 'xctest' and not os.path.exists(xctestagent_path):
                     unzip_agent_cmd = '%s setup' % self.qt4i_manage
-                    subprocess.call(unzip_agent_cmd, shell=True)
-                subprocess.call('%s restartdriver -t %s' % (self.qt4i_manage, driver_type), shell=True)
-                self._driver = RPCClientProxy('/'.join([self.host_url, 'host/']), allow_none=True, encoding=ENCODING)
+                    steps.append((u'安装XCTestAgent', lambda: subprocess.call(unzip_agent_cmd, shell=True)))
+                steps.append((u'重启driver', lambda: subprocess.call('%s restartdriver -t %s' % (self.qt4i_manage, driver_type),
+                                                                    shell=True)))
+                for index, (message, func) in enumerate(steps):
+                    if progress:
+                        progress(index, len(steps), message)
+                    func()
+                for breaker in get_breakers(self._host_url):
+                    breaker.reset()
                 is_connected = self._driver.echo()
             except:
                 pass
-        socket.setdefaulttimeout(None)        
         return is_connected
+
+    def ping(self, timeout=PING_TIMEOUT):
+        '''调用echo检查主机是否可用，不经过重试和熔断，用于心跳
+
+        :returns: float -- 往返耗时（秒）
+        :raises: 主机不可用时抛出调用的异常
+        '''
+        start = time.time()
+        self._driver('timeout')(timeout).echo()
+        return time.time() - start
+
+    def supervise(self, driver_type, **kwargs):
+        '''在后台定时检查主机是否可用，见rpc.supervisor.HostSupervisor
+
+        :returns: HostSupervisor -- 已启动的监控，不再需要时调用stop()
+        '''
+        return HostSupervisor(self, driver_type, **kwargs).start()
     
     def list_devices(self):
         self._devices = self._driver.list_devices()
         return self._devices
+
+    def wait_for_devices(self, version, timeout):
+        '''在主机上等待设备列表变化(长轮询)，主机不支持时抛出DriverApiError
+
+        :param version: 上次获得的设备列表版本，None表示立即返回当前列表
+        :param timeout: 主机上的最长等待时间（秒），超时后返回未变化的列表
+        :type timeout: float
+        :returns: dict -- {'version': 版本, 'devices': 设备列表}
+        '''
+        result = self._driver('timeout')(timeout + WAIT_MARGIN).wait_for_devices(version, timeout)
+        self._devices = result['devices']
+        return result
+
+    def watch_devices(self, callback, **kwargs):
+        '''在后台监视设备的插拔和模拟器的启动，见rpc.discovery.DeviceWatcher
+
+        :param callback: 设备变化时的回调函数，参数为DeviceChanges
+        :type callback: callable
+        :returns: DeviceWatcher -- 已启动的监视器，不再需要时调用stop()
+        '''
+        return DeviceWatcher(self, callback, **kwargs).start()
     
     def start_simulator(self, udid):
         self._driver.start_simulator(udid)    
 
 
+def _screen_rows(screenshot):
+    '''截屏中每行像素的摘要，用于比较两次截屏有多少行不同
+
+    非逐行扫描的PNG或其他格式(JPEG)只返回整张图片的摘要，此时只有完全相同才视为相同
+    '''
+    try:
+        return _png_rows(screenshot)
+    except (ValueError, struct.error, zlib.error):
+        return [hashlib.md5(screenshot).digest()]
+
+
+def _png_rows(data):
+    if not data.startswith(_IMAGE_SIGNATURES[0]):
+        raise ValueError('not a png')
+    pos, header, chunks = len(_IMAGE_SIGNATURES[0]), None, []
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        if kind == 'IHDR':
+            header = struct.unpack('>IIBBBBB', data[pos + 8:pos + 21])
+        elif kind == 'IDAT':
+            chunks.append(data[pos + 8:pos + 8 + length])
+        elif kind == 'IEND':
+            break
+        pos += length + 12  # length, type and crc
+    if header is None:
+        raise ValueError('missing IHDR')
+    width, height, depth, color_type, _, _, interlace = header
+    if interlace or color_type not in _PNG_CHANNELS:
+        raise ValueError('unsupported png')
+    # each scanline starts with a filter type byte
+    stride = 1 + (width * depth * _PNG_CHANNELS[color_type] + 7) // 8
+    pixels = zlib.decompress(''.join(chunks))
+    if len(pixels) < stride * height:
+        raise ValueError('truncated png')
+    return [hash(pixels[offset:offset + stride]) for offset in xrange(0, stride * height, stride)]
+
+
+def _changed_rows(rows, other):
+    '''两次截屏中不同的行所占的比例，尺寸不同时为1
+    '''
+    if len(rows) != len(other):
+        return 1.0
+    return sum(1 for row, other_row in itertools.izip(rows, other) if row != other_row) / float(len(rows))
+
+
+class IdleResult(object):
+    '''DeviceDriver.wait_for_idle的结果，界面已稳定时为真
+    '''
+
+    def __init__(self, settled, elapsed, samples, screenshot, interrupted=False):
+        '''
+        :param settled: 是否在超时前稳定
+        :param elapsed: 等待的时间（秒）
+        :param samples: 截屏次数
+        :param screenshot: 最后一次截屏
+        :param interrupted: 是否因wakeup而提前结束
+        '''
+        self.settled = settled
+        self.elapsed = elapsed
+        self.samples = samples
+        self.screenshot = screenshot
+        self.interrupted = interrupted
+
+    def __nonzero__(self):
+        return self.settled
+
+    def __repr__(self):
+        return '<IdleResult settled=%s elapsed=%.3f samples=%d>' % (self.settled, self.elapsed, self.samples)
+
+
 class DeviceDriver(object):
     '''iPhone真机或者模拟器的Driver
     '''
 
-    def __init__(self, host_url, device_udid):
-        self._driver = RPCClientProxy('/'.join([host_url, 'device', '%s/' % device_udid]), allow_none=True, encoding='utf-8')
+    def __init__(self, host_url, device_udid, transport=None, cache_max_age=DEFAULT_CACHE_MAX_AGE,
+                 metadata=None):
+        '''
+        :param transport: 替代网络请求的Transport，例如回放录制文件的rpc.replay.ReplayTransport
+        :param cache_max_age: 截屏、屏幕方向和控件树的缓存时间（秒），None表示直到界面操作前一直有效，
+                              0表示只合并同时发出的相同请求
+        :type cache_max_age: float
+        :param metadata: 版本号和App列表的缓存，默认为所有Driver共用的get_metadata_cache()
+        :type metadata: MetadataCache
+        '''
+        self._driver = ResilientProxy(RPCClientProxy('/'.join([host_url, 'device', '%s/' % device_udid]), transport=transport,
+                                                     allow_none=True, encoding='utf-8'),
+                                      get_breaker(host_url, device_udid))
         self.udid = device_udid
-        self.devicelock = threading.RLock()
+        # 查询可以并发，界面操作独占设备并按顺序执行，见rpc.scheduler
+        self.scheduler = DeviceScheduler(device_udid)
+        self._binary_screenshot = None  # 主机是否支持二进制截图，None表示尚未确定
+        # 并发的相同查询只发一次请求，界面操作会清空缓存
+        self._cache = SingleFlightCache(cache_max_age)
+        self._metadata = metadata or get_metadata_cache()
+        self._tree_delta = None  # 主机是否支持增量控件树，None表示尚未确定
+        self._sandbox_chunks = None  # 主机是否支持分块读取沙盒文件，None表示尚未确定
+        self._tree_lock = threading.Lock()
+        self._last_tree = None  # 最近获取的控件树，增量获取的基准
+        self._tree_hashes = []  # [(控件树, 子树哈希)]，最近使用的在后
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def invalidate_cache(self):
+        '''清空截屏和控件树的缓存，例如App自行改变了界面时
+        '''
+        self._cache.invalidate()
+
+    def invalidate_metadata(self, *names):
+        '''清除缓存的版本号和App列表，例如在UISpy之外安装了App时
+
+        :param names: 要清除的信息，如"app_list"，不指定时全部清除
+        '''
+        self._metadata.invalidate(self.udid, *names)
+
+    def _fetch_screenshot(self):
+        '''以GET device/<udid>/screenshot读取原始图片，省去base64编码和JSON解析，
+        主机不支持时返回None，之后改用capture_screen
+        '''
+        if self._binary_screenshot is False:
+            return None
+        try:
+            content = self._driver('fetch')('screenshot')
+        except xmlrpclib.ProtocolError, e:
+            if self._binary_screenshot or e.errcode not in _UNSUPPORTED_STATUS:
+                raise
+            content = None
+        if self._binary_screenshot is None:
+            self._binary_screenshot = content is not None and content.startswith(_IMAGE_SIGNATURES)
+            if not self._binary_screenshot:
+                Log.i('DeviceDriver', 'host does not serve binary screenshots, use base64')
+                return None
+        return content
         
-    @sync('devicelock')
+    @scheduled(WRITE)
     def start_app(self, bundle_id):
+        with self._cache.invalidating():
+            try:
+                self._driver.device.stop_app(bundle_id)
+            except:
+                pass
+            return self._driver.device.start_app(bundle_id, None, None)
+
+    @scheduled(READ)
+    def take_screenshot(self, max_age=None):
+        '''
+        :param max_age: 可接受的缓存时间（秒），默认为cache_max_age，0表示重新获取
+        :type max_age: float
+        '''
+        return self._cache.get('screenshot', self._take_screenshot, max_age)
+
+    def _take_screenshot(self):
+        content = self._fetch_screenshot()
+        if content is None:
+            content = base64.decodestring(self._driver.device.capture_screen())
+        return content
+
+    def wait_for_idle(self, timeout=IDLE_TIMEOUT, stable_samples=IDLE_STABLE_SAMPLES,
+                      min_interval=IDLE_MIN_INTERVAL, max_interval=IDLE_MAX_INTERVAL, wakeup=None):
+        '''等待界面稳定，用于代替界面操作后固定时间的等待
+
+        反复截屏并逐行比较，变化的行不超过IDLE_CHANGED_ROWS时视为相同，连续stable_samples次
+        相同时返回；界面仍在变化(动画、加载)时采样间隔从min_interval逐渐加大到max_interval，
+        超过timeout后不再等待
+
+        :param timeout: 最长等待时间（秒）
+        :type timeout: float
+        :param wakeup: 被set时立即结束等待，例如又有新的界面操作
+        :type wakeup: threading.Event
+        :returns: IdleResult
+        '''
+        start = time.time()
+        deadline = start + timeout
+        interval = min_interval
+        rows, same, samples, screenshot = None, 0, 0, None
+        settled = interrupted = False
+        while True:
+            screenshot = self.take_screenshot(max_age=0)
+            samples += 1
+            current = _screen_rows(screenshot)
+            if rows is not None and _changed_rows(rows, current) <= IDLE_CHANGED_ROWS:
+                same += 1
+            else:
+                if rows is not None:
+                    interval = min(interval * IDLE_BACKOFF, max_interval)
+                same = 1
+            rows = current
+            if same >= stable_samples:
+                settled = True
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if wakeup is None:
+                time.sleep(min(interval, remaining))
+                continue
+            wakeup.wait(min(interval, remaining))
+            if wakeup.is_set():
+                interrupted = True
+                break
+        elapsed = time.time() - start
+        if not interrupted:
+            get_registry().record_call('DeviceDriver.wait_for_idle', elapsed, error=not settled)
+        return IdleResult(settled, elapsed, samples, screenshot, interrupted)
+
+    @scheduled(READ)
+    def get_element_tree(self, max_age=None):
+        '''返回的控件树可能与其他调用者共享
+        '''
+        return self._cache.get('element_tree', self._fetch_element_tree, max_age)
+
+    @scheduled(READ)
+    def get_element_tree_update(self, base, max_age=None):
+        '''获取控件树以及相对base的变化，可以只更新界面上变化的部分
+
+        :param base: 之前获取的控件树，None表示没有
+        :type base: dict
+        :returns: tuple -- (控件树, patch)，patch的格式见util.uitree.diff_trees，base为None时patch为None
+        '''
+        tree = self.get_element_tree(max_age)
+        return tree, self.diff_element_tree(base, tree)
+
+    def diff_element_tree(self, base, tree):
+        '''比较两次获取的控件树
+
+        :returns: list -- util.uitree.diff_trees的结果，base为None时返回None
+        '''
+        if base is None:
+            return None
+        return uitree.diff_trees(base, tree, self._hashes(base), self._hashes(tree))
+
+    def _fetch_element_tree(self):
+        base, method, params = self._tree_request()
+        return self._receive_tree(lambda: getattr(self._driver.device, method)(*params), base)
+
+    def _tree_request(self):
+        # the call fetching the element tree: (base, method, params), the host
+        # is asked for the subtrees changed since base when it supports it
+        with self._tree_lock:
+            base = self._last_tree if self._tree_delta is not False else None
+        if base is None:
+            return None, 'get_element_tree', ()
+        return base, 'get_element_tree_delta', (uitree.known_hashes(base, self._hashes(base)),)
+
+    def _receive_tree(self, get_result, base):
         try:
-            self._driver.device.stop_app(bundle_id)
-        except:
-            pass
-        return self._driver.device.start_app(bundle_id, None, None) 
-    
-    @sync('devicelock')
-    def take_screenshot(self):
-        base64_img = self._driver.device.capture_screen()
-        return base64.decodestring(base64_img)
-    
-    @sync('devicelock')
-    def get_element_tree(self):
-        return self._driver.device.get_element_tree()
+            result = get_result()
+        except DriverApiError, e:
+            # only a missing method means an older host, timeouts and other errors are raised as is
+            if base is None or self._tree_delta or not is_unsupported(e):
+                raise
+            Log.i('DeviceDriver', 'host does not support incremental element trees')
+            self._tree_delta = False
+            result, base = self._driver.device.get_element_tree(), None
+        hashes = None
+        if base is None:
+            tree = result
+        else:
+            self._tree_delta = True
+            base_hashes = self._hashes(base)
+            tree = uitree.resolve_references(result, uitree.index_by_hash(base, base_hashes))
+            hashes = uitree.hash_tree(tree, base_hashes)
+        with self._tree_lock:
+            self._last_tree = tree
+            if hashes is not None:
+                self._remember_hashes(tree, hashes)
+        return tree
+
+    def _hashes(self, tree):
+        with self._tree_lock:
+            for index, (known_tree, hashes) in enumerate(self._tree_hashes):
+                if known_tree is tree:
+                    self._tree_hashes.append(self._tree_hashes.pop(index))
+                    return hashes
+        hashes = uitree.hash_tree(tree)
+        with self._tree_lock:
+            self._remember_hashes(tree, hashes)
+        return hashes
+
+    def _remember_hashes(self, tree, hashes):
+        # keep the trees alive with their hashes, so that the ids stay valid
+        self._tree_hashes.append((tree, hashes))
+        del self._tree_hashes[:-4]
+
+    def stream_element_tree(self):
+        '''以事件流的形式获取控件树，不必等待整棵树传输完毕即可开始处理
+
+        :returns: iterator -- (prefix, event, value)，prefix为相对控件树根节点的路径，
+                  例如"children.item.classname"，可配合rpc.client.iteritems使用
+        '''
+        # READ is only held while events are pulled from the response, not across yield:
+        # the consumer may call other methods of the driver between items, and a stream
+        # that is abandoned must not keep the device locked
+        events = iter(self._driver('stream')('device.get_element_tree'))
+        while True:
+            start = time.time()
+            with self.scheduler.acquire(READ):
+                get_registry().record_lock_wait('DeviceDriver.stream_element_tree', time.time() - start)
+                batch = list(itertools.islice(events, STREAM_BATCH))
+            for prefix, event, value in batch:
+                if prefix == 'result.item' or prefix.startswith('result.item.'):
+                    yield prefix[len('result.item.'):], event, value
+            if len(batch) < STREAM_BATCH:
+                return
+
+    @scheduled(READ)
+    def snapshot(self, max_age=None, base=None, screenshot=None):
+        '''一次往返同时获取截屏、屏幕方向和控件树，结果同时用于take_screenshot等方法的缓存
+
+        :param max_age: 可接受的缓存时间（秒），默认为cache_max_age，0表示重新获取
+        :type max_age: float
+        :param base: 之前获取的控件树，指定时结果中包括相对它的变化'patch'
+        :type base: dict
+        :param screenshot: 刚获取的截图数据(例如IdleResult.screenshot)，指定时不再重新截屏
+        :type screenshot: str
+        :returns: dict -- {'screenshot': 截图数据, 'orientation': 屏幕方向, 'element_tree': 控件树}
+        '''
+        # the keys of a snapshot are the cache keys of its parts
+        snapshot = self._cache.get('snapshot', lambda: self._snapshot(screenshot), max_age,
+                                   related=lambda snapshot: snapshot)
+        if base is None:
+            return snapshot
+        snapshot = dict(snapshot)
+        snapshot['patch'] = self.diff_element_tree(base, snapshot['element_tree'])
+        return snapshot
+
+    def _snapshot(self, screenshot=None):
+        if screenshot is None:
+            screenshot = self._fetch_screenshot()
+        multicall = MultiCall(self._driver)
+        if screenshot is None:
+            multicall.device.capture_screen()
+        multicall.device.get_screen_orientation()
+        base, method, params = self._tree_request()
+        getattr(multicall.device, method)(*params)
+        results = multicall()
+        if screenshot is None:
+            screenshot = base64.decodestring(results[0])
+        orientation = results[len(results) - 2]
+        element_tree = self._receive_tree(lambda: results[len(results) - 1], base)
+        return {'screenshot': screenshot,
+                'orientation': orientation,
+                'element_tree': element_tree}
     
-    @sync('devicelock')
+    @scheduled(INSTALL)
     def install_app(self, ipa_path):
-        return self._driver.device.install(ipa_path)
+        with self._cache.invalidating():
+            try:
+                return self._driver.device.install(ipa_path)
+            finally:
+                self._metadata.invalidate(self.udid, 'app_list')
     
-    @sync('devicelock')
+    @scheduled(INSTALL)
     def uninstall_app(self, bundle_id):
-        return self._driver.device.uninstall(bundle_id)
+        with self._cache.invalidating():
+            try:
+                return self._driver.device.uninstall(bundle_id)
+            finally:
+                self._metadata.invalidate(self.udid, 'app_list')
     
-    @sync('devicelock')
-    def get_screen_orientation(self):
-        return self._driver.device.get_screen_orientation()
+    @scheduled(READ)
+    def get_screen_orientation(self, max_age=None):
+        return self._cache.get('orientation', self._driver.device.get_screen_orientation, max_age)
     
-    @sync('devicelock')
+    @scheduled(READ)
     def get_app_list(self, app_type="user"):
         '''获取设备上的app列表
         :param app_type: app的类型(user/system/all)
         :type app_type: str 
         :returns: list  例如:[{'com.tencent.rdm': 'RDM'}]
         '''   
-        return self._driver.device.get_app_list(app_type)
+        return self._metadata.get(self.udid, 'app_list:%s' % app_type,
+                                  lambda: self._driver.device.get_app_list(app_type))
     
-    @sync('devicelock')
+    @scheduled(WRITE)
     def click(self, x, y, retry = 3):
         '''
         基于屏幕的点击操作
@@ -177,20 +598,23 @@ class DeviceDriver(object):
         :type x: float
         :param y: 纵向坐标（从上向下，屏幕百分比）
         :type y: float
-        :param retry 重试次数
+        :param retry 重试次数，仅在请求确定未送达设备主机时重试，避免重复点击
         :type int
         '''
-        self._driver.device.click(x, y)
+        with self._cache.invalidating():
+            self._driver('retry')(retry).device.click(x, y)
     
-    @sync('devicelock')    
+    @scheduled(WRITE)
     def double_click(self, x, y):
-        self._driver.device.double_click(x, y)
+        with self._cache.invalidating():
+            self._driver.device.double_click(x, y)
         
-    @sync('devicelock')
+    @scheduled(WRITE)
     def long_click(self, x, y, duration=3):
-        self._driver.device.long_click(x, y, duration)
+        with self._cache.invalidating():
+            self._driver.device.long_click(x, y, duration)
     
-    @sync('devicelock')          
+    @scheduled(WRITE)
     def drag(self, x0, y0, x1, y1, duration=0, repeat=1, interval=0.5, velocity=1000, retry = 3):
         '''拖拽（全局操作）
         :param x0: 起始横向坐标（从左向右，屏幕百分比）
@@ -203,14 +627,18 @@ class DeviceDriver(object):
         :type y1: float
         :param duration: 起始坐标按下的时间（秒）
         :type duration: float
+        :param retry 重试次数，仅在请求确定未送达设备主机时重试
+        :type int
         '''
-        self._driver.device.drag(x0, y0, x1, y1, duration, repeat, interval, velocity)
+        with self._cache.invalidating():
+            self._driver('retry')(retry).device.drag(x0, y0, x1, y1, duration, repeat, interval, velocity)
     
-    @sync('devicelock')
+    @scheduled(WRITE)
     def sendkeys(self, text):
-        self._driver.device.send_keys(text)
+        with self._cache.invalidating():
+            self._driver.device.send_keys(text)
 
-    @sync('devicelock')   
+    @scheduled(READ)
     def get_sandbox_path_files(self, bundle_id, file_path):
         '''返回真机或者模拟器的沙盒路径
         
@@ -221,7 +649,7 @@ class DeviceDriver(object):
         '''
         return self._driver.device.get_sandbox_path_files(bundle_id, file_path)
     
-    @sync('devicelock')
+    @scheduled(READ)
     def is_sandbox_path_dir(self, bundle_id, file_path):
         '''判断一个sandbox路径是否是一个目录
         
@@ -232,7 +660,7 @@ class DeviceDriver(object):
         '''
         return self._driver.device.is_sandbox_path_dir(bundle_id, file_path)
     
-    @sync('devicelock')
+    @scheduled(READ)
     def get_sandbox_file_content(self, bundle_id, file_path):
         '''获取sandbox中文本文件的内容
         
@@ -242,24 +670,270 @@ class DeviceDriver(object):
         :type file_path: str
         '''
         return self._driver.device.get_sandbox_file_content(bundle_id, file_path)
+
+    @scheduled(READ)
+    def get_sandbox_file_info(self, bundle_id, file_path):
+        '''获取sandbox中文件或目录的大小和修改时间，主机不支持时返回None
+
+        :returns: dict -- {'size': 字节数, 'mtime': 修改时间}
+        '''
+        if self._sandbox_chunks is False:
+            return None
+        try:
+            return self._driver.device.get_sandbox_file_info(bundle_id, file_path)
+        except DriverApiError, e:
+            # timeouts, an open circuit or a missing file say nothing about the host's support
+            if self._sandbox_chunks or not is_unsupported(e):
+                raise
+            return None
+
+    @scheduled(READ)
+    def get_sandbox_file_infos(self, bundle_id, file_paths):
+        '''一次往返获取多个文件或目录的大小和修改时间，主机不支持时返回None
+
+        :param file_paths: 路径列表
+        :type file_paths: list
+        :returns: list -- 与file_paths对应的{'size', 'mtime'}，路径不存在时为None
+        '''
+        if self._sandbox_chunks is False:
+            return None
+        multicall = MultiCall(self._driver)
+        for file_path in file_paths:
+            multicall.device.get_sandbox_file_info(bundle_id, file_path)
+        results = multicall().results
+        if not self._sandbox_chunks and results and all(is_unsupported(result) for result in results):
+            return None
+        return [None if isinstance(result, DriverApiError) else result for result in results]
+
+    @scheduled(READ)
+    def read_sandbox_file(self, bundle_id, file_path, offset, length):
+        '''读取sandbox中文件的一段内容
+
+        :param offset: 起始位置
+        :type offset: int
+        :param length: 最多读取的字节数
+        :type length: int
+        :returns: str -- 文件内容，到达文件末尾时少于length
+        '''
+        return base64.b64decode(self._driver.device.read_sandbox_file(bundle_id, file_path, offset, length))
+
+    def download_sandbox_file(self, bundle_id, file_path, mirror=None, chunk_size=SANDBOX_CHUNK_SIZE,
+                              progress=None):
+        '''把sandbox中的文件下载到本地镜像，文件未变化时直接返回镜像中的文件
+
+        分块读取，每块解码后立即写入文件，内存占用不随文件大小增长；中断的下载在下次调用时
+        从已下载的位置继续。每块单独调度，下载期间界面操作不会被阻塞。
+
+        :param mirror: 本地镜像，默认为所有Driver共用的镜像
+        :type mirror: SandboxMirror
+        :param chunk_size: 每次读取的字节数
+        :type chunk_size: int
+        :param progress: progress(已下载字节数, 总字节数)，返回False时中止下载
+        :type progress: callable
+        :returns: str -- 本地文件路径，中止时为None
+        '''
+        mirror = mirror or get_sandbox_mirror()
+        info = self.get_sandbox_file_info(bundle_id, file_path)
+        if info is None:
+            # 主机只支持一次读取整个文件
+            content = base64.b64decode(self.get_sandbox_file_content(bundle_id, file_path))
+            if self._sandbox_chunks is None:
+                Log.i('DeviceDriver', 'host does not support chunked sandbox reads')
+                self._sandbox_chunks = False
+            with mirror.downloading(self.udid, bundle_id, file_path):
+                entry = mirror.lookup(self.udid, bundle_id, file_path, len(content), None)
+                with entry.open_part() as fd:
+                    fd.write(content)
+                entry.finish()
+            if progress:
+                progress(len(content), len(content))
+            return entry.path
+        self._sandbox_chunks = True
+        # 同时下载同一文件时后一个等前一个完成，通常直接使用其结果
+        with mirror.downloading(self.udid, bundle_id, file_path):
+            return self._download_chunks(mirror, bundle_id, file_path, info, chunk_size, progress)
+
+    def _download_chunks(self, mirror, bundle_id, file_path, info, chunk_size, progress):
+        entry = mirror.lookup(self.udid, bundle_id, file_path, info['size'], info['mtime'])
+        if entry.complete:
+            return entry.path
+        offset = entry.downloaded
+        with entry.open_part() as fd:
+            while offset < entry.size:
+                if progress and progress(offset, entry.size) is False:
+                    return None
+                data = self.read_sandbox_file(bundle_id, file_path, offset, min(chunk_size, entry.size - offset))
+                if not data:
+                    break
+                fd.write(data)
+                offset += len(data)
+        if offset != entry.size:
+            # 下载期间文件被截短，下次重新下载
+            mirror.lookup(self.udid, bundle_id, file_path, offset, None)
+            raise IOError('%s changed while downloading' % file_path)
+        if progress:
+            progress(offset, entry.size)
+        entry.finish()
+        return entry.path
     
-    @sync('devicelock')
+    @scheduled(WRITE)
     def close_sandbox_client(self):
         '''销毁sandboxClient对象
         '''
         self._driver.device.close_sandbox_client()
     
-    @sync('devicelock')
+    @scheduled(READ)
     def get_xcode_version(self):
         '''查询Xcode版本
         
         '''
-        return self._driver.device.get_xcode_version()
+        return self._metadata.get(self.udid, 'xcode_version', self._driver.device.get_xcode_version)
 
-    @sync('devicelock')
+    @scheduled(READ)
     def get_ios_version(self):
         '''查询ios版本
         
         '''
-        return self._driver.device.get_ios_version()
-    
\ No newline at end of file
+        return self._metadata.get(self.udid, 'ios_version', self._driver.device.get_ios_version)
+
+    @scheduled(READ)
+    def get_versions(self):
+        '''一次往返查询Xcode版本和ios版本
+
+        :returns: tuple -- (xcode_version, ios_version)
+        '''
+        def _get_versions():
+            multicall = MultiCall(self._driver)
+            multicall.device.get_xcode_version()
+            multicall.device.get_ios_version()
+            return tuple(multicall())
+        return tuple(self._metadata.get(self.udid, 'versions', _get_versions,
+                                        lambda versions: {'xcode_version': versions[0],
+                                                          'ios_version': versions[1]}))
+
+
+class AsyncDeviceDriver(object):
+    '''iPhone真机或者模拟器的异步Driver，提供DeviceDriver中常用的设备操作和查询，参数和结果与
+    DeviceDriver的同名方法一致，每个方法立即返回Future；缓存、沙盒下载和等待界面稳定等只在DeviceDriver中提供
+
+    改变设备状态的操作(点击、拖拽、启动App等)按提交顺序依次执行，查询操作在之前提交的
+    操作完成后并发执行
+    '''
+
+    def __init__(self, host_url, device_udid, **kwargs):
+        self._driver = AsyncRPCClientProxy('/'.join([host_url, 'device', '%s/' % device_udid]), **kwargs)
+        self.udid = device_udid
+        self._order_lock = threading.Lock()
+        self._last_ordered = None
+
+    def _ordered(self, func):
+        '''前一个有序操作完成后再调用func，func返回Future
+        '''
+        result = Future()
+        with self._order_lock:
+            previous, self._last_ordered = self._last_ordered, result
+        self._run_after(previous, func, result)
+        return result
+
+    def _query(self, func):
+        '''在已提交的有序操作完成后调用func，查询之间不互相等待
+        '''
+        result = Future()
+        with self._order_lock:
+            previous = self._last_ordered
+        self._run_after(previous, func, result)
+        return result
+
+    def _run_after(self, previous, func, result):
+        def _start(_=None):
+            if result.cancelled():
+                return
+            try:
+                inner = func()
+            except Exception, e:
+                result.set_exception(e, sys.exc_info()[2])
+                return
+            result.set_cancel_handler(lambda _: inner.cancel())
+            transfer(inner, result)
+        if previous is None or previous.done():
+            _start()
+        else:
+            previous.add_done_callback(_start)
+
+    def start_app(self, bundle_id):
+        def _start_app():
+            started = Future()
+            def _on_stopped(_):
+                transfer(self._driver.device.start_app(bundle_id, None, None), started)
+            self._driver.device.stop_app(bundle_id).add_done_callback(_on_stopped)
+            return started
+        return self._ordered(_start_app)
+
+    def take_screenshot(self):
+        return self._query(lambda: self._driver.device.capture_screen().then(base64.decodestring))
+
+    def get_element_tree(self):
+        return self._query(lambda: self._driver.device.get_element_tree())
+
+    def snapshot(self):
+        '''并发获取截屏、屏幕方向和控件树，结果格式与DeviceDriver.snapshot一致
+        '''
+        def _snapshot():
+            futures = [self._driver.device.capture_screen(),
+                       self._driver.device.get_screen_orientation(),
+                       self._driver.device.get_element_tree()]
+            return gather(futures).then(lambda results: {'screenshot': base64.decodestring(results[0]),
+                                                         'orientation': results[1],
+                                                         'element_tree': results[2]})
+        return self._query(_snapshot)
+
+    def install_app(self, ipa_path):
+        return self._ordered(lambda: self._driver.device.install(ipa_path))
+
+    def uninstall_app(self, bundle_id):
+        return self._ordered(lambda: self._driver.device.uninstall(bundle_id))
+
+    def get_screen_orientation(self):
+        return self._query(lambda: self._driver.device.get_screen_orientation())
+
+    def get_app_list(self, app_type="user"):
+        return self._query(lambda: self._driver.device.get_app_list(app_type))
+
+    def click(self, x, y):
+        return self._ordered(lambda: self._driver.device.click(x, y))
+
+    def double_click(self, x, y):
+        return self._ordered(lambda: self._driver.device.double_click(x, y))
+
+    def long_click(self, x, y, duration=3):
+        return self._ordered(lambda: self._driver.device.long_click(x, y, duration))
+
+    def drag(self, x0, y0, x1, y1, duration=0, repeat=1, interval=0.5, velocity=1000):
+        return self._ordered(lambda: self._driver.device.drag(x0, y0, x1, y1, duration, repeat, interval, velocity))
+
+    def sendkeys(self, text):
+        return self._ordered(lambda: self._driver.device.send_keys(text))
+
+    def get_sandbox_path_files(self, bundle_id, file_path):
+        return self._query(lambda: self._driver.device.get_sandbox_path_files(bundle_id, file_path))
+
+    def is_sandbox_path_dir(self, bundle_id, file_path):
+        return self._query(lambda: self._driver.device.is_sandbox_path_dir(bundle_id, file_path))
+
+    def get_sandbox_file_content(self, bundle_id, file_path):
+        return self._query(lambda: self._driver.device.get_sandbox_file_content(bundle_id, file_path))
+
+    def close_sandbox_client(self):
+        return self._ordered(lambda: self._driver.device.close_sandbox_client())
+
+    def get_xcode_version(self):
+        return self._query(lambda: self._driver.device.get_xcode_version())
+
+    def get_ios_version(self):
+        return self._query(lambda: self._driver.device.get_ios_version())
+
+    def get_versions(self):
+        '''并发查询Xcode版本和ios版本，结果为(xcode_version, ios_version)
+        '''
+        return self._query(lambda: gather([self._driver.device.get_xcode_version(),
+                                           self._driver.device.get_ios_version()]).then(tuple))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''异步调用结果
+'''
+
+import sys
+import threading
+import time
+
+from util.logger import Log
+
+
+class CancelledError(Exception):
+    '''调用已被取消
+    '''
+
+
+class FutureTimeoutError(Exception):
+    '''等待调用结果超时
+    '''
+
+
+class Future(object):
+    '''异步调用的结果(线程安全)
+
+    回调函数在设置结果的线程中执行，不应在回调中做耗时操作
+    '''
+    PENDING, RUNNING, CANCELLED, FINISHED = ('pending', 'running', 'cancelled', 'finished')
+
+    def __init__(self):
+        self._state = Future.PENDING
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._cancel_handler = None
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return '<Future %s>' % self._state
+
+    def cancel(self):
+        '''取消调用，已经完成的调用无法取消
+
+        :returns: bool -- 是否取消成功
+        '''
+        with self._cond:
+            if self._state in (Future.FINISHED, Future.CANCELLED):
+                return self._state == Future.CANCELLED
+            self._state = Future.CANCELLED
+            self._cond.notify_all()
+            handler = self._cancel_handler
+        if handler:
+            handler(self)
+        self._invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == Future.CANCELLED
+
+    def running(self):
+        return self._state == Future.RUNNING
+
+    def done(self):
+        return self._state in (Future.FINISHED, Future.CANCELLED)
+
+    def set_cancel_handler(self, handler):
+        '''设置取消时的处理函数，用于从发送队列中移除未发出的调用
+        '''
+        self._cancel_handler = handler
+
+    def set_running(self):
+        '''标记调用开始执行
+
+        :returns: bool -- False表示调用已被取消，不应再执行
+        '''
+        with self._cond:
+            if self._state == Future.CANCELLED:
+                return False
+            self._state = Future.RUNNING
+            return True
+
+    def set_result(self, result):
+        with self._cond:
+            if self.done():
+                return
+            self._result = result
+            self._state = Future.FINISHED
+            self._cond.notify_all()
+        self._invoke_callbacks()
+
+    def set_exception(self, exception, traceback=None):
+        with self._cond:
+            if self.done():
+                return
+            self._exc_info = (type(exception), exception, traceback)
+            self._state = Future.FINISHED
+            self._cond.notify_all()
+        self._invoke_callbacks()
+
+    def result(self, timeout=None):
+        '''等待并返回调用结果，调用失败时抛出对应的异常
+
+        :param timeout: 最长等待时间（秒），None表示一直等待
+        :type timeout: float
+        '''
+        self._wait(timeout)
+        if self._state == Future.CANCELLED:
+            raise CancelledError()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._state == Future.CANCELLED:
+            raise CancelledError()
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, func):
+        '''添加完成回调，已完成时立即调用
+
+        :param func: 回调函数，参数为当前Future
+        :type func: callable
+        '''
+        with self._cond:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        self._call(func)
+
+    def then(self, func):
+        '''返回一个新的Future，其结果为func(当前结果)
+        '''
+        chained = Future()
+        chained.set_cancel_handler(lambda _: self.cancel())
+
+        def _on_done(future):
+            if future.cancelled():
+                chained.cancel()
+                return
+            if future._exc_info:
+                chained.set_exception(future._exc_info[1], future._exc_info[2])
+                return
+            try:
+                chained.set_result(func(future._result))
+            except:
+                exc_info = sys.exc_info()
+                chained.set_exception(exc_info[1], exc_info[2])
+        self.add_done_callback(_on_done)
+        return chained
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self.done():
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise FutureTimeoutError()
+                    self._cond.wait(remaining)
+
+    def _invoke_callbacks(self):
+        with self._cond:
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            self._call(func)
+
+    def _call(self, func):
+        try:
+            func(self)
+        except:
+            import traceback
+            Log.e('Future', traceback.format_exc())
+
+
+def gather(futures):
+    '''合并多个Future，全部成功后结果为按顺序排列的结果列表，任一失败则以该异常结束
+
+    :param futures: Future列表
+    :type futures: list
+    :returns: Future
+    '''
+    combined = Future()
+    combined.set_cancel_handler(lambda _: [future.cancel() for future in futures])
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _on_done(index, future):
+        if future.cancelled():
+            combined.cancel()
+            return
+        if future._exc_info:
+            combined.set_exception(future._exc_info[1], future._exc_info[2])
+            return
+        with lock:
+            results[index] = future._result
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            combined.set_result(results)
+
+    if not futures:
+        combined.set_result([])
+    for index, future in enumerate(futures):
+        future.add_done_callback(lambda f, index=index: _on_done(index, f))
+    return combined
+
+
+def transfer(source, target):
+    '''source完成后将其结果、异常或取消状态转移到target
+    '''
+    def _on_done(future):
+        if future.cancelled():
+            target.cancel()
+        elif future._exc_info:
+            target.set_exception(future._exc_info[1], future._exc_info[2])
+        else:
+            target.set_result(future._result)
+    source.add_done_callback(_on_done)
+
+
+def wait_all(futures, timeout=None):
+    '''等待所有Future完成
+
+    :param futures: Future列表
+    :type futures: list
+    :param timeout: 最长等待时间（秒）
+    :type timeout: float
+    :returns: list -- 未完成的Future
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    for future in futures:
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        try:
+            future._wait(remaining)
+        except FutureTimeoutError:
+            break
+    return [future for future in futures if not future.done()]
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''远程控制的手势队列
+
+手势提交后立即返回Future，由后台线程按提交顺序发送到设备；最后一个手势发出后
+等待界面稳定(DeviceDriver.wait_for_idle)，期间没有新的手势时才通知刷新一次，连续点击
+只刷新一次控件树。
+
+用法:
+    queue = GestureQueue(driver, on_idle=lambda count, idle: refresh())
+    future = queue.click(0.5, 0.5)
+'''
+
+import collections
+import sys
+import threading
+import traceback
+
+from rpc.future import Future
+from util.logger import Log
+
+
+# 手势发出后等待界面稳定的最长时间（秒），期间的新手势合并为一次刷新
+SETTLE_TIMEOUT = 1.5
+
+
+class GestureQueue(object):
+    '''单台设备的手势队列(线程安全)
+    '''
+
+    def __init__(self, device_driver, on_idle=None, settle_timeout=SETTLE_TIMEOUT):
+        '''
+        :param device_driver: 设备的Driver
+        :type device_driver: DeviceDriver
+        :param on_idle: 一批手势发送完且界面稳定后调用on_idle(手势数, IdleResult)，在队列线程中执行；
+                        检测界面是否稳定失败时IdleResult为None
+        :type on_idle: callable
+        :param settle_timeout: 最后一个手势发出后等待界面稳定的最长时间（秒）
+        :type settle_timeout: float
+        '''
+        self.driver = device_driver
+        self.on_idle = on_idle
+        self.settle_timeout = settle_timeout
+        self.sent = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._queue = collections.deque()  # [(Future, func, args, kwargs)]
+        self._unsettled = 0  # 上次通知刷新后发出的手势数
+        self._wakeup = threading.Event()  # 等待界面稳定时有新的手势
+        self._thread = None
+        self._closed = False
+
+    def click(self, x, y):
+        return self.submit(self.driver.click, x, y)
+
+    def double_click(self, x, y):
+        return self.submit(self.driver.double_click, x, y)
+
+    def long_click(self, x, y, duration=3):
+        return self.submit(self.driver.long_click, x, y, duration)
+
+    def drag(self, x0, y0, x1, y1, duration=0, repeat=1, interval=0.5, velocity=1000):
+        return self.submit(self.driver.drag, x0, y0, x1, y1, duration, repeat, interval, velocity)
+
+    def sendkeys(self, text):
+        return self.submit(self.driver.sendkeys, text)
+
+    def submit(self, func, *args, **kwargs):
+        '''把func(*args, **kwargs)加入队列，立即返回
+
+        :returns: Future -- 手势的执行结果，未发出前可以取消；队列已关闭时返回已取消的Future
+        '''
+        future = Future()
+        with self._lock:
+            if self._closed:
+                future.cancel()
+                return future
+            future.set_cancel_handler(self._discard)
+            self._queue.append((future, func, args, kwargs))
+            self._wakeup.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='GestureQueue-%s' % self.driver.udid)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        return future
+
+    @property
+    def pending(self):
+        '''尚未发出的手势数
+        '''
+        with self._lock:
+            return len(self._queue)
+
+    def close(self):
+        '''取消所有未发出的手势，之后提交的手势直接取消
+        '''
+        with self._lock:
+            self._closed = True
+            tasks, self._queue = list(self._queue), collections.deque()
+            self._wakeup.set()
+        for future, _, _, _ in tasks:
+            future.cancel()
+
+    def _discard(self, future):
+        with self._lock:
+            for task in self._queue:
+                if task[0] is future:
+                    self._queue.remove(task)
+                    break
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queue:
+                    task = self._queue.popleft()
+                elif self._closed or not self._unsettled:
+                    self._unsettled = 0
+                    self._thread = None
+                    return
+                else:
+                    task = None
+                    self._wakeup.clear()
+            if task is None:
+                self._settle()
+                continue
+            future, func, args, kwargs = task
+            if not future.set_running():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception, e:
+                Log.w('GestureQueue', 'gesture %s%r failed: %s' % (func.__name__, args, e))
+                future.set_exception(e, sys.exc_info()[2])
+            with self._lock:
+                self.sent += 1
+                self._unsettled += 1
+
+    def _settle(self):
+        # 等待界面稳定，期间提交的手势打断等待并继续发送，刷新推迟到最后一个手势之后
+        try:
+            idle = self.driver.wait_for_idle(self.settle_timeout, wakeup=self._wakeup)
+        except Exception, e:
+            Log.w('GestureQueue', 'failed to wait for idle: %s' % e)
+            idle = None
+        with self._lock:
+            if self._queue or self._closed:
+                return
+            count, self._unsettled = self._unsettled, 0
+        self.refreshes += 1
+        if self.on_idle is None:
+            return
+        try:
+            self.on_idle(count, idle)
+        except:
+            Log.e('GestureQueue', traceback.format_exc())
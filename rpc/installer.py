@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''在多台设备上批量安装App
+
+用法:
+    installer = BatchInstaller(pool, '/path/to/app.ipa', udids, callback=on_progress)
+    report = installer.start().result()
+    print report.format()
+'''
+
+import collections
+import threading
+import time
+import traceback
+
+from rpc.future import Future
+from util.logger import Log
+
+
+# 同一主机上同时安装的设备数，安装时主机需要解压和传输安装包，并发过多反而更慢
+DEFAULT_PER_HOST = 2
+# 安装失败后的重试次数
+DEFAULT_RETRIES = 1
+# 第一次重试前等待的时间（秒），之后每次加倍
+RETRY_DELAY = 2.0
+
+
+class InstallTask(object):
+    '''单台设备的安装进度
+    '''
+    QUEUED, INSTALLING, WAITING_RETRY, SUCCEEDED, FAILED, CANCELLED = (
+        'queued', 'installing', 'waiting_retry', 'succeeded', 'failed', 'cancelled')
+
+    def __init__(self, udid, name, host_url):
+        self.udid = udid
+        self.name = name
+        self.host_url = host_url
+        self.state = InstallTask.QUEUED
+        self.attempts = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.state in (InstallTask.SUCCEEDED, InstallTask.FAILED, InstallTask.CANCELLED)
+
+    @property
+    def elapsed(self):
+        '''从开始安装到结束(或者到现在)的时间（秒），尚未开始时为0
+        '''
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def error_summary(self):
+        '''错误信息的最后一行，主机返回的错误包含调用栈时只保留异常本身
+        '''
+        lines = [line for line in (self.error or '').splitlines() if line.strip()]
+        return lines[-1].strip() if lines else ''
+
+    def __repr__(self):
+        return '<InstallTask %s %s>' % (self.udid, self.state)
+
+
+class InstallReport(object):
+    '''批量安装的结果
+    '''
+
+    def __init__(self, pkg_path, tasks, elapsed):
+        self.pkg_path = pkg_path
+        self.tasks = tasks
+        self.elapsed = elapsed
+
+    def _with_state(self, state):
+        return [task for task in self.tasks if task.state == state]
+
+    @property
+    def succeeded(self):
+        return self._with_state(InstallTask.SUCCEEDED)
+
+    @property
+    def failed(self):
+        return self._with_state(InstallTask.FAILED)
+
+    @property
+    def cancelled(self):
+        return self._with_state(InstallTask.CANCELLED)
+
+    def format(self):
+        '''格式化为文本，每台设备一行
+        '''
+        lines = ['install %s on %d devices in %.1fs: %d succeeded, %d failed, %d cancelled' % (
+            self.pkg_path, len(self.tasks), self.elapsed,
+            len(self.succeeded), len(self.failed), len(self.cancelled))]
+        for task in self.tasks:
+            lines.append('%-42s %-10s %2d attempts %7.1fs  %s' % (
+                task.udid, task.state, task.attempts, task.elapsed, task.error_summary))
+        return '\n'.join(lines)
+
+
+class BatchInstaller(object):
+    '''在多台设备上并发安装同一个安装包
+
+    每台主机各自排队，同一主机同时安装的设备数不超过per_host，一台主机上的设备多也不会
+    阻塞其他主机；安装失败的设备等待一段时间后重试。安装包路径为设备主机上的路径，与
+    DeviceDriver.install_app一致
+    '''
+
+    def __init__(self, device_pool, pkg_path, udids, per_host=DEFAULT_PER_HOST, retries=DEFAULT_RETRIES,
+                 retry_delay=RETRY_DELAY, callback=None):
+        '''
+        :param device_pool: 设备所在的DevicePool
+        :type device_pool: DevicePool
+        :param pkg_path: 安装包路径(真机为.ipa，模拟器为.zip)
+        :type pkg_path: str
+        :param udids: 要安装的设备
+        :type udids: list
+        :param per_host: 同一主机上同时安装的设备数
+        :type per_host: int
+        :param retries: 每台设备失败后的重试次数
+        :type retries: int
+        :param retry_delay: 第一次重试前等待的时间（秒），之后每次加倍
+        :type retry_delay: float
+        :param callback: 设备的安装状态变化时调用callback(InstallTask)，在安装线程中执行
+        :type callback: callable
+        '''
+        self.pool = device_pool
+        self.pkg_path = pkg_path
+        self.per_host = per_host
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.callback = callback
+        devices = dict((device['udid'], device) for device in device_pool.devices())
+        self.tasks = [InstallTask(udid, devices.get(udid, {}).get('name', udid), devices.get(udid, {}).get('host_url'))
+                      for udid in udids]
+        self._future = Future()
+        self._future.set_cancel_handler(lambda _: self.cancel())
+        self._lock = threading.Lock()
+        self._remaining = len(self.tasks)
+        self._cancelled = threading.Event()
+        self._started_at = None
+
+    def start(self):
+        '''开始安装，立即返回
+
+        :returns: Future -- 结果为InstallReport
+        '''
+        self._started_at = time.time()
+        queues = collections.OrderedDict()
+        for task in self.tasks:
+            queues.setdefault(task.host_url, collections.deque()).append(task)
+        if not self.tasks:
+            self._finish()
+        for host_url, queue in queues.items():
+            for index in range(min(self.per_host, len(queue))):
+                thread = threading.Thread(target=self._work, args=(queue,), name='BatchInstaller-%d' % index)
+                thread.setDaemon(True)
+                thread.start()
+        return self._future
+
+    def cancel(self):
+        '''不再开始新的安装，正在进行的安装完成后结束
+        '''
+        self._cancelled.set()
+
+    def _work(self, queue):
+        while True:
+            with self._lock:
+                if not queue:
+                    return
+                task = queue.popleft()
+            self._install(task)
+            with self._lock:
+                self._remaining -= 1
+                finished = self._remaining == 0
+            if finished:
+                self._finish()
+
+    def _install(self, task):
+        task.started_at = time.time()
+        for attempt in range(self.retries + 1):
+            if self._cancelled.is_set():
+                break
+            task.attempts = attempt + 1
+            self._update(task, InstallTask.INSTALLING)
+            try:
+                if self.pool.get(task.udid).install_app(self.pkg_path):
+                    task.error = None
+                    self._update(task, InstallTask.SUCCEEDED)
+                    return
+                task.error = 'install returned false'
+            except Exception, e:
+                task.error = str(e)
+            Log.w('BatchInstaller', 'install %s on %s failed (attempt %d): %s'
+                  % (self.pkg_path, task.udid, task.attempts, task.error_summary))
+            if attempt < self.retries:
+                self._update(task, InstallTask.WAITING_RETRY)
+                self._cancelled.wait(self.retry_delay * 2 ** attempt)
+        self._update(task, InstallTask.CANCELLED if task.error is None else InstallTask.FAILED)
+
+    def _update(self, task, state):
+        task.state = state
+        if task.done:
+            task.finished_at = time.time()
+        if self.callback is None:
+            return
+        try:
+            self.callback(task)
+        except:
+            Log.e('BatchInstaller', traceback.format_exc())
+
+    def _finish(self):
+        report = InstallReport(self.pkg_path, self.tasks, time.time() - self._started_at)
+        Log.i('BatchInstaller', report.format())
+        self._future.set_result(report)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RPC调用的耗时和流量统计
+'''
+
+import bisect
+import threading
+import time
+
+from util.logger import Log
+
+
+def _make_bounds():
+    # 0.1ms到20分钟按1.2倍递增的桶边界（秒），分位数的相对误差不超过20%
+    bounds = []
+    bound = 0.0001
+    while bound < 1200:
+        bounds.append(bound)
+        bound *= 1.2
+    return bounds
+
+_BOUNDS = _make_bounds()
+
+
+class Histogram(object):
+    '''固定桶的耗时直方图，内存占用与样本数无关
+    '''
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        '''返回分位数（秒），取所在桶的上界，不超过最大值
+        '''
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(_BOUNDS):
+                    return min(_BOUNDS[index], self.max)
+                return self.max
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class MethodMetrics(object):
+    '''单个方法的统计数据
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.lock_wait = Histogram()
+        self.request_bytes = 0
+        self.request_wire_bytes = 0
+        self.response_bytes = 0
+        self.response_wire_bytes = 0
+        self.decode_time = 0.0
+
+    def snapshot(self):
+        return {'method': self.name,
+                'calls': self.calls,
+                'errors': self.errors,
+                'mean': self.latency.mean,
+                'p50': self.latency.percentile(50),
+                'p95': self.latency.percentile(95),
+                'p99': self.latency.percentile(99),
+                'max': self.latency.max,
+                'request_bytes': self.request_bytes,
+                'request_wire_bytes': self.request_wire_bytes,
+                'response_bytes': self.response_bytes,
+                'response_wire_bytes': self.response_wire_bytes,
+                'decode_time': self.decode_time,
+                'lock_waits': self.lock_wait.count,
+                'lock_wait_p95': self.lock_wait.percentile(95),
+                'lock_wait_max': self.lock_wait.max}
+
+
+class MetricsRegistry(object):
+    '''按方法名汇总的统计数据(线程安全)
+    '''
+
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+        self._dump_interval = None
+        self.started = time.time()
+
+    def _get(self, name):
+        metrics = self._methods.get(name)
+        if metrics is None:
+            metrics = self._methods[name] = MethodMetrics(name)
+        return metrics
+
+    def record_call(self, name, latency, error=False, stats=None):
+        '''记录一次远程调用
+
+        :param name: 远程方法名
+        :type name: str
+        :param latency: 调用耗时（秒）
+        :type latency: float
+        :param error: 调用是否失败
+        :type error: bool
+        :param stats: 传输字节数和解码耗时
+        :type stats: rpc.client.TransferStats
+        '''
+        with self._lock:
+            metrics = self._get(name)
+            metrics.calls += 1
+            if error:
+                metrics.errors += 1
+            metrics.latency.add(latency)
+            if stats is not None:
+                metrics.request_bytes += stats.request_bytes
+                metrics.request_wire_bytes += stats.request_wire_bytes
+                metrics.response_bytes += stats.response_bytes
+                metrics.response_wire_bytes += stats.response_wire_bytes
+                metrics.decode_time += stats.decode_time
+
+    def record_lock_wait(self, name, seconds):
+        '''记录等待设备锁的时间
+
+        :param name: Driver方法名
+        :type name: str
+        '''
+        with self._lock:
+            self._get(name).lock_wait.add(seconds)
+
+    def snapshot(self):
+        '''所有方法的统计数据，按累计耗时从大到小排列
+
+        :returns: list -- [dict]
+        '''
+        with self._lock:
+            items = [metrics.snapshot() for metrics in self._methods.values()]
+        items.sort(key=lambda item: item['mean'] * item['calls'], reverse=True)
+        return items
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+            self.started = time.time()
+
+    def format(self):
+        '''格式化为文本表格
+        '''
+        lines = ['%-40s %6s %5s %8s %8s %8s %10s %10s %8s %8s' % (
+            'method', 'calls', 'err', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+            'sent(KB)', 'recv(KB)', 'dec(ms)', 'lock(ms)')]
+        for item in self.snapshot():
+            lines.append('%-40s %6d %5d %8.1f %8.1f %8.1f %10.1f %10.1f %8.1f %8.1f' % (
+                item['method'][:40], item['calls'], item['errors'],
+                item['p50'] * 1000, item['p95'] * 1000, item['p99'] * 1000,
+                item['request_wire_bytes'] / 1024.0, item['response_wire_bytes'] / 1024.0,
+                item['decode_time'] * 1000, item['lock_wait_p95'] * 1000))
+        return '\n'.join(lines)
+
+    def dump(self):
+        '''输出统计数据到日志
+        '''
+        Log.i('RPCMetrics', 'rpc metrics since %s\n%s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)), self.format()))
+
+    def start_periodic_dump(self, interval=300):
+        '''每隔interval秒输出一次统计数据到日志，重复调用只修改间隔
+        '''
+        self._dump_interval = interval
+        if self._dump_thread:
+            return
+        self._dump_thread = threading.Thread(target=self._dump_loop, name='RPCMetricsDump')
+        self._dump_thread.setDaemon(True)
+        self._dump_thread.start()
+
+    def _dump_loop(self):
+        while True:
+            time.sleep(self._dump_interval)
+            with self._lock:
+                empty = not self._methods
+            if not empty:
+                self.dump()
+
+
+registry = MetricsRegistry()
+
+
+def get_registry():
+    '''获取进程共享的统计数据
+    '''
+    return registry
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''回放录制的RPC流量，不需要连接设备
+
+用法:
+    cassette = Cassette('session.cassette')
+    transport = ReplayTransport(cassette, speed=1.0)
+    proxy = RPCClientProxy('http://127.0.0.1:12306/device/<udid>/', transport=transport)
+'''
+
+import json
+import threading
+import time
+import xmlrpclib
+
+from rpc.cassette import iter_records
+from rpc.client import DriverApiError
+from rpc.client import RPCTimeoutError
+from rpc.client import Timeout
+from rpc.client import TransferStats
+from rpc.client import TransportMixIn
+
+
+class CassetteMissError(DriverApiError):
+    '''录制文件中没有与请求匹配的记录
+    '''
+
+
+def request_key(method, handler, request_body):
+    '''请求的匹配键，忽略JSON-RPC的id和主机地址
+    '''
+    if method == 'GET' or not request_body:
+        return method, handler, None
+    try:
+        request = json.loads(request_body)
+    except ValueError:
+        return method, handler, request_body
+    items = request if isinstance(request, list) else [request]
+    calls = [(item.get('method'), item.get('params', [])) if isinstance(item, dict) else item
+             for item in items]
+    return method, handler, json.dumps([isinstance(request, list), calls], sort_keys=True)
+
+
+def _request_ids(request_body):
+    try:
+        request = json.loads(request_body)
+    except (TypeError, ValueError):
+        return []
+    items = request if isinstance(request, list) else [request]
+    return [item.get('id') for item in items if isinstance(item, dict)]
+
+
+class Cassette(object):
+    '''加载录制文件，按请求内容查找响应
+
+    相同的请求按录制顺序依次返回，用完后从头循环，以便重复回放同一段操作
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = list(iter_records(path))
+        self._index = {}
+        self._cursors = {}
+        self._lock = threading.Lock()
+        for record in self.records:
+            key = request_key(record.method, record.handler, record.request)
+            self._index.setdefault(key, []).append(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def match(self, method, handler, request_body):
+        '''返回与请求匹配的下一条记录
+
+        :raises: CassetteMissError
+        '''
+        key = request_key(method, handler, request_body)
+        records = self._index.get(key)
+        if not records:
+            raise CassetteMissError('no recorded response for %s %s %s' % (method, handler, key[2]))
+        with self._lock:
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = (cursor + 1) % len(records)
+        return records[cursor]
+
+    def rewind(self):
+        with self._lock:
+            self._cursors = {}
+
+
+class ReplayTransport(TransportMixIn):
+    '''以录制的响应代替网络请求的Transport，可传给RPCClientProxy
+
+    speed为1时按录制时的耗时回放，为2时快一倍，为None时不等待
+    '''
+
+    def __init__(self, cassette, speed=None):
+        '''
+        :param cassette: 录制文件路径或者Cassette
+        :type cassette: str or Cassette
+        :param speed: 回放速度倍数，None表示尽快回放
+        :type speed: float
+        '''
+        TransportMixIn.__init__(self)
+        self.cassette = Cassette(cassette) if isinstance(cassette, basestring) else cassette
+        self.speed = speed
+        self.verbose = 0
+
+    def request(self, host, handler, request_body, verbose=0, timeout=None):
+        record = self._replay('POST', host, handler, request_body, timeout)
+        p, u = self.getparser()
+        start = time.time()
+        p.feed(record.response)
+        p.close()
+        result = u.close()
+        self._local.stats.decode_time = time.time() - start
+        self._add_total(self._local.stats)
+        return _rewrite_ids(result, _request_ids(record.request), _request_ids(request_body))
+
+    def fetch(self, host, handler, verbose=0, timeout=None):
+        record = self._replay('GET', host, handler, None, timeout)
+        self._add_total(self._local.stats)
+        return record.response
+
+    def stream_request(self, host, handler, request_body, verbose=0, timeout=None):
+        record = self._replay('POST', host, handler, request_body, timeout)
+        stats = self._local.stats
+        for offset in xrange(0, len(record.response), self.read_size):
+            yield record.response[offset:offset + self.read_size]
+        self._add_total(stats)
+
+    def _replay(self, method, host, handler, request_body, timeout):
+        record = self.cassette.match(method, handler, request_body)
+        timeout = timeout or Timeout()
+        stats = self._local.stats = TransferStats()
+        stats.calls = 1
+        stats.request_bytes = stats.request_wire_bytes = len(request_body or '')
+        stats.response_bytes = stats.response_wire_bytes = len(record.response)
+        if self.speed:
+            delay = record.duration / self.speed
+            if timeout.read is not None and delay > timeout.read:
+                time.sleep(timeout.read)
+                raise RPCTimeoutError('%s%s timed out after %ss' % (host, handler, timeout.read),
+                                      'read', timeout.read)
+            time.sleep(delay)
+        if record.error == 'timeout':
+            raise RPCTimeoutError('%s%s timed out (recorded)' % (host, handler), 'read', timeout.read)
+        if record.status != 200:
+            raise xmlrpclib.ProtocolError(host + handler, record.status, record.reason, {})
+        return record
+
+    def close(self):
+        pass
+
+
+def _rewrite_ids(response, recorded_ids, ids):
+    # give the recorded responses the ids of the requests being replayed
+    mapping = dict(zip(recorded_ids, ids))
+    items = response if isinstance(response, list) else [response]
+    for item in items:
+        if isinstance(item, dict) and item.get('id') in mapping:
+            item['id'] = mapping[item['id']]
+    return response
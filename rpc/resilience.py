@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''RPC调用的重试、退避以及按主机熔断
+'''
+
+import errno
+import httplib
+import random
+import socket
+import threading
+import time
+import xmlrpclib
+
+from rpc.client import DriverApiError
+from rpc.client import remaining_time
+from rpc.client import RPCTimeoutError
+from util.logger import Log
+
+
+# 重复执行不会改变设备状态的方法，任何暂时性错误都可以重试
+IDEMPOTENT_METHODS = frozenset([
+    'echo',
+    'list_devices',
+    'device.capture_screen',
+    'device.get_screen_orientation',
+    'device.get_element_tree',
+    'device.get_element_tree_delta',
+    'device.get_app_list',
+    'device.get_sandbox_path_files',
+    'device.is_sandbox_path_dir',
+    'device.get_sandbox_file_content',
+    'device.get_sandbox_file_info',
+    'device.read_sandbox_file',
+    'device.get_xcode_version',
+    'device.get_ios_version',
+])
+
+# 耗时取决于设备和界面复杂度的方法，读超时说明设备忙而不是主机不可用，不计入熔断
+SLOW_METHODS = frozenset([
+    'start_simulator',
+    'screenshot',
+    'device.capture_screen',
+    'device.get_element_tree',
+    'device.get_element_tree_delta',
+    'device.start_app',
+    'device.install',
+    'device.uninstall',
+    'device.get_sandbox_file_content',
+    'device.read_sandbox_file',
+])
+
+# 服务端繁忙或者网关错误，请求未被处理
+_RETRYABLE_STATUS = (502, 503, 504)
+
+
+class CircuitOpenError(DriverApiError):
+    '''主机熔断中，调用未发出
+    '''
+
+
+def is_transient(error):
+    '''是否为网络或者主机暂时不可用导致的错误，业务错误(DriverApiError)不属于此类
+    '''
+    if isinstance(error, RPCTimeoutError):
+        return error.phase != 'deadline'
+    if isinstance(error, xmlrpclib.ProtocolError):
+        return error.errcode in _RETRYABLE_STATUS
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+def is_host_failure(methodname, error):
+    '''错误是否应计入熔断：慢方法的读超时不代表主机不可用
+    '''
+    if not is_transient(error):
+        return False
+    if isinstance(error, RPCTimeoutError) and error.phase == 'read':
+        if methodname.startswith('fetch['):
+            methodname = methodname[len('fetch['):-1]
+        return methodname not in SLOW_METHODS
+    return True
+
+
+def is_unsent(error):
+    '''请求确定没有到达服务端，非幂等的方法也可以安全重试
+    '''
+    if isinstance(error, RPCTimeoutError):
+        return error.phase == 'connect'
+    if isinstance(error, xmlrpclib.ProtocolError):
+        return error.errcode == 503
+    if isinstance(error, socket.error):
+        return error.errno == errno.ECONNREFUSED
+    return False
+
+
+class RetryPolicy(object):
+    '''重试策略，退避时间按指数增长并加入随机抖动
+    '''
+
+    def __init__(self, retries=2, backoff=0.2, max_backoff=2.0, jitter=0.5):
+        '''
+        :param retries: 最大重试次数
+        :type retries: int
+        :param backoff: 第一次重试前的等待时间（秒）
+        :type backoff: float
+        :param max_backoff: 单次等待时间上限（秒）
+        :type max_backoff: float
+        :param jitter: 随机抖动的比例，0表示不抖动
+        :type jitter: float
+        '''
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        '''第attempt次重试前的等待时间（attempt从1开始）
+        '''
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, methodname, error):
+        if not is_transient(error):
+            return False
+        # fetch[...] only reads a resource with GET
+        return (methodname in IDEMPOTENT_METHODS or methodname.startswith('fetch[')
+                or is_unsent(error))
+
+
+class CircuitBreaker(object):
+    '''单个主机或者设备的熔断器(线程安全)
+
+    连续失败达到阈值后熔断(open)，熔断期间的调用直接失败；经过reset_timeout后
+    放行一个试探调用(half-open)，成功则恢复(closed)，失败则继续熔断
+    '''
+    CLOSED, OPEN, HALF_OPEN = ('closed', 'open', 'half-open')
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0
+        self.last_error = None
+        self._opened_at = 0
+        self._probing = False
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, func):
+        '''添加状态变化的回调，参数为当前CircuitBreaker，在发生变化的线程中调用
+        '''
+        self._listeners.append(func)
+
+    def remove_listener(self, func):
+        if func in self._listeners:
+            self._listeners.remove(func)
+
+    def allow(self):
+        '''调用前检查，熔断中抛出CircuitOpenError
+        '''
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            if self.state == CircuitBreaker.OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.time()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError('%s is unavailable, retry in %.1fs: %s'
+                                           % (self.name, remaining, self.last_error))
+                self.state = CircuitBreaker.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError('%s is being probed: %s' % (self.name, self.last_error))
+            self._probing = True
+        self._notify()
+
+    def record_success(self):
+        with self._lock:
+            changed = self.state != CircuitBreaker.CLOSED
+            self.state = CircuitBreaker.CLOSED
+            self.consecutive_failures = 0
+            self._probing = False
+        if changed:
+            Log.i('CircuitBreaker', '%s closed' % self.name)
+            self._notify()
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            self._probing = False
+            opened = (self.state == CircuitBreaker.HALF_OPEN
+                      or (self.state == CircuitBreaker.CLOSED
+                          and self.consecutive_failures >= self.failure_threshold))
+            if opened:
+                self.state = CircuitBreaker.OPEN
+                self._opened_at = time.time()
+        if opened:
+            Log.w('CircuitBreaker', '%s opened after %d failures: %s' % (self.name, self.consecutive_failures, error))
+        self._notify()
+
+    def release_probe(self):
+        '''调用的结果不能说明主机是否可用(例如慢方法读超时)时调用，不改变状态，
+        半开状态下允许下一个调用重新试探
+        '''
+        with self._lock:
+            self._probing = False
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+        self._notify()
+
+    def reset(self):
+        '''强制恢复，例如重启主机上的driver之后
+        '''
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.consecutive_failures = 0
+            self._probing = False
+        self._notify()
+
+    def snapshot(self):
+        '''当前状态，供界面展示
+
+        :returns: dict
+        '''
+        with self._lock:
+            return {'name': self.name,
+                    'state': self.state,
+                    'consecutive_failures': self.consecutive_failures,
+                    'failures': self.failures,
+                    'retries': self.retries,
+                    'rejected': self.rejected,
+                    'last_error': str(self.last_error) if self.last_error else None}
+
+    def _notify(self):
+        for func in list(self._listeners):
+            try:
+                func(self)
+            except:
+                import traceback
+                Log.e('CircuitBreaker', traceback.format_exc())
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host_url, udid=None):
+    '''获取主机或者设备对应的共享熔断器，不存在时创建
+
+    每台设备有各自的熔断器，一台设备无响应不影响同一主机上的其他设备和主机本身
+
+    :param host_url: 主机url
+    :type host_url: str
+    :param udid: 设备的udid，None表示主机本身(host/接口)
+    :type udid: str
+    '''
+    key = host_url if udid is None else (host_url, udid)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            name = host_url if udid is None else '%s/device/%s' % (host_url, udid)
+            breaker = _breakers[key] = CircuitBreaker(name)
+        return breaker
+
+
+def get_breakers(host_url=None):
+    '''获取所有熔断器，指定host_url时只返回该主机及其设备的熔断器
+    '''
+    with _breakers_lock:
+        return [breaker for key, breaker in _breakers.items()
+                if host_url is None or key == host_url or (isinstance(key, tuple) and key[0] == host_url)]
+
+
+class ResilientProxy(object):
+    '''为RPCClientProxy加上自动重试和熔断，用法与RPCClientProxy一致
+
+    proxy("retry")(n)返回最多重试n次的调用对象，非幂等方法仅在请求确定未发出时重试
+    '''
+
+    def __init__(self, proxy, breaker, policy=None):
+        '''
+        :param proxy: 被包装的RPCClientProxy
+        :type proxy: RPCClientProxy
+        :param breaker: 主机的熔断器
+        :type breaker: CircuitBreaker
+        :param policy: 重试策略
+        :type policy: RetryPolicy
+        '''
+        self.__proxy = proxy
+        self.__breaker = breaker
+        self.__policy = policy or RetryPolicy()
+
+    def __invoke(self, methodname, func, retries=None):
+        # call func() under the breaker, retrying transient failures with backoff
+        policy = self.__policy
+        retries = policy.retries if retries is None else retries
+        attempt = 0
+        while True:
+            self.__breaker.allow()
+            try:
+                result = func()
+            except Exception, e:
+                if not is_transient(e):
+                    # the host answered, it is alive
+                    self.__breaker.record_success()
+                    raise
+                if is_host_failure(methodname, e):
+                    self.__breaker.record_failure(e)
+                else:
+                    self.__breaker.release_probe()
+                attempt += 1
+                if (attempt > retries or not policy.should_retry(methodname, e)
+                        or self.__breaker.state == CircuitBreaker.OPEN):
+                    raise
+                delay = policy.delay(attempt)
+                remaining = remaining_time()
+                if remaining is not None and remaining <= delay:
+                    raise
+                Log.w('ResilientProxy', 'retry %s (%d/%d) in %.2fs: %s' % (methodname, attempt, retries, delay, e))
+                self.__breaker.record_retry()
+                time.sleep(delay)
+            else:
+                self.__breaker.record_success()
+                return result
+
+    def __request(self, methodname, params, retries=None):
+        method = getattr(self.__proxy, methodname)
+        return self.__invoke(methodname, lambda: method(*params), retries)
+
+    def __batch_request(self, calls):
+        batch = self.__proxy("batch")
+        methodnames = [methodname for methodname, _ in calls]
+        # a batch is only as idempotent as its least idempotent call
+        if all(methodname in IDEMPOTENT_METHODS for methodname in methodnames):
+            key = methodnames[0]
+        else:
+            key = 'batch'
+        return self.__invoke(key, lambda: batch(calls))
+
+    def __stream_request(self, methodname, *params):
+        # streams cannot be replayed once consumed, only the breaker applies
+        self.__breaker.allow()
+        try:
+            for event in self.__proxy("stream")(methodname, *params):
+                yield event
+        except GeneratorExit:
+            # closed early by the consumer after the host has answered
+            self.__breaker.record_success()
+            raise
+        except Exception, e:
+            if is_host_failure(methodname, e):
+                self.__breaker.record_failure(e)
+            elif not is_transient(e):
+                self.__breaker.record_success()
+            else:
+                self.__breaker.release_probe()
+            raise
+        self.__breaker.record_success()
+
+    def __fetch(self, name, *args, **kwargs):
+        fetch = self.__proxy("fetch")
+        return self.__invoke('fetch[%s]' % name, lambda: fetch(name, *args, **kwargs))
+
+    def __with_retry(self, retries):
+        return _RetryMethods(lambda methodname, params: self.__request(methodname, params, retries))
+
+    def __repr__(self):
+        return "<ResilientProxy for %r>" % self.__proxy
+
+    __str__ = __repr__
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__request, name)
+
+    def __call__(self, attr):
+        if attr == "batch":
+            return self.__batch_request
+        elif attr == "stream":
+            return self.__stream_request
+        elif attr == "fetch":
+            return self.__fetch
+        elif attr == "retry":
+            return self.__with_retry
+        elif attr == "breaker":
+            return self.__breaker
+        return self.__proxy(attr)
+
+
+class _RetryMethods(object):
+    # method dispatcher returned by proxy("retry")(n)
+
+    def __init__(self, send):
+        self.__send = send
+
+    def __getattr__(self, name):
+        return xmlrpclib._Method(self.__send, name)
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''沙盒文件的本地镜像和目录索引
+
+每个文件以(udid, bundle_id, 路径)的哈希命名，旁边的.json记录文件在设备上的大小和修改时间；
+大小和修改时间都未变化时直接使用本地文件。下载中的文件以.part结尾，中断后从已下载的位置继续；
+同一文件同时只能有一个下载，见SandboxMirror.downloading。
+'''
+
+import collections
+import contextlib
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import threading
+import time
+
+from util.logger import Log
+
+
+DEFAULT_MIRROR_ROOT = os.path.join(tempfile.gettempdir(), 'uispy_sandbox')
+# 镜像的最大总大小，超过时删除最久未使用的文件
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# 同时列出的沙盒目录数，与每个主机连接池的默认连接数一致
+DEFAULT_CRAWL_WORKERS = 4
+
+
+class MirrorEntry(object):
+    '''镜像中的一个文件
+    '''
+
+    def __init__(self, mirror, key, meta):
+        self._mirror = mirror
+        self.key = key
+        self.meta = meta
+
+    @property
+    def path(self):
+        '''下载完成后的本地文件
+        '''
+        return self._mirror._file(self.key)
+
+    @property
+    def part_path(self):
+        return self.path + '.part'
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    @property
+    def complete(self):
+        try:
+            return os.path.getsize(self.path) == self.size
+        except OSError:
+            return False
+
+    @property
+    def downloaded(self):
+        '''已下载的字节数
+        '''
+        if self.complete:
+            return self.size
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    def open_part(self):
+        '''以追加方式打开下载中的文件
+        '''
+        return open(self.part_path, 'ab')
+
+    def finish(self):
+        '''下载完成，.part文件改为正式文件
+        '''
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.part_path, self.path)
+        self._mirror._prune()
+
+
+class SandboxMirror(object):
+    '''沙盒文件的本地镜像(线程安全)
+    '''
+
+    def __init__(self, root=DEFAULT_MIRROR_ROOT, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        :param root: 镜像目录
+        :type root: str
+        :param max_bytes: 镜像的最大总大小（字节），None表示不限制
+        :type max_bytes: int
+        '''
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._downloads = {}  # {key: [Lock, 使用者数]}
+
+    def _key(self, udid, bundle_id, path):
+        values = [value.encode('utf-8') if isinstance(value, unicode) else value
+                  for value in (udid, bundle_id, path)]
+        return hashlib.sha1('\0'.join(values)).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    @contextlib.contextmanager
+    def downloading(self, udid, bundle_id, path):
+        '''下载文件期间持有，同一文件的下载依次进行，避免同时追加到同一个.part文件
+
+        用法:
+            with mirror.downloading(udid, bundle_id, path):
+                entry = mirror.lookup(udid, bundle_id, path, size, mtime)
+                ...
+        '''
+        key = self._key(udid, bundle_id, path)
+        with self._lock:
+            download = self._downloads.setdefault(key, [threading.Lock(), 0])
+            download[1] += 1
+        try:
+            with download[0]:
+                yield
+        finally:
+            with self._lock:
+                download[1] -= 1
+                if not download[1]:
+                    del self._downloads[key]
+
+    def lookup(self, udid, bundle_id, path, size, mtime):
+        '''返回与设备上文件对应的镜像，文件已变化时丢弃之前的镜像
+
+        :param size: 文件在设备上的大小
+        :type size: int
+        :param mtime: 文件在设备上的修改时间，None表示未知，此时不复用已有的镜像
+        :returns: MirrorEntry -- 可能已下载完成、部分下载或者尚未下载
+        '''
+        key = self._key(udid, bundle_id, path)
+        meta = {'udid': udid, 'bundle_id': bundle_id, 'path': path, 'size': size, 'mtime': mtime}
+        entry = MirrorEntry(self, key, meta)
+        meta_path = entry.path + '.json'
+        with self._lock:
+            try:
+                with open(meta_path) as fd:
+                    previous = json.load(fd)
+            except (IOError, ValueError):
+                previous = None
+            if previous is not None and mtime is not None and \
+                    (previous.get('size'), previous.get('mtime')) == (size, mtime):
+                if entry.complete:
+                    # 镜像文件的修改时间即最近使用时间，淘汰时参考
+                    os.utime(entry.path, None)
+                return entry
+            for stale in (entry.path, entry.part_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            directory = os.path.dirname(entry.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(meta_path, 'w') as fd:
+                json.dump(meta, fd)
+        return entry
+
+    def _prune(self):
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            files = []
+            for directory, _, names in os.walk(self.root):
+                for name in names:
+                    if name.endswith('.json') or name.endswith('.part'):
+                        continue
+                    path = os.path.join(directory, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                Log.i('SandboxMirror', 'evict %s' % path)
+                for stale in (path, path + '.json'):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                total -= size
+
+
+_mirror = SandboxMirror()
+
+
+def get_sandbox_mirror():
+    '''所有DeviceDriver共用的沙盒镜像
+    '''
+    return _mirror
+
+
+def _is_glob(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+class SandboxIndex(object):
+    '''一个App沙盒的路径索引(线程安全)，由SandboxCrawler填充
+
+    entries中每项为目录列表返回的信息{'path', 'is_dir', 'size', 'mtime'}，path为绝对路径；
+    主机不返回size、mtime时为None
+    '''
+
+    def __init__(self, udid, bundle_id):
+        self.udid = udid
+        self.bundle_id = bundle_id
+        self._lock = threading.Lock()
+        self._entries = {'/': {'path': '/', 'is_dir': True, 'size': None, 'mtime': None}}
+        self._children = {}  # {目录: [子路径]}，只包含已列出的目录
+        self._listed_mtimes = {}  # {目录: 列出前目录的mtime}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries) - 1
+
+    def get(self, path):
+        with self._lock:
+            return self._entries.get(path)
+
+    def list_dir(self, path):
+        '''返回索引中目录的内容，尚未列出时返回None
+        '''
+        with self._lock:
+            children = self._children.get(path)
+            if children is None:
+                return None
+            return [self._entries[child] for child in children]
+
+    def is_listed(self, path):
+        with self._lock:
+            return path in self._children
+
+    def listed_dirs(self):
+        '''已列出的目录
+
+        :returns: dict -- {目录: 列出前目录的mtime}
+        '''
+        with self._lock:
+            return dict(self._listed_mtimes)
+
+    def set_listing(self, path, items, mtime=None):
+        '''记录目录的内容，已不存在的子路径连同其下的所有路径一起移除
+
+        :param items: 目录列表，每项的path为绝对路径
+        :type items: list
+        :param mtime: 列出前获得的目录mtime，用于之后判断目录是否变化
+        :returns: tuple -- (新增的路径列表, 移除的路径列表)
+        '''
+        with self._lock:
+            previous = set(self._children.get(path, ()))
+            current = [item['path'] for item in items]
+            removed = previous - set(current)
+            for child in removed:
+                self._remove(child)
+            for item in items:
+                self._entries[item['path']] = item
+            self._children[path] = current
+            self._listed_mtimes[path] = mtime
+            return [child for child in current if child not in previous], sorted(removed)
+
+    def _remove(self, path):
+        self._entries.pop(path, None)
+        self._listed_mtimes.pop(path, None)
+        for child in self._children.pop(path, ()):
+            self._remove(child)
+
+    def search(self, pattern, limit=1000):
+        '''按文件名查找
+
+        :param pattern: 包含*?[时按glob匹配(含"/"时匹配完整路径，否则匹配文件名)，否则按文件名包含该字符串查找，
+                        都不区分大小写
+        :type pattern: str
+        :param limit: 最多返回的结果数
+        :type limit: int
+        :returns: list -- 按路径排序的entries
+        '''
+        pattern = pattern.lower()
+        with self._lock:
+            entries = self._entries.values()
+        if _is_glob(pattern):
+            full_path = '/' in pattern
+            match = lambda path: fnmatch.fnmatchcase(path if full_path else posixpath.basename(path), pattern)
+        else:
+            match = lambda path: pattern in posixpath.basename(path)
+        result = [entry for entry in entries if entry['path'] != '/' and match(entry['path'].lower())]
+        result.sort(key=lambda entry: entry['path'])
+        return result[:limit]
+
+
+class SandboxCrawler(object):
+    '''在后台按广度优先并发列出沙盒目录，结果写入SandboxIndex
+
+    目录的mtime只在增删子项时变化，且不会传递到上级目录，因此refresh一次批量查询所有已列出
+    目录的mtime，只重新列出mtime变化了的目录和新出现的目录；目录中已有文件的大小在
+    目录重新列出前可能已过时。
+    '''
+
+    def __init__(self, device_driver, index, max_workers=DEFAULT_CRAWL_WORKERS, callback=None):
+        '''
+        :param device_driver: 设备的Driver
+        :type device_driver: DeviceDriver
+        :param index: 写入结果的索引
+        :type index: SandboxIndex
+        :param max_workers: 同时列出的目录数
+        :type max_workers: int
+        :param callback: 每列出一个目录后调用callback(目录, 目录内容, 新增的路径, 移除的路径)，在工作线程中执行
+        :type callback: callable
+        '''
+        self.driver = device_driver
+        self.index = index
+        self.max_workers = max_workers
+        self.callback = callback
+        self.listed = 0
+        self.skipped = 0
+        self.errors = []
+        self._cond = threading.Condition()
+        self._queue = collections.deque()  # [(目录, 列出前的mtime)]
+        self._pending = 0
+        self._incremental = False
+        self._cancelled = False
+
+    def crawl(self, root='/'):
+        '''在后台列出root下的所有目录，立即返回
+
+        :returns: SandboxCrawler
+        '''
+        return self._start([(root, None)])
+
+    def refresh(self):
+        '''增量刷新索引，在调用线程中查询目录的mtime后立即返回；主机不支持查询mtime时
+        重新列出所有目录
+
+        :returns: SandboxCrawler
+        '''
+        listed = self.index.listed_dirs()
+        paths = sorted(listed, key=lambda path: (path.count('/'), path))
+        infos = self.driver.get_sandbox_file_infos(self.index.bundle_id, paths) if paths else None
+        if infos is None:
+            return self.crawl()
+        changed = []
+        for path, info in zip(paths, infos):
+            if info is None:
+                continue  # 已被删除，上级目录重新列出时从索引中移除
+            if listed[path] is None or info['mtime'] != listed[path]:
+                changed.append((path, info['mtime']))
+            else:
+                self.skipped += 1
+        self._incremental = True
+        return self._start(changed)
+
+    def _start(self, dirs):
+        with self._cond:
+            self._queue.extend(dirs)
+            self._pending += len(dirs)
+        # 目录数随列出不断增加，开始时只有一个目录也启动全部工作线程
+        for index in range(self.max_workers if dirs else 0):
+            thread = threading.Thread(target=self._work, name='SandboxCrawler-%d' % index)
+            thread.setDaemon(True)
+            thread.start()
+        return self
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._queue.clear()
+            self._pending = 0
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        '''等待所有目录列出完毕
+
+        :returns: bool -- 是否已完成
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    @property
+    def done(self):
+        return self._pending == 0
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and self._pending and not self._cancelled:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                path, mtime = self._queue.popleft()
+            try:
+                self._list(path, mtime)
+            except Exception, e:
+                Log.w('SandboxCrawler', 'failed to list %s: %s' % (path, e))
+                self.errors.append((path, e))
+            with self._cond:
+                if self._pending:
+                    self._pending -= 1
+                self._cond.notify_all()
+
+    def _list(self, path, mtime):
+        items = []
+        for item in self.driver.get_sandbox_path_files(self.index.bundle_id, path):
+            items.append({'path': posixpath.join(path, item['path']),
+                          'is_dir': item['is_dir'],
+                          'size': item.get('size'),
+                          'mtime': item.get('mtime')})
+        added, removed = self.index.set_listing(path, items, mtime)
+        # 增量刷新时已列出的子目录由各自的mtime决定是否重新列出
+        subdirs = [(item['path'], item['mtime']) for item in items
+                   if item['is_dir'] and not (self._incremental and self.index.is_listed(item['path']))]
+        if self.callback:
+            self.callback(path, items, added, removed)
+        with self._cond:
+            if self._cancelled:
+                return
+            self.listed += 1
+            self._queue.extend(subdirs)
+            self._pending += len(subdirs)
+            self._cond.notify_all()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_sandbox_index(udid, bundle_id):
+    '''获取App沙盒的共享索引，不存在时创建
+    '''
+    with _indexes_lock:
+        index = _indexes.get((udid, bundle_id))
+        if index is None:
+            index = _indexes[(udid, bundle_id)] = SandboxIndex(udid, bundle_id)
+        return index
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''单个设备上的请求调度，按操作类型决定哪些请求可以并发执行
+
+    READ    -- 只读查询(控件树、截图、沙盒等)，可以互相并发，也可以与INSTALL并发
+    WRITE   -- 改变界面的操作(点击、拖拽、启动App等)，独占设备，按提交顺序执行
+    INSTALL -- 耗时的安装卸载，与WRITE和其他INSTALL互斥，不阻塞READ
+
+等待中的请求按优先级和提交顺序排队，排在前面且与之冲突的请求未开始前，后面的请求
+不会插队执行，因此交互操作不会被持续的后台刷新饿死；WRITE之间始终按提交顺序执行
+'''
+
+import contextlib
+from functools import wraps
+import itertools
+import threading
+import time
+
+from rpc.metrics import get_registry
+
+
+READ, WRITE, INSTALL = ('read', 'write', 'install')
+
+# 优先级，数值越小越先执行
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# 各类操作未指定优先级时的默认值
+DEFAULT_PRIORITIES = {READ: NORMAL, WRITE: INTERACTIVE, INSTALL: NORMAL}
+
+_priorities = threading.local()
+
+
+@contextlib.contextmanager
+def priority(level):
+    '''指定当前线程内调度请求的优先级
+
+    用法:
+        with priority(BACKGROUND):
+            driver.snapshot()
+    '''
+    previous = getattr(_priorities, 'value', None)
+    _priorities.value = level
+    try:
+        yield
+    finally:
+        _priorities.value = previous
+
+
+def current_priority(kind):
+    level = getattr(_priorities, 'value', None)
+    return DEFAULT_PRIORITIES[kind] if level is None else level
+
+
+def _conflicts(kind1, kind2):
+    if kind1 == READ or kind2 == READ:
+        return WRITE in (kind1, kind2)
+    return True
+
+
+def _covers(held, kind):
+    # whether holding `held` already excludes everything that conflicts with `kind`
+    return held == kind or held == WRITE or (held == INSTALL and kind == READ)
+
+
+class _Ticket(object):
+
+    def __init__(self, kind, level, seq):
+        self.kind = kind
+        self.level = level
+        self.seq = seq
+
+    def ahead_of(self, other):
+        if self.kind == WRITE and other.kind == WRITE:
+            return self.seq < other.seq
+        return (self.level, self.seq) < (other.level, other.seq)
+
+
+class DeviceScheduler(object):
+    '''单个设备的读写调度器(线程安全)
+
+    同一线程内嵌套的请求直接执行，不重新排队；嵌套的请求需要的许可不能超出已持有的，
+    例如持有READ时不能再请求WRITE，否则抛出RuntimeError
+    '''
+
+    def __init__(self, name=''):
+        self.name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._running = {READ: 0, WRITE: 0, INSTALL: 0}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def acquire(self, kind, level=None):
+        '''获得执行kind类操作的许可，返回的上下文结束时释放
+
+        :param kind: READ/WRITE/INSTALL
+        :type kind: str
+        :param level: 优先级，默认由priority()或者操作类型决定
+        :type level: int
+        '''
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            held = self._local.kind
+            if not _covers(held, kind):
+                raise RuntimeError('cannot acquire %s on %s while holding %s' % (kind, self.name, held))
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+            return
+        if level is None:
+            level = current_priority(kind)
+        with self._cond:
+            ticket = _Ticket(kind, level, next(self._seq))
+            self._waiting.append(ticket)
+            try:
+                while not self._can_start(ticket):
+                    self._cond.wait()
+            finally:
+                self._waiting.remove(ticket)
+            self._running[kind] += 1
+        self._local.depth = 1
+        self._local.kind = kind
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            with self._cond:
+                self._running[kind] -= 1
+                self._cond.notify_all()
+
+    def _can_start(self, ticket):
+        for kind, count in self._running.items():
+            if count and _conflicts(kind, ticket.kind):
+                return False
+        for other in self._waiting:
+            if other is not ticket and other.ahead_of(ticket) and _conflicts(other.kind, ticket.kind):
+                return False
+        return True
+
+    def snapshot(self):
+        '''正在执行和等待中的请求数
+
+        :returns: dict -- {'running': {kind: count}, 'waiting': {kind: count}}
+        '''
+        with self._cond:
+            waiting = dict.fromkeys(self._running, 0)
+            for ticket in self._waiting:
+                waiting[ticket.kind] += 1
+            return {'running': dict(self._running), 'waiting': waiting}
+
+
+def scheduled(kind, attrname='scheduler'):
+    '''按操作类型经由self.<attrname>调度方法，等待的时间计入统计数据
+    '''
+
+    def _scheduled(func):
+        @wraps(func)
+        def _run(self, *args, **kwargs):
+            scheduler = getattr(self, attrname)
+            start = time.time()
+            with scheduler.acquire(kind):
+                get_registry().record_lock_wait('%s.%s' % (type(self).__name__, func.__name__), time.time() - start)
+                return func(self, *args, **kwargs)
+        return _run
+    return _scheduled
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''多线程JSON-RPC服务端，支持HTTP/1.1 keep-alive和chunked传输
+'''
+
+import json
+import Queue
+import select
+import SimpleXMLRPCServer
+import socket
+import SocketServer
+import threading
+import time
+import traceback
+import zlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from rpc.asyncclient import _make_wakeup_pair
+from rpc.client import compress
+from rpc.client import Decompressor
+from rpc.client import Fault
+from rpc.client import SimpleJSONRPCRequestHandler
+from util.logger import Log
+
+
+DEFAULT_MAX_WORKERS = 16
+READ_SIZE = 64 * 1024
+# 超过该大小的响应使用chunked编码边序列化边发送
+CHUNKED_THRESHOLD = 256 * 1024
+
+# JSON-RPC 2.0标准错误码
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+
+class JSONRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
+    '''JSON-RPC 2.0请求分发，支持批量请求和通知，方法的注册方式与SimpleXMLRPCDispatcher一致
+
+    调用结果按qt4i的约定放在列表中返回，即{"result": [value]}；截图等二进制数据可以用
+    register_resource注册为GET资源，不经过base64和JSON
+    '''
+    resources = None
+
+    def register_resource(self, name, func, content_type='application/octet-stream'):
+        '''注册以GET方式读取的二进制资源，请求路径的最后一段为name
+
+        :param func: 无参数，返回资源内容(str)
+        :type func: callable
+        '''
+        if self.resources is None:
+            self.resources = {}
+        self.resources[name] = (func, content_type)
+
+    def _get_resource(self, path):
+        '''返回路径对应资源的(内容, Content-Type)，不存在时返回None
+        '''
+        name = path.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        if not self.resources or name not in self.resources:
+            return None
+        func, content_type = self.resources[name]
+        return func(), content_type
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        response = self._dispatch_request(data, dispatch_method, path)
+        if response is None:
+            return None
+        return json.dumps(response)
+
+    def _dispatch_request(self, data, dispatch_method=None, path=None):
+        '''解析并执行请求，返回未序列化的响应对象，全部为通知时返回None
+        '''
+        try:
+            request = json.loads(data)
+        except ValueError, e:
+            return self._error(PARSE_ERROR, 'parse error: %s' % e)
+        if isinstance(request, list):
+            if not request:
+                return self._error(INVALID_REQUEST, 'empty batch')
+            responses = [self._dispatch_one(item, dispatch_method, path) for item in request]
+            responses = [response for response in responses if response is not None]
+            return responses or None
+        return self._dispatch_one(request, dispatch_method, path)
+
+    def _dispatch_one(self, request, dispatch_method, path):
+        if not isinstance(request, dict) or not isinstance(request.get('method'), basestring):
+            return self._error(INVALID_REQUEST, 'invalid request')
+        rpcid = request.get('id')
+        params = request.get('params', [])
+        if not isinstance(params, list):
+            return self._error(INVALID_PARAMS, 'params must be a list', rpcid)
+        method = request['method'].encode('utf-8')
+        if dispatch_method is None and self.instance is None and method not in self.funcs:
+            return self._error(METHOD_NOT_FOUND, 'method "%s" is not supported' % method, rpcid)
+        try:
+            if dispatch_method is not None:
+                result = dispatch_method(method, params)
+            else:
+                result = self._dispatch(method, params)
+        except:
+            Log.e('JSONRPCDispatcher', 'call %s failed:\n%s' % (method, traceback.format_exc()))
+            if 'id' not in request:
+                return None
+            return {"jsonrpc": "2.0", "error": Fault(rpcid=rpcid).error(), "id": rpcid}
+        if 'id' not in request:
+            return None
+        return {"jsonrpc": "2.0", "result": [result], "id": rpcid}
+
+    def _error(self, code, message, rpcid=None):
+        return {"jsonrpc": "2.0", "error": Fault(code, message).error(), "id": rpcid}
+
+
+class ThreadedJSONRPCRequestHandler(SimpleJSONRPCRequestHandler):
+    '''支持keep-alive、流式读取请求体和chunked响应的请求处理器
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = 60  # keep-alive连接的最长空闲时间（秒）
+    encode_threshold = 1400
+    chunked_threshold = CHUNKED_THRESHOLD
+
+    def handle(self):
+        if not isinstance(self.server, ThreadPoolMixIn):
+            SimpleJSONRPCRequestHandler.handle(self)
+            return
+        # serve the requests already received on this connection, the server
+        # waits for the next one without holding a worker thread
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._has_buffered_request():
+            self.handle_one_request()
+
+    def _has_buffered_request(self):
+        # pipelined data read ahead into the file buffer is not visible to select()
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def do_POST(self):
+        '''处理HTTP的POST请求
+        '''
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+        try:
+            data = self.read_body()
+            if data is None:
+                return
+            dispatch_request = getattr(self.server, '_dispatch_request', None)
+            if dispatch_request is None:
+                response = self.server._marshaled_dispatch(
+                    data, getattr(self, '_dispatch', None), self.path)
+            else:
+                response = dispatch_request(data, getattr(self, '_dispatch', None), self.path)
+        except Exception:
+            # the request body may be partly unread, do not reuse the connection
+            self.close_connection = 1
+            response = Fault().response()
+            self.send_response(500, response)
+            self.send_body(response)
+            return
+        self.send_response(200)
+        if response is None or isinstance(response, str):
+            self.send_body(response or '')
+            return
+        chunks = json.JSONEncoder().iterencode(response)
+        self.send_chunks(chunks)
+
+    def do_GET(self):
+        '''以原始字节返回服务端注册的二进制资源
+        '''
+        get_resource = getattr(self.server, '_get_resource', None)
+        try:
+            resource = get_resource(self.path) if get_resource else None
+        except Exception:
+            Log.e('JSONRPCServer', 'get %s failed:\n%s' % (self.path, traceback.format_exc()))
+            response = Fault().response()
+            self.send_response(500)
+            self.send_body(response)
+            return
+        if resource is None:
+            self.report_404()
+            return
+        content, content_type = resource
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        '''分块读取请求体，支持Content-Length和chunked两种方式，返回None表示已回复错误
+        '''
+        encoding = self.headers.get("content-encoding", "identity").lower()
+        if encoding not in ("identity", "gzip", "deflate"):
+            self.send_response(501, "encoding %r not supported" % encoding)
+            self.send_body('')
+            return None
+        decompressor = Decompressor(encoding) if encoding != "identity" else None
+        L = []
+        try:
+            for chunk in self._iter_body():
+                L.append(decompressor.decompress(chunk) if decompressor else chunk)
+            if decompressor:
+                L.append(decompressor.flush())
+        except zlib.error:
+            self.send_response(400, "error decoding %s body" % encoding)
+            self.send_body('')
+            return None
+        return ''.join(L)
+
+    def _iter_body(self):
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(';', 1)[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while self.rfile.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    return
+                while size:
+                    chunk = self.rfile.read(min(size, READ_SIZE))
+                    if not chunk:
+                        raise IOError('connection closed while reading request body')
+                    size -= len(chunk)
+                    yield chunk
+                self.rfile.readline()
+        else:
+            size_remaining = int(self.headers.get("content-length", 0))
+            while size_remaining:
+                chunk = self.rfile.read(min(size_remaining, READ_SIZE))
+                if not chunk:
+                    raise IOError('connection closed while reading request body')
+                size_remaining -= len(chunk)
+                yield chunk
+
+    def send_body(self, body):
+        '''发送完整的响应体，超过encode_threshold时按客户端的Accept-Encoding压缩
+        '''
+        self.send_header("Content-type", "application/json-rpc")
+        if self.encode_threshold is not None and len(body) > self.encode_threshold:
+            encoding = self.choose_encoding()
+            if encoding:
+                body = compress(body, encoding, self.encode_level)
+                self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, chunks):
+        '''边序列化边发送响应，小响应仍然使用Content-Length
+
+        :param chunks: 产生响应内容片段的迭代器
+        :type chunks: iterator
+        '''
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= self.chunked_threshold:
+                break
+        else:
+            self.send_body(''.join(buffered))
+            return
+        if self.request_version != 'HTTP/1.1':
+            # HTTP/1.0不支持chunked，以关闭连接标记响应结束
+            self.close_connection = 1
+            self.send_header("Content-type", "application/json-rpc")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self._write_all(buffered, chunks, None, self.wfile.write)
+            return
+        self.send_header("Content-type", "application/json-rpc")
+        self.send_header("Transfer-Encoding", "chunked")
+        encoding = self.choose_encoding() if self.encode_threshold is not None else None
+        compressor = None
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+            compressor = _compressor(encoding, self.encode_level)
+        self.end_headers()
+        self._write_all(buffered, chunks, compressor, self._write_chunk)
+        self.wfile.write('0\r\n\r\n')
+
+    def _write_all(self, buffered, chunks, compressor, write):
+        # group the small pieces produced by the encoder into READ_SIZE blocks
+        pending = buffered
+        size = sum(len(chunk) for chunk in pending)
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= READ_SIZE:
+                self._write_block(''.join(pending), compressor, write)
+                pending = []
+                size = 0
+        if pending:
+            self._write_block(''.join(pending), compressor, write)
+        if compressor:
+            write(compressor.flush())
+
+    def _write_block(self, block, compressor, write):
+        if compressor:
+            block = compressor.compress(block)
+        if block:
+            write(block)
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def log_message(self, format, *args):
+        if getattr(self.server, 'logRequests', False):
+            Log.d('JSONRPCServer', format % args)
+
+
+def _compressor(encoding, level):
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+class ThreadPoolMixIn:
+    '''用固定数量的工作线程处理请求
+
+    连接在有数据可读时才交给工作线程，处理完已收到的请求后归还给轮询线程等待下一个
+    请求，空闲的keep-alive连接不占用工作线程
+    '''
+    max_workers = DEFAULT_MAX_WORKERS
+    keepalive_timeout = 60  # 空闲keep-alive连接的保留时间（秒）
+    _workers = None
+
+    def start_workers(self):
+        self._requests = Queue.Queue(self.max_workers * 4)
+        self._idle = {}  # {socket: (client_address, idle_since)}
+        self._idle_lock = threading.Lock()
+        self._wakeup_reader, self._wakeup_writer = _make_wakeup_pair()
+        self._closed = False
+        self._workers = []
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._work, name='JSONRPCWorker-%d' % index)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+        poller = threading.Thread(target=self._poll_idle, name='JSONRPCPoller')
+        poller.setDaemon(True)
+        poller.start()
+
+    def process_request(self, request, client_address):
+        # wait for the first request without holding a worker
+        self._park(request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                handler = self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                continue
+            if handler.close_connection or self._closed:
+                self.shutdown_request(request)
+            else:
+                self._park(request, client_address)
+
+    def _park(self, request, client_address):
+        with self._idle_lock:
+            self._idle[request] = (client_address, time.time())
+        self._wakeup_writer.send('x')
+
+    def _poll_idle(self):
+        while not self._closed:
+            with self._idle_lock:
+                sockets = list(self._idle)
+            try:
+                readable, _, _ = select.select([self._wakeup_reader] + sockets, [], [], 1.0)
+            except (select.error, socket.error):
+                # a socket was closed under us, drop the broken ones
+                readable = [sock for sock in sockets if _is_closed(sock)]
+            if self._wakeup_reader in readable:
+                self._wakeup_reader.recv(4096)
+                readable.remove(self._wakeup_reader)
+            now = time.time()
+            ready, expired = [], []
+            with self._idle_lock:
+                for sock in readable:
+                    if sock in self._idle:
+                        ready.append((sock, self._idle.pop(sock)[0]))
+                for sock, (_, idle_since) in self._idle.items():
+                    if now - idle_since > self.keepalive_timeout:
+                        del self._idle[sock]
+                        expired.append(sock)
+            for sock in expired:
+                self.shutdown_request(sock)
+            # the queue is bounded, a busy pool pushes back on new work
+            for item in ready:
+                self._requests.put(item)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        if self._workers:
+            self._closed = True
+            self._wakeup_writer.send('x')
+            for _ in self._workers:
+                self._requests.put(None)
+            self._workers = None
+            with self._idle_lock:
+                idle, self._idle = self._idle, {}
+            for sock in idle:
+                self.shutdown_request(sock)
+
+
+def _is_closed(sock):
+    try:
+        sock.fileno()
+        select.select([sock], [], [], 0)
+    except (select.error, socket.error):
+        return True
+    return False
+
+
+class ThreadedJSONRPCServer(ThreadPoolMixIn, SocketServer.TCPServer, JSONRPCDispatcher):
+    '''多线程JSON-RPC服务端
+
+    用法:
+        server = ThreadedJSONRPCServer(('127.0.0.1', 12306))
+        server.register_function(echo)
+        server.serve_forever()
+    '''
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, addr, requestHandler=ThreadedJSONRPCRequestHandler,
+                 max_workers=DEFAULT_MAX_WORKERS, logRequests=False,
+                 allow_none=True, encoding=None, bind_and_activate=True):
+        self.logRequests = logRequests
+        self.max_workers = max_workers
+        JSONRPCDispatcher.__init__(self, allow_none, encoding)
+        SocketServer.TCPServer.__init__(self, addr, requestHandler, bind_and_activate)
+        if fcntl is not None and hasattr(fcntl, 'FD_CLOEXEC'):
+            flags = fcntl.fcntl(self.fileno(), fcntl.F_GETFD)
+            flags |= fcntl.FD_CLOEXEC
+            fcntl.fcntl(self.fileno(), fcntl.F_SETFD, flags)
+        self.start_workers()
+
+    def handle_error(self, request, client_address):
+        Log.e('JSONRPCServer', 'error handling request from %s:%s\n%s' % (
+            client_address[0], client_address[1], traceback.format_exc()))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''设备主机的健康监控
+
+在后台线程中定时发送心跳(echo)，统计延迟和可用率；心跳同时让连接池中的连接保持可用，
+主机正常时重新连接无需再次探测。重启主机上的driver在后台线程中执行并通知进度。
+
+用法:
+    supervisor = HostSupervisor(host_driver, 'xctest').start()
+    supervisor.connect().add_done_callback(on_connected)
+'''
+
+import sys
+import threading
+import time
+import traceback
+
+from rpc.future import Future
+from rpc.metrics import Histogram
+from rpc.resilience import CircuitBreaker
+from util.logger import Log
+
+
+# 心跳间隔（秒），小于连接池的空闲超时，连接在两次心跳之间不会被淘汰
+HEARTBEAT_INTERVAL = 5.0
+# 心跳的超时（秒）
+HEARTBEAT_TIMEOUT = 3
+# 连续失败多少次心跳后认为主机不可用
+FAILURE_THRESHOLD = 2
+
+
+class HostEvent(object):
+    '''HostSupervisor通知的事件
+    '''
+    HEARTBEAT, RESTARTING, RESTARTED = ('heartbeat', 'restarting', 'restarted')
+
+    def __init__(self, kind, message=None, step=0, steps=0, ok=None):
+        '''
+        :param kind: 事件类型，HEARTBEAT、RESTARTING(重启的每一步)或RESTARTED
+        :param message: 重启步骤的说明
+        :param step: 当前步骤序号
+        :param steps: 总步数
+        :param ok: 心跳或重启是否成功
+        '''
+        self.kind = kind
+        self.message = message
+        self.step = step
+        self.steps = steps
+        self.ok = ok
+
+    def __repr__(self):
+        return '<HostEvent %s %s>' % (self.kind, self.message or self.ok)
+
+
+class HostSupervisor(object):
+    '''单台设备主机的健康监控(线程安全)
+
+    listener(supervisor, HostEvent)在心跳线程或重启线程中调用，界面应转到主线程中更新
+    '''
+
+    def __init__(self, host_driver, driver_type, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT,
+                 failure_threshold=FAILURE_THRESHOLD, auto_restart=False):
+        '''
+        :param host_driver: 设备主机
+        :type host_driver: HostDriver
+        :param driver_type: 重启时使用的driver类型(xctest/instruments)
+        :type driver_type: str
+        :param interval: 心跳间隔（秒）
+        :type interval: float
+        :param timeout: 心跳的超时（秒）
+        :type timeout: float
+        :param failure_threshold: 连续失败多少次后认为主机不可用
+        :type failure_threshold: int
+        :param auto_restart: 主机变为不可用时是否自动重启driver
+        :type auto_restart: bool
+        '''
+        self.host_driver = host_driver
+        self.driver_type = driver_type
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.auto_restart = auto_restart
+        self.latency = Histogram()
+        self.checks = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.available = None  # 主机是否可用，None表示尚未确定
+        self.last_latency = None
+        self.last_ok = None
+        self.last_error = None
+        self._restart = None  # 进行中的重启
+        self._connects = set()  # 未完成的connect()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_listener(self, func):
+        self._listeners.append(func)
+
+    def remove_listener(self, func):
+        if func in self._listeners:
+            self._listeners.remove(func)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='HostSupervisor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''停止心跳，未完成的connect()被取消
+        '''
+        self._stopped.set()
+        self._wakeup.set()
+        with self._lock:
+            connects, self._connects = list(self._connects), set()
+        for future in connects:
+            future.cancel()
+
+    def check_now(self):
+        '''立即发送一次心跳
+        '''
+        self._wakeup.set()
+
+    @property
+    def warm(self):
+        '''最近一次心跳成功且未过期，此时可以直接使用主机
+        '''
+        with self._lock:
+            return bool(self.available and self.last_ok and time.time() - self.last_ok <= self.interval * 2)
+
+    @property
+    def restarting(self):
+        with self._lock:
+            return self._restart is not None and not self._restart.done()
+
+    def snapshot(self):
+        '''当前状态，供界面展示
+
+        :returns: dict
+        '''
+        with self._lock:
+            return {'host_url': self.host_driver.host_url,
+                    'available': self.available,
+                    'restarting': self._restart is not None and not self._restart.done(),
+                    'checks': self.checks,
+                    'failures': self.failures,
+                    'availability': 1 - float(self.failures) / self.checks if self.checks else None,
+                    'latency': self.last_latency,
+                    'mean': self.latency.mean,
+                    'p95': self.latency.percentile(95),
+                    'last_error': str(self.last_error) if self.last_error else None}
+
+    def heartbeat(self):
+        '''立即在调用线程中发送一次心跳
+
+        :returns: bool -- 主机是否可用
+        '''
+        try:
+            latency = self.host_driver.ping(self.timeout)
+        except Exception, e:
+            self._record_failure(e)
+            return False
+        self._record_success(latency)
+        return True
+
+    def connect(self):
+        '''连接主机，立即返回：主机最近的心跳正常时直接完成，否则在后台发送心跳，失败时重启driver
+
+        :returns: Future -- 结果为是否连接成功，stop()时尚未完成的被取消
+        '''
+        future = Future()
+        if self.warm:
+            future.set_result(True)
+            return future
+        with self._lock:
+            self._connects.add(future)
+        future.add_done_callback(self._forget_connect)
+
+        def _connect():
+            if self.heartbeat():
+                future.set_result(True)
+                return
+            if future.cancelled():
+                return  # 已停止，不再重启driver
+
+            def _on_restarted(restart):
+                future.set_result(not restart.cancelled() and restart.exception() is None and restart.result())
+            self.restart().add_done_callback(_on_restarted)
+        self._spawn(_connect, 'HostSupervisor-connect')
+        return future
+
+    def _forget_connect(self, future):
+        with self._lock:
+            self._connects.discard(future)
+
+    def restart(self):
+        '''在后台重启主机上的driver，每一步通知RESTARTING事件，完成后通知RESTARTED事件
+
+        :returns: Future -- 结果为重启后主机是否可用；正在重启时返回同一个Future
+        '''
+        with self._lock:
+            if self._restart is not None and not self._restart.done():
+                return self._restart
+            future = self._restart = Future()
+        self._spawn(lambda: self._do_restart(future), 'HostSupervisor-restart')
+        return future
+
+    def _do_restart(self, future):
+        Log.i('HostSupervisor', 'restart driver on %s' % self.host_driver.host_url)
+        progress = lambda step, steps, message: self._notify(HostEvent(HostEvent.RESTARTING, message, step, steps))
+        try:
+            ok = self.host_driver.restart_host_driver(self.driver_type, progress)
+        except Exception, e:
+            self._notify(HostEvent(HostEvent.RESTARTED, ok=False))
+            future.set_exception(e, sys.exc_info()[2])
+            return
+        if ok:
+            # 重启后立即确认一次，心跳线程随之恢复
+            ok = self.heartbeat()
+        self._notify(HostEvent(HostEvent.RESTARTED, ok=ok))
+        future.set_result(ok)
+
+    def _spawn(self, func, name):
+        thread = threading.Thread(target=func, name=name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            if not self.restarting:
+                self.heartbeat()
+            self._wakeup.wait(self.interval)
+
+    def _record_success(self, latency):
+        with self._lock:
+            self.checks += 1
+            self.latency.add(latency)
+            self.last_latency = latency
+            self.last_ok = time.time()
+            self.consecutive_failures = 0
+            recovered = self.available is False
+            self.available = True
+        if recovered:
+            Log.i('HostSupervisor', '%s is available again' % self.host_driver.host_url)
+        if self.host_driver.breaker.state != CircuitBreaker.CLOSED:
+            # 主机已经恢复，不必等熔断器自行试探
+            self.host_driver.breaker.reset()
+        self._notify(HostEvent(HostEvent.HEARTBEAT, ok=True))
+
+    def _record_failure(self, error):
+        with self._lock:
+            self.checks += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            lost = self.available is not False and self.consecutive_failures >= self.failure_threshold
+            if lost:
+                self.available = False
+        if lost:
+            Log.w('HostSupervisor', '%s is unavailable: %s' % (self.host_driver.host_url, error))
+            if self.auto_restart:
+                self.restart()
+        self._notify(HostEvent(HostEvent.HEARTBEAT, ok=False))
+
+    def _notify(self, event):
+        for func in list(self._listeners):
+            try:
+                func(self, event)
+            except:
+                Log.e('HostSupervisor', traceback.format_exc())
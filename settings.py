@@ -15,6 +15,7 @@
 '''配置参数
 '''
 
+import os
 import sys
 
 if getattr(sys, 'frozen', False):
@@ -24,3 +25,6 @@ else:
     # we are running in a normal Python environment
     RESOURCE_PATH = '../res'
 
+# 运行中产生、下次启动继续使用的数据(缓存等)保存在用户目录，打包后的RESOURCE_PATH
+# 是每次运行时解压的临时目录，且可能只读
+DATA_PATH = os.path.join(os.path.expanduser('~'), '.uispy')
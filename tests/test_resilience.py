@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this 
+# file except in compliance with the License. You may obtain a copy of the License at
+# 
+# https://opensource.org/licenses/BSD-3-Clause
+# 
+# Unless required by applicable law or agreed to in writing, software distributed 
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''重试和熔断的测试
+
+运行: python -m unittest discover -s tests -t .
+'''
+
+import errno
+import socket
+import unittest
+
+from rpc.client import RPCTimeoutError
+from rpc.resilience import CircuitBreaker
+from rpc.resilience import CircuitOpenError
+from rpc.resilience import ResilientProxy
+from rpc.resilience import RetryPolicy
+
+
+class _StubProxy(object):
+    # stands in for RPCClientProxy, each call pops the next outcome
+
+    def __init__(self):
+        self.outcomes = []
+
+    def _next(self, *_):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def _stream(self, methodname, *_):
+        yield ('result.item', 'value', self._next())
+
+    def __getattr__(self, name):
+        return self._next
+
+    def __call__(self, attr):
+        if attr == "stream":
+            return self._stream
+        raise AttributeError(attr)
+
+
+class ResilientProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = _StubProxy()
+        self.breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        self.proxy = ResilientProxy(self.stub, self.breaker, RetryPolicy(retries=0))
+        # open the breaker, with reset_timeout=0 the next call is the half-open probe
+        self.stub.outcomes.append(socket.error(errno.ECONNREFUSED, 'connection refused'))
+        self.assertRaises(socket.error, self.proxy.device.click, 1, 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_slow_probe_timeout_releases_probe(self):
+        self.stub.outcomes.append(RPCTimeoutError('timed out', 'read', 30))
+        self.assertRaises(RPCTimeoutError, self.proxy.device.get_element_tree)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.stub.outcomes.append(1)
+        self.assertEqual(self.proxy.device.get_screen_orientation(), 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_slow_stream_probe_timeout_releases_probe(self):
+        self.stub.outcomes.append(RPCTimeoutError('timed out', 'read', 30))
+        self.assertRaises(RPCTimeoutError, list, self.proxy("stream")('device.get_element_tree'))
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.stub.outcomes.append(1)
+        self.assertEqual(self.proxy.device.get_screen_orientation(), 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_in_flight_rejects_other_calls(self):
+        self.breaker.allow()
+        self.assertRaises(CircuitOpenError, self.proxy.device.get_screen_orientation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''
+批量安装界面
+'''
+import os
+import wx
+
+from rpc.installer import InstallTask
+
+
+REFRESH_INTERVAL = 1000  # 毫秒
+
+COLUMNS = ((u'设备', 180),
+           (u'主机', 160),
+           (u'状态', 80),
+           (u'次数', 45),
+           (u'耗时(s)', 65),
+           (u'错误', 260))
+
+STATE_TEXTS = {InstallTask.QUEUED: u'等待',
+               InstallTask.INSTALLING: u'安装中',
+               InstallTask.WAITING_RETRY: u'等待重试',
+               InstallTask.SUCCEEDED: u'成功',
+               InstallTask.FAILED: u'失败',
+               InstallTask.CANCELLED: u'已取消'}
+
+
+class InstallFrame(wx.Frame):
+    '''展示每台设备的安装进度和最终结果，关闭窗口时尚未开始的安装被取消
+    '''
+
+    def __init__(self, main_frame, installer):
+        '''
+        :param installer: 尚未开始的批量安装，由本窗口开始
+        :type installer: BatchInstaller
+        '''
+        self._main_frame = main_frame
+        self._installer = installer
+        self._rows = {}  # {udid: 行号}
+        title = u'批量安装 %s' % os.path.basename(installer.pkg_path).decode('utf-8')
+        wx.Frame.__init__(self, None, -1, title, size=(820, 360))
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+        panel = wx.Panel(self, wx.ID_ANY)
+        self.list_tasks = wx.ListCtrl(panel, wx.ID_ANY, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for index, (title, width) in enumerate(COLUMNS):
+            self.list_tasks.InsertColumn(index, title, width=width)
+        for task in installer.tasks:
+            self._rows[task.udid] = self.list_tasks.InsertItem(self.list_tasks.GetItemCount(), _text(task.name))
+            self.list_tasks.SetItem(self._rows[task.udid], 1, _text(task.host_url or ''))
+            self._update_row(task)
+        self.lbl_summary = wx.StaticText(panel, wx.ID_ANY, u'正在安装......')
+        self.btn_cancel = wx.Button(panel, wx.ID_ANY, u'取消')
+        self.btn_cancel.Bind(wx.EVT_BUTTON, self.on_cancel)
+
+        bottom = wx.BoxSizer(wx.HORIZONTAL)
+        bottom.Add(self.lbl_summary, 1, wx.ALIGN_CENTER_VERTICAL)
+        bottom.Add(self.btn_cancel, 0)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.list_tasks, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(bottom, 0, wx.EXPAND | wx.ALL, 5)
+        panel.SetSizer(sizer)
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_refresh, self.timer)
+        self.timer.Start(REFRESH_INTERVAL)
+        installer.callback = lambda task: wx.CallAfter(self._update_row, task)
+        installer.start().add_done_callback(lambda future: wx.CallAfter(self._on_finished, future))
+
+    def _update_row(self, task):
+        if not self._installer:
+            return  # 窗口已关闭
+        row = self._rows[task.udid]
+        self.list_tasks.SetItem(row, 2, STATE_TEXTS.get(task.state, task.state))
+        self.list_tasks.SetItem(row, 3, '%d' % task.attempts)
+        self.list_tasks.SetItem(row, 4, '%.1f' % task.elapsed)
+        self.list_tasks.SetItem(row, 5, _text(task.error_summary))
+
+    def on_refresh(self, event):
+        # 安装中的设备每秒更新耗时
+        for task in self._installer.tasks:
+            if task.state == InstallTask.INSTALLING:
+                self.list_tasks.SetItem(self._rows[task.udid], 4, '%.1f' % task.elapsed)
+
+    def _on_finished(self, future):
+        if not self._installer:
+            return
+        self.timer.Stop()
+        self.btn_cancel.Disable()
+        report = future.result()
+        for task in report.tasks:
+            self._update_row(task)
+        self.lbl_summary.SetLabel(u'共%d台设备，成功%d台，失败%d台，取消%d台，耗时%.1f秒' % (
+            len(report.tasks), len(report.succeeded), len(report.failed), len(report.cancelled), report.elapsed))
+        self._main_frame.on_batch_install_finished(report)
+
+    def on_cancel(self, event):
+        self._installer.cancel()
+        self.btn_cancel.Disable()
+        self.lbl_summary.SetLabel(u'正在取消，安装中的设备完成后结束......')
+
+    def on_close(self, event):
+        self.timer.Stop()
+        self._installer.cancel()
+        self._installer = None
+        self._main_frame.on_close_install_frame()
+        event.Skip()
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
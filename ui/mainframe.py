@@ -27,16 +27,29 @@ import subprocess
 import time
 
 from util.logger import Log
+from util import uitree
 from rpc.driver import HostDriver
-from rpc.driver import DeviceDriver
+from rpc.cache import get_metadata_cache
+from rpc.cassette import start_recording
+from rpc.cassette import stop_recording
+from rpc.devicepool import DevicePool
+from rpc.gesture import GestureQueue
+from rpc.installer import BatchInstaller
+from rpc.metrics import get_registry
+from rpc.resilience import CircuitBreaker
+from rpc.supervisor import HostEvent
+from ui.metricsframe import MetricsFrame
+from ui.installframe import InstallFrame
 from ui.sandboxframe import TreeFrame
 from version import VERSION
+from settings import DATA_PATH
 from settings import RESOURCE_PATH
 
 
 DEFAULT_BUNDLE_ID = 'com.tencent.sng.test.gn'
 DEBUG_PATH = 'UISpy.app/Contents/MacOS/UISpy'
 TIMER_ID = 10010
+METADATA_CACHE_FILE = 'metadata_cache.json'
 
 
 class EnumDriverType(object):
@@ -52,14 +65,29 @@ class MainFrame(wx.Frame):
         self._driver_type = EnumDriverType.XCTest
         self._device = None 
         self._host_driver = None
+        self._host_supervisor = None  # 设备主机的心跳，重新连接同一主机时直接使用
         self._device_driver = None
+        self._device_pool = DevicePool()  # 切换设备时复用已创建的DeviceDriver
+        self._device_watcher = None
+        self._gesture_queues = {}  # {udid: GestureQueue}，远程控制的手势按设备排队发送
+        # 版本号和App列表的缓存保存在文件中，下次启动时继续使用
+        if not os.path.isdir(DATA_PATH):
+            try:
+                os.makedirs(DATA_PATH)
+            except OSError, e:
+                Log.w('MainFrame', 'failed to create %s: %s' % (DATA_PATH, e))
+        get_metadata_cache().load(os.path.join(DATA_PATH, METADATA_CACHE_FILE))
         self._element_tree = None
+        self._device_tree = None  # 驱动返回的完整控件树，增量刷新的基准
         self._focused_element = None
         self._app_started = False
         self._orientation = 1
         self._app_type = 'user'
         self._process_dlg_running = False
         self.treeframe = None
+        self.metricsframe = None
+        self.installframe = None
+        get_registry().start_periodic_dump()
     
     def _init_controls(self):
         #设置MacOS X的偏移
@@ -80,6 +108,7 @@ class MainFrame(wx.Frame):
         #应用菜单
         app_menu = wx.Menu()
         install_menu = app_menu.Append(wx.ID_ANY, u"安装App", u"安装app到被测手机")
+        batch_install_menu = app_menu.Append(wx.ID_ANY, u"批量安装App", u"在多台设备上同时安装app")
         uninstall_menu = app_menu.Append(wx.ID_ANY, u"卸载App", u"卸载被测手机上的app")
         sandbox_menu = app_menu.Append(wx.ID_ANY, u"浏览App沙盒", u"打开并查看设备的沙盒目录")
         app_menu.AppendSeparator()
@@ -89,6 +118,8 @@ class MainFrame(wx.Frame):
         log_menu = advance_menu.Append(wx.ID_ANY, u"查看日志", u"打开日志文件夹")
         debug_menu = advance_menu.Append(wx.ID_ANY, u"Debug模式", u"使用Debug模式运行UISpy")
         setting_menu = advance_menu.Append(wx.ID_ANY, u"设置", u"环境参数设置")
+        metrics_menu = advance_menu.Append(wx.ID_ANY, u"RPC统计", u"查看各接口的调用耗时和流量")
+        self.record_menu = advance_menu.Append(wx.ID_ANY, u"录制RPC", u"录制RPC调用到文件，用于离线回放和性能分析", kind=wx.ITEM_CHECK)
         self.show_qpath_menu = advance_menu.Append(wx.ID_ANY, u'显示QPath', u"打开即可显示控件Qpath",kind=wx.ITEM_CHECK)
         self.remote_operator_menu = advance_menu.Append(wx.ID_ANY, u'远程控制', u"打开即可远程控制手机",kind=wx.ITEM_CHECK)
 
@@ -96,10 +127,13 @@ class MainFrame(wx.Frame):
         menu_bar.Append(advance_menu, u'高级')
         
         self.Bind(wx.EVT_MENU, self.on_select_install_pkg, install_menu) 
+        self.Bind(wx.EVT_MENU, self.on_select_batch_install_pkg, batch_install_menu)
         self.Bind(wx.EVT_MENU, self.on_uninstall, uninstall_menu)
         self.Bind(wx.EVT_MENU, self.on_log, log_menu)
         self.Bind(wx.EVT_MENU, self.on_debug, debug_menu)
         self.Bind(wx.EVT_MENU, self.on_settings, setting_menu)
+        self.Bind(wx.EVT_MENU, self.on_metrics_view, metrics_menu)
+        self.Bind(wx.EVT_MENU, self.on_record_rpc, self.record_menu)
         self.Bind(wx.EVT_MENU, self.on_sandbox_view, sandbox_menu)
         self.SetMenuBar(menu_bar)
         
@@ -214,6 +248,19 @@ class MainFrame(wx.Frame):
     def on_close(self, event):
         if self.treeframe:
             self.treeframe.Destroy()
+        if self.metricsframe:
+            self.metricsframe.Destroy()
+        if self.installframe:
+            self.installframe.Destroy()
+        stop_recording()
+        if self._device_watcher:
+            self._device_watcher.stop()
+        if self._host_supervisor:
+            self._host_supervisor.stop()
+        for queue in self._gesture_queues.values():
+            queue.close()
+        self._device_pool.close()
+        get_metadata_cache().save()
         config_parser = ConfigParser.ConfigParser()   
         config_parser.read(self._config_file_path)
         config_parser.set("uispy", "bundle_id", self.tc_bundle_id.GetValue())
@@ -247,36 +294,66 @@ class MainFrame(wx.Frame):
         t.setDaemon(True)
         t.start()
 
-    def _update_device_list(self):
-        self._run_in_main_thread(self.statusbar.SetStatusText, u"正在获取设备列表......", 0)
-        time.sleep(2)
-        try:
-            start_time = time.time()
-            devices = self._host_driver.list_devices()
-            end_time = time.time()
-            print 'cost time:',(end_time - start_time)
-        except:
-            error = traceback.format_exc()
-            Log.e('update_device_list', error)
-            self._run_in_main_thread(self.statusbar.SetStatusText, u"更新设备列表失败", 0)
-            self._run_in_main_thread(self.create_tip_dialog, error.decode('utf-8'))
-            return
+    def _watch_devices(self, host_driver):
+        '''在后台监视设备主机上的设备插拔，设备列表随之增量更新
+        '''
+        if self._device_watcher:
+            self._device_watcher.stop()
         self.cb_devicelist.Clear()
-        for dev in devices:
+        self._device = None
+        self.statusbar.SetStatusText(u"正在获取设备列表......", 0)
+        self._device_pool.add_host(host_driver, refresh=False)
+        self._device_watcher = host_driver.watch_devices(
+            lambda changes: self._on_devices_changed(host_driver, changes))
+
+    def _on_devices_changed(self, host_driver, changes):
+        self._device_pool.update_devices(host_driver.host_url, changes.devices)
+        self._run_in_main_thread(self._update_device_list, host_driver, changes)
+
+    def _update_device_list(self, host_driver, changes):
+        '''按设备的增减和变化更新设备列表，保持当前选中的设备
+        '''
+        if host_driver is not self._host_driver:
+            return
+        removed = set(device['udid'] for device in changes.removed)
+        changed = dict((device['udid'], device) for device in changes.changed)
+        for index in reversed(range(self.cb_devicelist.GetCount())):
+            udid = self.cb_devicelist.GetClientData(index)['udid']
+            if udid in removed:
+                self.cb_devicelist.Delete(index)
+            elif udid in changed:
+                self.cb_devicelist.SetString(index, changed[udid]['name'].decode('utf-8'))
+                self.cb_devicelist.SetClientData(index, changed[udid])
+        for dev in changes.added:
             self.cb_devicelist.Append(dev['name'].decode('utf-8'), dev)
-        self._device = devices[0]
-        self._run_in_main_thread(self.btn_refresh.Enable)
-        self._run_in_main_thread(self.btn_refresh_applist.Enable)
-        self._run_in_main_thread(self.cb_devicelist.Select, 0)
-        self._run_in_main_thread(self.statusbar.SetStatusText, u"更新设备列表完毕", 0)
-        self._update_bundle_id_list()
+        self.btn_refresh.Enable()
+        self.btn_refresh_applist.Enable()
+        self.statusbar.SetStatusText(u"设备列表已更新(新增%d台，移除%d台)" % (len(changes.added), len(changes.removed)), 0)
+
+        selected = self._device['udid'] if self._device else None
+        for index in range(self.cb_devicelist.GetCount()):
+            if self.cb_devicelist.GetClientData(index)['udid'] == selected:
+                self._device = changed.get(selected, self._device)
+                self.cb_devicelist.Select(index)
+                return
+        # 选中的设备已被拔出或者尚未选择设备
+        self._device_driver = None
+        if self.cb_devicelist.GetCount():
+            self.cb_devicelist.Select(0)
+            self._device = self.cb_devicelist.GetClientData(0)
+            self._run_in_work_thread(self._update_bundle_id_list)
+        else:
+            self._device = None
     
-    def _update_bundle_id_list(self):
+    def _update_bundle_id_list(self, reload=False):
         '''
         在连接设备或者更换设备时，更新bundle_id列表
+        :param reload: 是否忽略缓存的App列表重新获取
         '''
         print self._device
-        self._device_driver = DeviceDriver(self._host_driver.host_url, self._device['udid'])
+        self._device_driver = self._device_pool.get(self._device['udid'])
+        if reload:
+            self._device_driver.invalidate_metadata('app_list')
         original_bundle_id = self.tc_bundle_id.GetValue()
         self.tc_bundle_id.Clear()
         if self._device['simulator']:
@@ -309,8 +386,28 @@ class MainFrame(wx.Frame):
         self.statusbar.SetStatusText(u"正在连接设备主机......", 0)
         host_ip = self.tc_device_host_ip.GetValue()
         host_port = self.tc_device_host_port.GetValue()
-        self._host_driver = HostDriver(host_ip, host_port)
-        if not self._host_driver.connect_to_host(self._driver_type):
+        if self._host_driver:
+            self._device_pool.remove_host(self._host_driver.host_url)
+        host_driver = HostDriver(host_ip, host_port)
+        supervisor = self._host_supervisor
+        if supervisor is None or supervisor.host_driver.host_url != host_driver.host_url:
+            if supervisor:
+                supervisor.stop()
+            supervisor = self._host_supervisor = host_driver.supervise(self._driver_type)
+            supervisor.add_listener(self._on_host_event)
+        supervisor.driver_type = self._driver_type
+        self._host_driver = host_driver = supervisor.host_driver
+        self._watch_host_health(host_driver.breaker)
+        # 探测主机以及失败后重启driver都在后台进行，不阻塞界面
+        supervisor.connect().add_done_callback(
+            lambda future: self._run_in_main_thread(self._on_host_connected, host_driver, future))
+
+    def _on_host_connected(self, host_driver, future):
+        if host_driver is not self._host_driver:
+            return  # 已经连接到其他主机
+        if future.cancelled():
+            return  # 连接被停止或已切换主机
+        if future.exception() is not None or not future.result():
             self.statusbar.SetStatusText(u"连接设备主机异常！", 0)
             config_parser = ConfigParser.ConfigParser()
             config_parser.read(os.path.join(RESOURCE_PATH, 'uispy.conf'))
@@ -322,8 +419,47 @@ class MainFrame(wx.Frame):
             else:
                 self.create_tip_dialog(u"连接设备主机异常，请检查设备主机地址")
             return
-        self._run_in_work_thread(self._update_device_list)
+        self._watch_devices(host_driver)
+
+    def _on_host_event(self, supervisor, event):
+        if supervisor is not self._host_supervisor:
+            return
+        if event.kind == HostEvent.RESTARTING:
+            self._run_in_main_thread(self.statusbar.SetStatusText, u"正在重启设备主机的driver(%d/%d): %s......"
+                                     % (event.step + 1, event.steps, event.message), 0)
+        elif event.kind == HostEvent.HEARTBEAT:
+            self._run_in_main_thread(self._update_host_health, supervisor.host_driver.breaker.snapshot())
     
+    def _watch_host_health(self, breaker):
+        '''在状态栏展示设备主机的熔断状态和重试次数
+        '''
+        previous = getattr(self, '_host_breaker', None)
+        if previous:
+            previous.remove_listener(self._on_host_health_changed)
+        self._host_breaker = breaker
+        breaker.remove_listener(self._on_host_health_changed)
+        breaker.add_listener(self._on_host_health_changed)
+        self._update_host_health(breaker.snapshot())
+
+    def _on_host_health_changed(self, breaker):
+        self._run_in_main_thread(self._update_host_health, breaker.snapshot())
+
+    def _update_host_health(self, state):
+        if state['state'] == CircuitBreaker.OPEN:
+            text = u"设备主机不可用，暂停请求"
+        elif state['state'] == CircuitBreaker.HALF_OPEN:
+            text = u"正在探测设备主机"
+        else:
+            text = u"设备主机正常"
+        if state['retries'] or state['failures']:
+            text += u"(重试%d次，失败%d次)" % (state['retries'], state['failures'])
+        health = self._host_supervisor.snapshot() if self._host_supervisor else None
+        if health and health['available'] is False:
+            text = u"设备主机无响应"
+        elif health and health['latency'] is not None:
+            text += u" %dms" % (health['latency'] * 1000)
+        self.statusbar.SetStatusText(text, 1)
+
     def on_select_device(self, event):
         '''从设备列表中选择设备
         '''
@@ -338,8 +474,9 @@ class MainFrame(wx.Frame):
     def on_update_device_list(self, event):
         '''刷新设备列表
         '''
-        self.statusbar.SetStatusText(u"正在更新设备列表......", 0)
-        self._run_in_work_thread(self._update_device_list)
+        if self._device_watcher:
+            self.statusbar.SetStatusText(u"正在更新设备列表......", 0)
+            self._device_watcher.poll_now()
     
     def _update_screenshot(self, img_data):
         image = wx.Image(StringIO.StringIO(img_data))
@@ -380,6 +517,36 @@ class MainFrame(wx.Frame):
         self._element_tree['depth'] = -1
         self._root_item = root
         self._add_child(root, self._element_tree['children'], 0)
+
+    def _patch_uitree(self, old_tree, tree, patch):
+        '''只更新控件树中变化的节点，无法增量更新时返回False
+
+        :param patch: tree相对old_tree的变化，见util.uitree.diff_trees
+        :type patch: list
+        '''
+        if old_tree is None or patch is None:
+            return False
+        # the app node is the root of the shown tree, below UIATarget if any
+        app_path = (0,) if tree['classname'] == 'UIATarget' else ()
+        changes = []
+        for op, path, element in patch:
+            if path[:len(app_path)] != app_path:
+                continue  # not shown
+            if len(path) == len(app_path):
+                return False  # the app itself changed, e.g. rotated
+            changes.append((op, element))
+        uitree.copy_annotations(old_tree, tree)
+        for op, element in changes:
+            item = element['item_id']
+            properties = dict((key, value) for key, value in element.iteritems()
+                              if key != 'children' and key not in uitree.ANNOTATION_KEYS)
+            self.tc_uitree.SetItemText(item, element['classname'])
+            self.tc_uitree.SetItemData(item, properties)
+            if op == 'replace':
+                self.tc_uitree.DeleteChildren(item)
+                self._add_child(item, element['children'], element['depth'] + 1)
+        self._element_tree = uitree.get_element(tree, app_path)
+        return True
     
     def _start_app(self): 
         bundle_id = self.tc_bundle_id.GetValue()
@@ -389,20 +556,18 @@ class MainFrame(wx.Frame):
                 break
         dlg = self._dialog
         try:
-            xcode_version = self._device_driver.get_xcode_version()
-            ios_version = self._device_driver.get_ios_version()
+            xcode_version, ios_version = self._device_driver.get_versions()
             Log.i('xcode_version:%s ios_version:%s' % (xcode_version, ios_version))
 #             增加版本检测
             self._run_in_main_thread(dlg.on_update)
             self._app_started = self._device_driver.start_app(bundle_id)
             if self._app_started:
                 self._run_in_main_thread(self.statusbar.SetStatusText, u"App启动成功", 0)
-                self._run_in_main_thread(dlg.on_update_title_msg, '抓取App屏幕中......')
-                img_data = self._device_driver.take_screenshot()
-                self._orientation = self._device_driver.get_screen_orientation()
-                self._run_in_main_thread(self._update_screenshot, img_data)
-                self._run_in_main_thread(dlg.on_update_title_msg, '抓取App控件树中......')
-                self._element_tree = self._device_driver.get_element_tree()
+                self._run_in_main_thread(dlg.on_update_title_msg, '抓取App屏幕和控件树中......')
+                snapshot = self._device_driver.snapshot()
+                self._orientation = snapshot['orientation']
+                self._run_in_main_thread(self._update_screenshot, snapshot['screenshot'])
+                self._device_tree = self._element_tree = snapshot['element_tree']
                 self._run_in_main_thread(self._update_uitree)
             else:
                 self._run_in_main_thread(self.statusbar.SetStatusText, u"App启动失败:", 0)
@@ -417,9 +582,10 @@ class MainFrame(wx.Frame):
         if self._host_driver is None:
             self.create_tip_dialog(u"未连接设备主机，请连接设备主机")
             return
-        self._device_driver = DeviceDriver(self._host_driver.host_url, self._device['udid'])
+        self._device_driver = self._device_pool.get(self._device['udid'])
         self.statusbar.SetStatusText(u"App正在启动......", 0)
         self._scale_rate = None
+        self._device_tree = None
         self._run_in_work_thread(self._start_app)
         self.show_dialog('App启动中......')
         
@@ -427,73 +593,21 @@ class MainFrame(wx.Frame):
         self._dialog = MyProgressDialog(msg, self.panel)
         self._process_dlg_running = True
     
-    def on_get_uitree(self, event):
-        img_data = self._device_driver.take_screenshot()
-        self._orientation = self._device_driver.get_screen_orientation()
-        print 'orientation: ', self._orientation
-        self._update_screenshot(img_data)
+    def on_get_uitree(self, event, screenshot=None):
         try:
-            self._element_tree = self._device_driver.get_element_tree()
+            snapshot = self._device_driver.snapshot(base=self._device_tree, screenshot=screenshot)
         except:
             self.create_tip_dialog(u'获取控件树失败:%s' % traceback.format_exc())
             return
-        self._update_uitree()
+        self._orientation = snapshot['orientation']
+        print 'orientation: ', self._orientation
+        self._update_screenshot(snapshot['screenshot'])
+        old_tree, self._device_tree = self._device_tree, snapshot['element_tree']
+        if not self._patch_uitree(old_tree, self._device_tree, snapshot.get('patch')):
+            self._element_tree = self._device_tree
+            self._update_uitree()
         self.statusbar.SetStatusText(u"获取控件树成功", 0)
     
-    def _check_pos_in_element(self, pos, element):
-        rect = element['rect']
-        if pos[0] >= rect['origin']['x'] and pos[0] <= rect['origin']['x'] + rect['size']['width'] \
-           and pos[1] >= rect['origin']['y'] and pos[1] <= rect['origin']['y'] + rect['size']['height'] \
-           and element['visible']:
-            return True
-        else:
-            return False
-        
-    def _select_closest_element(self, pos, element1, element2):
-        '''选择距离最近的控件，具体规则如下：
-            1、如果element1和element2的位置是包含关系（父子关系），则选择子节点
-            2、如果element1和element2的位置是部分重叠，则选择距离控件中心最近的控件
-        '''
-        rect1 = element1['rect']
-        rect2 = element2['rect']
-        if rect1['origin']['x'] >= rect2['origin']['x'] and \
-            rect1['origin']['x'] + rect1['size']['width'] <= rect2['origin']['x'] + rect2['size']['width'] and \
-            rect1['origin']['y'] >= rect2['origin']['y'] and \
-            rect1['origin']['y'] + rect1['size']['height'] <= rect2['origin']['y'] + rect2['size']['height']:
-            return element1
-        
-        if rect2['origin']['x'] >= rect1['origin']['x'] and \
-            rect2['origin']['x'] + rect2['size']['width'] <= rect1['origin']['x'] + rect1['size']['width'] and \
-            rect2['origin']['y'] >= rect1['origin']['y'] and \
-            rect2['origin']['y'] + rect2['size']['height'] <= rect1['origin']['y'] + rect1['size']['height']:
-            return element2
-        
-        center1 = (rect1['origin']['x'] + rect1['size']['width'] / 2.0, rect1['origin']['y'] + rect1['size']['height'] / 2.0)
-        center2 = (rect2['origin']['x'] + rect2['size']['width'] / 2.0, rect2['origin']['y'] + rect2['size']['height'] / 2.0)
-        distance1 = (pos[0] - center1[0]) ** 2 + (pos[1] - center1[1]) ** 2       
-        distance2 = (pos[0] - center2[0]) ** 2 + (pos[1] - center2[1]) ** 2  
-        if distance1 <= distance2:
-            return element1
-        else:
-            return element2     
-    
-    def _get_focused_element(self, pos, root):
-        '''优先查找叶子节点的控件（深度遍历）
-        '''
-        for e in root['children']:
-            self._get_focused_element(pos, e)
-            if self._check_pos_in_element(pos, e):
-                if self._focused_element is None:
-                    self._focused_element = e
-                else:
-                    self._focused_element = self._select_closest_element(pos, self._focused_element, e)
-        
-#         if self._check_pos_in_element(pos, root):
-#                 if self._focused_element is None:
-#                     self._focused_element = root
-#                 else:
-#                     self._focused_element = self._select_closest_element(pos, self._focused_element, root)    
-    
     def _expand_uitree(self, item_id):
         '''展开控件树
         '''
@@ -504,14 +618,6 @@ class MainFrame(wx.Frame):
         else:
             self.tc_uitree.Expand(self._root_item)
             
-    def _dfs_traverse(self, element_tree, element_list=None):
-        if element_list is None:
-            element_list = []
-        element_list.append(element_tree)
-        for e in element_tree['children']:
-            self._dfs_traverse(e, element_list)
-        return element_list
-            
     def _recommend_qpath(self, element):
         '''推荐QPath，具体策略如下：
            1、id唯一，则推荐id作为QPath
@@ -520,7 +626,7 @@ class MainFrame(wx.Frame):
         self.tc_qpath.SetValue("")    
         if element['name']:
             element_id = element['name']
-            element_list = self._dfs_traverse(self._element_tree)
+            element_list = uitree.dfs_traverse(self._element_tree)
             count = 0
             for e in element_list:
                 if e['name'] == element_id:
@@ -557,8 +663,7 @@ class MainFrame(wx.Frame):
         if not self._element_tree:
             Log.e('on_screenshot_single_click', 'failed to get element tree')
             return
-        self._focused_element = None
-        self._get_focused_element(self._single_click_position, self._element_tree)
+        self._focused_element = uitree.get_focused_element(self._single_click_position, self._element_tree)
         print 'focus_element:', self._focused_element ['rect']
         rect = (self._focused_element ['rect']['origin']['x'], self._focused_element ['rect']['origin']['y'], \
             self._focused_element ['rect']['size']['width'], self._focused_element ['rect']['size']['height'])
@@ -575,10 +680,41 @@ class MainFrame(wx.Frame):
         self._recommend_qpath(self._focused_element)
         #判断是否进行远程控制
         if self.remote_operator_menu.IsChecked() and self._device_driver:
-            driver_method = getattr(self._device_driver, click_action)
-            driver_method(self.x, self.y)
-            time.sleep(1.5)
-            self._run_in_work_thread(self.on_get_uitree,event)
+            self._send_gesture(click_action, self.x, self.y)
+
+    def _send_gesture(self, action, *args):
+        '''把远程控制的手势加入当前设备的队列后立即返回，一批手势发送完且界面响应后只刷新一次控件树
+
+        :param action: GestureQueue的方法名，如click、long_click、drag
+        :type action: str
+        :returns: Future
+        '''
+        driver = self._device_driver
+        queue = self._gesture_queues.get(driver.udid)
+        if queue is None or queue.driver is not driver:
+            if queue:
+                queue.close()
+            queue = GestureQueue(driver, lambda count, idle: self._on_gestures_settled(driver, idle))
+            self._gesture_queues[driver.udid] = queue
+        future = getattr(queue, action)(*args)
+        future.add_done_callback(lambda future: self._on_gesture_done(action, future))
+        return future
+
+    def _on_gesture_done(self, action, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        error = str(future.exception()).decode('utf-8', 'replace')
+        self._run_in_main_thread(self.statusbar.SetStatusText, u'远程操作%s失败: %s' % (action, error), 0)
+
+    def _on_gestures_settled(self, driver, idle):
+        # 在手势队列线程中执行，切换设备后不再刷新
+        if driver is not self._device_driver:
+            return
+        # 等待界面稳定时最后的截屏就是当前界面，刷新时不再重新截屏
+        self.on_get_uitree(None, idle.screenshot if idle is not None else None)
+        if idle is not None:
+            msg = u'界面稳定用时%.2f秒' % idle.elapsed if idle else u'界面%.1f秒内未稳定' % idle.elapsed
+            self._run_in_main_thread(self.statusbar.SetStatusText, u'获取控件树成功，%s' % msg, 0)
                 
     def on_screenshot_mouse_event(self, event):
         pos = event.GetPosition()
@@ -616,9 +752,7 @@ class MainFrame(wx.Frame):
             self._single_click_position = new_pos
             if abs(self.x - x1) > 0.02 or abs(self.y - y1) > 0.02:
                 if self.remote_operator_menu.IsChecked() and self._device_driver:
-                    self._device_driver.drag(self.x, self.y, x1, y1, self._event_interval)
-                    time.sleep(1.5)
-                    self._run_in_work_thread(self.on_get_uitree,event)
+                    self._send_gesture('drag', self.x, self.y, x1, y1, self._event_interval)
                 
     def on_uitree_node_click(self, event):
         
@@ -684,7 +818,7 @@ class MainFrame(wx.Frame):
         self._run_in_main_thread(dlg.on_update)
         
         if not self._device_driver:
-            self._device_driver = DeviceDriver(self._host_driver.host_url, self._device['udid'])
+            self._device_driver = self._device_pool.get(self._device['udid'])
         try:
             result = self._device_driver.install_app(pkg_path)
             self._process_dlg_running = False
@@ -699,12 +833,57 @@ class MainFrame(wx.Frame):
             Log.e('start_app', error)
             self.create_tip_dialog(error.decode('utf-8'))
         
+    def on_select_batch_install_pkg(self, event):
+        if not self._device_pool.devices():
+            self.create_tip_dialog(u'没有可用的设备，请连接设备主机！')
+            return
+        dlg = wx.FileDialog(self, u"选择app的安装包", "", "",
+                                       "app files (*.zip,*.ipa)|*.zip;*.ipa", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dlg.ShowModal() == wx.ID_CANCEL:
+            return
+        pkg_path = dlg.GetPath().encode('utf-8')
+        dlg.Destroy()
+        self.on_batch_install(pkg_path)
+
+    def on_batch_install(self, pkg_path):
+        '''选择设备后在多台设备上同时安装，进度在批量安装窗口中展示
+        '''
+        if self.installframe:
+            self.installframe.Raise()
+            self.create_tip_dialog(u'已有正在进行的批量安装，请等待完成后再试！')
+            return
+        devices = self._device_pool.devices()
+        choices = [u'%s (%s)' % (device['name'].decode('utf-8'), device['udid']) for device in devices]
+        dlg = wx.MultiChoiceDialog(self, u'选择要安装%s的设备' % os.path.basename(pkg_path).decode('utf-8'),
+                                   u'批量安装App', choices)
+        if self._device:
+            dlg.SetSelections([index for index, device in enumerate(devices) if device['udid'] == self._device['udid']])
+        if dlg.ShowModal() == wx.ID_CANCEL:
+            dlg.Destroy()
+            return
+        udids = [devices[index]['udid'] for index in dlg.GetSelections()]
+        dlg.Destroy()
+        if not udids:
+            return
+        installer = BatchInstaller(self._device_pool, pkg_path, udids)
+        self.installframe = InstallFrame(self, installer)
+        self.installframe.Show(show=True)
+
+    def on_batch_install_finished(self, report):
+        '''批量安装完成后，当前设备安装成功时刷新app列表
+        '''
+        if self._device and self._device['udid'] in [task.udid for task in report.succeeded]:
+            self._run_in_work_thread(self._update_bundle_id_list, True)
+
+    def on_close_install_frame(self):
+        self.installframe = None
+
     def on_uninstall(self, event):
         if self._device is None:
             self.create_tip_dialog(u'未选择设备，请连接设备主机并选择设备！')
             return
         if not self._device_driver:
-            self._device_driver = DeviceDriver(self._host_driver.host_url, self._device['udid'])
+            self._device_driver = self._device_pool.get(self._device['udid'])
         index = self.tc_bundle_id.GetSelection()
         bundle_id = self.tc_bundle_id.GetClientData(index).keys()[0]
         result = self._device_driver.uninstall_app(bundle_id)
@@ -744,7 +923,7 @@ class MainFrame(wx.Frame):
         更新app列表
         '''
         if self._device:
-            self._run_in_work_thread(self._update_bundle_id_list)
+            self._run_in_work_thread(self._update_bundle_id_list, True)
         
     def on_select_bundle_all(self, event):
         '''
@@ -815,6 +994,36 @@ class MainFrame(wx.Frame):
         '''监控沙盒frame是否关闭
         '''
         self.treeframe = None
+
+    def on_metrics_view(self, event):
+        '''查看RPC调用统计
+        '''
+        if self.metricsframe:
+            self.metricsframe.Raise()
+            return
+        self.metricsframe = MetricsFrame(self)
+        self.metricsframe.Show(show=True)
+
+    def on_close_metrics_frame(self):
+        self.metricsframe = None
+
+    def on_record_rpc(self, event):
+        '''开始或者结束录制RPC调用
+        '''
+        if not self.record_menu.IsChecked():
+            count = stop_recording()
+            self.statusbar.SetStatusText(u"RPC录制结束，共%d次调用" % count, 0)
+            return
+        dlg = wx.FileDialog(self, u"保存RPC录制文件", "", time.strftime('uispy-%Y%m%d-%H%M%S.cassette'),
+                            "cassette files (*.cassette)|*.cassette", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_CANCEL:
+            self.record_menu.Check(False)
+            dlg.Destroy()
+            return
+        path = dlg.GetPath().encode('utf-8')
+        dlg.Destroy()
+        start_recording(path)
+        self.statusbar.SetStatusText(u"正在录制RPC调用......", 0)
     
     
 class CanvasPanel(wx.Panel):
@@ -925,7 +1134,10 @@ class FileDropTarget(wx.FileDropTarget):
         for path in filepath:
             path = path.encode('utf-8')
             basename = os.path.basename(path)
-            if path.endswith(('.ipa', '.zip')):
+            if path.endswith(('.ipa', '.zip')) and len(self.frame_window._device_pool.devices()) > 1:
+                # 连接了多台设备时可以选择同时安装到哪些设备
+                self.frame_window.on_batch_install(path)
+            elif path.endswith(('.ipa', '.zip')):
                 self.frame_window._run_in_work_thread(self.frame_window.on_install, path)
             else:
                 self.frame_window.create_tip_dialog(u'%s格式不符合，请选择.ipa(真机)或者.zip(模拟器)类型安装包' % basename)
@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''
+RPC统计界面
+'''
+import wx
+
+from rpc.metrics import get_registry
+
+
+REFRESH_INTERVAL = 1000  # 毫秒
+
+COLUMNS = ((u'方法', 260),
+           (u'次数', 55),
+           (u'失败', 45),
+           (u'p50(ms)', 70),
+           (u'p95(ms)', 70),
+           (u'p99(ms)', 70),
+           (u'发送(KB)', 75),
+           (u'接收(KB)', 75),
+           (u'解码(ms)', 75),
+           (u'等锁p95(ms)', 90))
+
+
+class MetricsFrame(wx.Frame):
+    '''按方法展示RPC调用次数、耗时分位数、流量、解码耗时以及等待设备锁的时间
+    '''
+
+    def __init__(self, main_frame):
+        self._main_frame = main_frame
+        self._registry = get_registry()
+        wx.Frame.__init__(self, None, -1, u'RPC统计', size=(900, 420))
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+        panel = wx.Panel(self, wx.ID_ANY)
+        self.list_metrics = wx.ListCtrl(panel, wx.ID_ANY, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for index, (title, width) in enumerate(COLUMNS):
+            self.list_metrics.InsertColumn(index, title, width=width)
+        btn_reset = wx.Button(panel, wx.ID_ANY, u'清空')
+        btn_reset.Bind(wx.EVT_BUTTON, self.on_reset)
+        btn_dump = wx.Button(panel, wx.ID_ANY, u'写入日志')
+        btn_dump.Bind(wx.EVT_BUTTON, self.on_dump)
+
+        buttons = wx.BoxSizer(wx.HORIZONTAL)
+        buttons.Add(btn_reset, 0, wx.RIGHT, 5)
+        buttons.Add(btn_dump, 0)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.list_metrics, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(buttons, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        panel.SetSizer(sizer)
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_refresh, self.timer)
+        self.timer.Start(REFRESH_INTERVAL)
+        self.refresh()
+
+    def refresh(self):
+        self.list_metrics.DeleteAllItems()
+        for item in self._registry.snapshot():
+            values = (item['method'].decode('utf-8'),
+                      '%d' % item['calls'],
+                      '%d' % item['errors'],
+                      '%.1f' % (item['p50'] * 1000),
+                      '%.1f' % (item['p95'] * 1000),
+                      '%.1f' % (item['p99'] * 1000),
+                      '%.1f' % (item['request_wire_bytes'] / 1024.0),
+                      '%.1f' % (item['response_wire_bytes'] / 1024.0),
+                      '%.1f' % (item['decode_time'] * 1000),
+                      '%.1f' % (item['lock_wait_p95'] * 1000))
+            index = self.list_metrics.InsertItem(self.list_metrics.GetItemCount(), values[0])
+            for column, value in enumerate(values[1:], 1):
+                self.list_metrics.SetItem(index, column, value)
+
+    def on_refresh(self, event):
+        self.refresh()
+
+    def on_reset(self, event):
+        self._registry.reset()
+        self.refresh()
+
+    def on_dump(self, event):
+        self._registry.dump()
+
+    def on_close(self, event):
+        self.timer.Stop()
+        self._main_frame.on_close_metrics_frame()
+        event.Skip()
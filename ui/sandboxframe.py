@@ -17,16 +17,23 @@ sandbox界面
 '''
 import wx
 import os
+import posixpath
 import sys
-import base64
+import threading
 import traceback
 
+from rpc.sandbox import SandboxCrawler
+from rpc.sandbox import get_sandbox_index
 from util.logger import Log
 from settings import RESOURCE_PATH
 
 
 
 SANDBOX_FILE_READ_FORM = ('.log', '.txt', '.plist', 'json', '.Indexed', '.conf', '.array', '.data', 'config')
+# 文本框中最多显示的字节数，更大的文件只显示开头部分，完整内容在本地镜像文件中
+PREVIEW_BYTES = 256 * 1024
+# 查找结果最多显示的条数
+SEARCH_LIMIT = 500
 
 class TreeFrame(wx.Frame):
     
@@ -35,6 +42,11 @@ class TreeFrame(wx.Frame):
         self._main_frame = main_frame
         self._device_driver = device_driver
         self._bundle_id = bundle_id
+        self._selected_path = None  # 正在查看的文件，切换文件后之前的下载中止
+        self._nodes = {}  # {path: item_id}
+        self._index = None
+        self._crawler = None
+        self._generation = 0  # 每次重建目录树加一，之前发出的列目录结果不再使用
         self._init_frame(title)
         
     def _init_frame(self, title):
@@ -46,22 +58,31 @@ class TreeFrame(wx.Frame):
         self.image_list.Add(wx.Image(os.path.join(RESOURCE_PATH, 'folder.png'), wx.BITMAP_TYPE_PNG).Scale(14,14).ConvertToBitmap())
         self.image_list.Add(wx.Image(os.path.join(RESOURCE_PATH, 'file.png'), wx.BITMAP_TYPE_PNG).Scale(14,14).ConvertToBitmap())
         
-        self.treectrl = wx.TreeCtrl(self, wx.ID_ANY, size=(220, 600))
+        self.tc_search = wx.TextCtrl(self, wx.ID_ANY, pos=(0, 0), size=(170, 24), style=wx.TE_PROCESS_ENTER)
+        self.tc_search.SetToolTip(u"按文件名查找，支持*?通配符，回车查找")
+        self.tc_search.Bind(wx.EVT_TEXT_ENTER, self.on_search)
+        self.btn_refresh = wx.Button(self, wx.ID_ANY, u'刷新', pos=(170, 0), size=(50, 24))
+        self.btn_refresh.Bind(wx.EVT_BUTTON, self.on_refresh)
+
+        self.treectrl = wx.TreeCtrl(self, wx.ID_ANY, pos=(0, 24), size=(220, 576))
         self.treectrl.AssignImageList(self.image_list)
         self.treectrl.Bind(wx.EVT_TREE_SEL_CHANGED, self.on_tree_node_click)
-        self.update_directory_tree()
         
         self.lbl = wx.TextCtrl(self, -1, pos=(220, 0), size=(730, 600), style=wx.TE_READONLY | wx.TE_MULTILINE) 
+        self.update_directory_tree()
 
     def update_tree_frame(self, title, device_driver, bundle_id):
         self.SetTitle(title)
         self.directory_tree = {}
+        self._selected_path = None
+        self._stop_crawler()
         self._device_driver = device_driver
         self._bundle_id = bundle_id
         print 'bundle_id:%s' % self._bundle_id
         self.update_directory_tree()
     
     def update_directory_tree(self, bundle_id=None):
+        self._generation += 1
         self.treectrl.DeleteAllItems()
         if bundle_id:
             self._bundle_id = bundle_id
@@ -69,7 +90,105 @@ class TreeFrame(wx.Frame):
         self.treectrl.SetItemImage(self.treeroot, 0, which=wx.TreeItemIcon_Normal)
         # 添加子目录
         self.directory_tree[self.treeroot] = {'path':self._root_path, 'is_dir':True, 'expanded':True}
-        self.add_item(self.treeroot, self._root_path)
+        self._nodes = {self._root_path: self.treeroot}
+        # 先显示上次列出的结果，再在后台增量刷新
+        self._index = get_sandbox_index(self._device_driver.udid, self._bundle_id)
+        self._fill_item(self.treeroot, self._root_path)
+        self._start_crawler()
+
+    def _start_crawler(self):
+        '''在后台列出沙盒中的所有目录，每列出一个目录就更新已展开的节点
+        '''
+        self._stop_crawler()
+        crawler = SandboxCrawler(self._device_driver, self._index,
+                                 callback=lambda path, items, added, removed:
+                                 wx.CallAfter(self._on_dir_listed, crawler, path, added, removed))
+        self._crawler = crawler
+
+        def _run():
+            try:
+                if self._index.is_listed(self._root_path):
+                    crawler.refresh()
+                else:
+                    crawler.crawl(self._root_path)
+            except:
+                Log.e('SandboxCrawler', traceback.format_exc())
+        t = threading.Thread(target=_run)
+        t.setDaemon(True)
+        t.start()
+
+    def _stop_crawler(self):
+        if self._crawler:
+            self._crawler.cancel()
+            self._crawler = None
+
+    def _on_dir_listed(self, crawler, path, added, removed):
+        if crawler is not self._crawler:
+            return
+        item_id = self._nodes.get(path)
+        if item_id is None or not self.directory_tree[item_id]['expanded']:
+            return  # 节点尚未展开，展开时从索引中取
+        for child in removed:
+            self._remove_node(child)
+        for child in added:
+            item = self._index.get(child)
+            if item and child not in self._nodes:
+                self._append_node(item_id, item)
+
+    def _fill_item(self, item_id, path):
+        '''用索引中的目录内容生成子节点
+
+        :returns: bool -- 目录尚未列出时返回False
+        '''
+        items = self._index.list_dir(path)
+        if items is None:
+            return False
+        self.directory_tree[item_id]['expanded'] = True
+        for item in items:
+            if item['path'] not in self._nodes:
+                self._append_node(item_id, item)
+        return True
+
+    def _append_node(self, parent, item):
+        child = self.treectrl.AppendItem(parent, posixpath.basename(item['path']))
+        self.treectrl.SetItemImage(child, 0 if item['is_dir'] else 1, which=wx.TreeItemIcon_Normal)
+        self.directory_tree[child] = {'path': item['path'], 'is_dir': item['is_dir'], 'expanded': False}
+        self._nodes[item['path']] = child
+        return child
+
+    def _remove_node(self, path):
+        item_id = self._nodes.get(path)
+        if item_id is None:
+            return
+        prefix = path.rstrip('/') + '/'
+        for child_path in [child_path for child_path in self._nodes if child_path.startswith(prefix)] + [path]:
+            self.directory_tree.pop(self._nodes.pop(child_path), None)
+        self.treectrl.Delete(item_id)
+
+    def on_refresh(self, event):
+        self._start_crawler()
+
+    def on_search(self, event):
+        pattern = self.tc_search.GetValue().strip()
+        if not pattern or self._index is None:
+            return
+        self._selected_path = None
+        results = self._index.search(pattern, SEARCH_LIMIT + 1)
+        lines = [u'查找"%s"的结果:' % pattern]
+        if self._crawler and not self._crawler.done:
+            lines.append(u'(目录尚未全部列出，结果可能不完整)')
+        for item in results[:SEARCH_LIMIT]:
+            if item['is_dir']:
+                lines.append(u'%s/' % item['path'])
+            elif item.get('size') is not None:
+                lines.append(u'%s  (%d字节)' % (item['path'], item['size']))
+            else:
+                lines.append(item['path'])
+        if not results:
+            lines.append(u'没有找到匹配的文件')
+        elif len(results) > SEARCH_LIMIT:
+            lines.append(u'......(仅显示前%d个)' % SEARCH_LIMIT)
+        self.lbl.SetValue(u'\n'.join(lines))
 
     def on_tree_node_click(self, event):
         item_id = event.GetItem()
@@ -77,51 +196,86 @@ class TreeFrame(wx.Frame):
         print path
         if self.directory_tree[item_id]['is_dir']:
             if not self.directory_tree[item_id]['expanded']:
-                self.add_item(item_id, path)
+                if not self._fill_item(item_id, path):
+                    self.add_item(item_id, path)
+                self.treectrl.Expand(item_id)
         else:
             if os.path.splitext(path)[1] in SANDBOX_FILE_READ_FORM:
-                try:
-                    content = self._device_driver.get_sandbox_file_content(self._bundle_id, path)
-                    self.lbl.SetValue(base64.b64decode(content))
-                except:
-                    msg = traceback.format_exc() # 方式1  
-                    print (msg)
-                    self.lbl.SetValue('该文件可能存在某些字符导致无法base64编码')
+                self._selected_path = path
+                self.lbl.SetValue(u'正在读取文件......')
+                self._run_in_work_thread(self._load_file, self._device_driver, self._bundle_id, path)
             else:
+                self._selected_path = None
                 self.lbl.SetValue('不支持该格式的文件显示')
+
+    def _load_file(self, device_driver, bundle_id, path):
+        '''在工作线程中分块下载文件到本地镜像，只把开头部分显示在文本框中
+        '''
+        def _progress(done, total):
+            if self._selected_path != path:
+                return False  # 已切换到其他文件，下次查看时从中断处继续
+            if total > PREVIEW_BYTES:
+                wx.CallAfter(self._show_file, path, u'正在读取文件......%d%%' % (done * 100 // total))
+        try:
+            local_path = device_driver.download_sandbox_file(bundle_id, path, progress=_progress)
+            if local_path is None:
+                return
+            with open(local_path, 'rb') as fd:
+                content = fd.read(PREVIEW_BYTES)
+            text = content.decode('utf-8', 'replace')
+            size = os.path.getsize(local_path)
+            if size > PREVIEW_BYTES:
+                text += u'\n\n......(文件共%d字节，仅显示前%d字节，完整文件: %s)' % (
+                    size, PREVIEW_BYTES, local_path.decode(sys.getfilesystemencoding() or 'utf-8'))
+        except:
+            msg = traceback.format_exc()
+            Log.e('load_file', msg)
+            text = u'读取文件失败:\n%s' % msg.decode('utf-8', 'replace')
+        wx.CallAfter(self._show_file, path, text)
+
+    def _show_file(self, path, text):
+        if self._selected_path == path:
+            self.lbl.SetValue(text)
     
     def add_item(self, root, path):
+        '''索引中还没有该目录时，在工作线程中列出目录后生成子节点
+        '''
         self.directory_tree[root]['expanded'] = True
+        self._run_in_work_thread(self._list_dir, self._device_driver, self._bundle_id, root, path, self._generation)
+
+    def _list_dir(self, device_driver, bundle_id, root, path, generation):
         try:
-            file_list = self._device_driver.get_sandbox_path_files(self._bundle_id, path)
-            for i in file_list:
-                # 获得绝对路径
-                tmpdir = os.path.join(path, i['path'])
-                tmpdict = {}
-                # 如果是路径的话 还需对该路径进行一次操作
-                if i['is_dir']:
-                    child = self.treectrl.AppendItem(root, os.path.basename(i['path']))
-                    tmpdict['path'] = tmpdir
-                    tmpdict['is_dir'] = i['is_dir']
-                    tmpdict['expanded'] = False
-                    self.directory_tree[child] = tmpdict
-                    self.treectrl.SetItemImage(child, 0, which=wx.TreeItemIcon_Normal)
-                    tmpdict = {}
-                # 如果是目录的话
-                else:
-                    child = self.treectrl.AppendItem(root, os.path.basename(i['path']))
-                    tmpdict['path'] = tmpdir
-                    tmpdict['is_dir'] = i['is_dir']
-                    tmpdict['expanded'] = False
-                    self.directory_tree[child] = tmpdict
-                    self.treectrl.SetItemImage(child, 1, which=wx.TreeItemIcon_Normal)
-                    tmpdict = {}
+            file_list = device_driver.get_sandbox_path_files(bundle_id, path)
         except:
             error = traceback.format_exc()
             Log.e('add_item', error)
-            self._main_frame.create_tip_dialog(error.decode('utf-8'))
+            wx.CallAfter(self._main_frame.create_tip_dialog, error.decode('utf-8'))
+            return
+        items = [{'path': os.path.join(path, item['path']), 'is_dir': item['is_dir']} for item in file_list]
+        wx.CallAfter(self._on_items_listed, root, path, items, generation)
+
+    def _on_items_listed(self, root, path, items, generation):
+        if generation != self._generation or self._nodes.get(path) != root:
+            return  # 目录树已经重建
+        for item in items:
+            # 爬取线程可能已经添加了部分节点
+            if item['path'] not in self._nodes:
+                self._append_node(root, item)
+
+    def _run_in_work_thread(self, func, *args):
+        t = threading.Thread(target=func, args=args)
+        t.setDaemon(True)
+        t.start()
 
     def on_close(self, event):
+        self._selected_path = None
+        self._stop_crawler()
         self._main_frame.on_close_treeFrame()
-        self._device_driver.close_sandbox_client()
+        self._run_in_work_thread(self._close_sandbox_client, self._device_driver)
         event.Skip()
+
+    def _close_sandbox_client(self, device_driver):
+        try:
+            device_driver.close_sandbox_client()
+        except:
+            Log.e('close_sandbox_client', traceback.format_exc())
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# Tencent is pleased to support the open source community by making QTA available.
+# Copyright (C) 2016THL A29 Limited, a Tencent company. All rights reserved.
+# Licensed under the BSD 3-Clause License (the "License"); you may not use this
+# file except in compliance with the License. You may obtain a copy of the License at
+#
+# https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" basis, WITHOUT WARRANTIES OR CONDITIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+'''控件树的查找、遍历和增量比较，不依赖界面库
+'''
+
+import copy
+import hashlib
+import json
+
+
+def check_pos_in_element(pos, element):
+    '''坐标是否在可见控件的范围内
+    '''
+    rect = element['rect']
+    if pos[0] >= rect['origin']['x'] and pos[0] <= rect['origin']['x'] + rect['size']['width'] \
+       and pos[1] >= rect['origin']['y'] and pos[1] <= rect['origin']['y'] + rect['size']['height'] \
+       and element['visible']:
+        return True
+    else:
+        return False
+
+
+def select_closest_element(pos, element1, element2):
+    '''选择距离最近的控件，具体规则如下：
+        1、如果element1和element2的位置是包含关系（父子关系），则选择子节点
+        2、如果element1和element2的位置是部分重叠，则选择距离控件中心最近的控件
+    '''
+    rect1 = element1['rect']
+    rect2 = element2['rect']
+    if rect1['origin']['x'] >= rect2['origin']['x'] and \
+        rect1['origin']['x'] + rect1['size']['width'] <= rect2['origin']['x'] + rect2['size']['width'] and \
+        rect1['origin']['y'] >= rect2['origin']['y'] and \
+        rect1['origin']['y'] + rect1['size']['height'] <= rect2['origin']['y'] + rect2['size']['height']:
+        return element1
+
+    if rect2['origin']['x'] >= rect1['origin']['x'] and \
+        rect2['origin']['x'] + rect2['size']['width'] <= rect1['origin']['x'] + rect1['size']['width'] and \
+        rect2['origin']['y'] >= rect1['origin']['y'] and \
+        rect2['origin']['y'] + rect2['size']['height'] <= rect1['origin']['y'] + rect1['size']['height']:
+        return element2
+
+    center1 = (rect1['origin']['x'] + rect1['size']['width'] / 2.0, rect1['origin']['y'] + rect1['size']['height'] / 2.0)
+    center2 = (rect2['origin']['x'] + rect2['size']['width'] / 2.0, rect2['origin']['y'] + rect2['size']['height'] / 2.0)
+    distance1 = (pos[0] - center1[0]) ** 2 + (pos[1] - center1[1]) ** 2
+    distance2 = (pos[0] - center2[0]) ** 2 + (pos[1] - center2[1]) ** 2
+    if distance1 <= distance2:
+        return element1
+    else:
+        return element2
+
+
+def get_focused_element(pos, root, focused=None):
+    '''优先查找叶子节点的控件（深度遍历）
+
+    :param pos: 坐标(x, y)
+    :type pos: tuple
+    :param root: 控件树的根节点，本身不参与查找
+    :type root: dict
+    :returns: dict -- 坐标处的控件，没有时返回focused
+    '''
+    for e in root['children']:
+        focused = get_focused_element(pos, e, focused)
+        if check_pos_in_element(pos, e):
+            if focused is None:
+                focused = e
+            else:
+                focused = select_closest_element(pos, focused, e)
+    return focused
+
+
+def dfs_traverse(element_tree, element_list=None):
+    '''深度优先遍历，返回包含所有控件的列表
+    '''
+    if element_list is None:
+        element_list = []
+    element_list.append(element_tree)
+    for e in element_tree['children']:
+        dfs_traverse(e, element_list)
+    return element_list
+
+
+# 使用者附加在控件上的字段(如MainFrame的树节点id)，不属于控件内容，不参与哈希
+ANNOTATION_KEYS = frozenset(['item_id', 'depth'])
+# 增量控件树中代替未变化子树的引用，{REF_KEY: 子树哈希}
+REF_KEY = '$ref'
+# sort_keys would switch json to its pure python encoder, keys are sorted by
+# _canonical instead
+_digest_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return sorted((key, _canonical(item)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    return value
+
+
+def element_digest(element):
+    '''控件自身属性(不含子控件)的规范化JSON，键按字典序排列
+    '''
+    props = sorted((key, _canonical(value)) for key, value in element.iteritems()
+                   if key != 'children' and key not in ANNOTATION_KEYS)
+    return _digest_encoder.encode(props)
+
+
+def hash_tree(root, known=None):
+    '''计算每棵子树的内容哈希，子树哈希由控件属性和子控件的哈希决定
+
+    :param known: 另一棵树的哈希，两棵树共享的子树不再重新计算
+    :type known: dict
+    :returns: dict -- {id(控件): 哈希}，只包含root中的控件，调用者需保证树在使用期间存活，避免id被复用
+    '''
+    hashes = {}
+
+    def _copy(element):
+        hashes[id(element)] = known[id(element)]
+        for child in element['children']:
+            _copy(child)
+
+    def _hash(element):
+        if known is not None and id(element) in known:
+            _copy(element)
+            return hashes[id(element)]
+        digest = hashlib.sha1(element_digest(element))
+        for child in element['children']:
+            digest.update(_hash(child))
+        value = hashes[id(element)] = digest.hexdigest()[:16]
+        return value
+    _hash(root)
+    return hashes
+
+
+def index_by_hash(root, hashes):
+    '''按哈希索引所有子树
+
+    :returns: dict -- {哈希: 控件}
+    '''
+    index = {}
+    for element in dfs_traverse(root):
+        index.setdefault(hashes[id(element)], element)
+    return index
+
+
+def reference_subtrees(root, known, hashes):
+    '''把哈希在known中的子树替换为引用，用于只传输变化的部分
+
+    :param known: 对方已有的子树哈希
+    :type known: set
+    '''
+    value = hashes[id(root)]
+    if value in known:
+        return {REF_KEY: value}
+    element = dict(root)
+    element['children'] = [reference_subtrees(child, known, hashes) for child in root['children']]
+    return element
+
+
+def resolve_references(delta, index):
+    '''用已有的子树替换增量控件树中的引用，未变化的子树与原来的树共享同一对象
+
+    :param index: index_by_hash的结果
+    :type index: dict
+    :raises: KeyError -- 引用了不存在的子树
+    '''
+    used = set()
+
+    def _resolve(element):
+        if REF_KEY in element:
+            subtree = index[element[REF_KEY]]
+            if id(subtree) in used:
+                # the same content appears twice, do not alias one object
+                return copy.deepcopy(subtree)
+            used.add(id(subtree))
+            return subtree
+        element['children'] = [_resolve(child) for child in element['children']]
+        return element
+    return _resolve(delta)
+
+
+def known_hashes(root, hashes):
+    '''可供对方引用的子树哈希，叶子控件直接传输的代价与引用相当，不包括在内
+    '''
+    return [hashes[id(element)] for element in dfs_traverse(root) if element['children']]
+
+
+def diff_trees(old, new, old_hashes, new_hashes):
+    '''按位置比较两棵树，返回把old变为new的操作列表
+
+    操作为(op, path, element)，path为从根节点开始的子控件下标:
+        ('update', path, element)  -- 控件自身属性变化，子控件数量不变(子控件另有各自的操作)
+        ('replace', path, element) -- 子控件数量变化，整棵子树替换为element
+
+    :returns: list
+    '''
+    patch = []
+
+    def _diff(o, n, path):
+        if o is n or old_hashes[id(o)] == new_hashes[id(n)]:
+            return
+        if len(o['children']) != len(n['children']):
+            patch.append(('replace', path, n))
+            return
+        if element_digest(o) != element_digest(n):
+            patch.append(('update', path, n))
+        for index, (old_child, new_child) in enumerate(zip(o['children'], n['children'])):
+            _diff(old_child, new_child, path + (index,))
+    _diff(old, new, ())
+    return patch
+
+
+def copy_annotations(old, new, keys=ANNOTATION_KEYS):
+    '''把old中各控件的附加字段按位置复制到new中对应的控件，子控件数量不同的子树不再深入
+    '''
+    pairs = []
+
+    def _collect(o, n):
+        if o is n:
+            return
+        values = [(key, o[key]) for key in keys if key in o]
+        pairs.append((n, values))
+        if len(o['children']) == len(n['children']):
+            for old_child, new_child in zip(o['children'], n['children']):
+                _collect(old_child, new_child)
+    # collect everything first, a subtree shared by both trees may have moved
+    _collect(old, new)
+    for element, values in pairs:
+        element.update(values)
+
+
+def get_element(root, path):
+    '''按子控件下标的路径查找控件
+    '''
+    element = root
+    for index in path:
+        element = element['children'][index]
+    return element